@@ -1,28 +1,73 @@
+import os
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_bcrypt import Bcrypt
+from app.database import Session
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': Session})
 bcrypt = Bcrypt()
 login_manager = LoginManager()
 login_manager.login_view = 'main.login'
 login_manager.login_message_category = 'info'
 
-def create_app():
+def create_app(config=None):
     app = Flask(__name__)
-    app.config['SECRET_KEY'] = '5791628bb0b13ce0c676dfde280ba245' # Change this in production!
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///site.db'
+    # APP_ENV selects the config class (development or production); single
+    # settings can be overridden with FLASK_-prefixed environment variables
+    from app.config import config_for
+    app.config.from_object(config_for(os.environ.get('APP_ENV', 'development')))
+    app.config.from_prefixed_env()
+    # Overrides (e.g. an in-memory database for tests) must be applied before
+    # the extensions are initialised, as the engine is created in init_app
+    if config:
+        app.config.update(config)
+    if not app.config['SECRET_KEY']:
+        raise RuntimeError('Set the SECRET_KEY environment variable')
     
     db.init_app(app)
     bcrypt.init_app(app)
     login_manager.init_app(app)
     
+    from app import database
+    with app.app_context():
+        database.init_engine(app, db.engine)
+    
+    from app.cache import cache
+    cache.init_app(app)
+    
+    from app.passwords import hasher
+    hasher.init_app(app)
+    
+    from app import instrumentation, jobs, recurring, archive
+    instrumentation.init_app(app)
+    jobs.init_app(app)
+    recurring.init_app(app)
+    archive.init_app(app)
+    
     from app.routes import main
     app.register_blueprint(main)
     
+    from app.api import api
+    app.register_blueprint(api)
+    
+    from app.money import format_money
+    app.add_template_filter(format_money, 'money')
+    
+    # app.search and app.changes also hook their triggers into the table DDL
+    from app import migrations, rollup, importer, search, changes
+    app.cli.add_command(migrations.upgrade_command)
+    app.cli.add_command(rollup.rollup_command)
+    app.cli.add_command(importer.import_command)
+    app.cli.add_command(jobs.purge_command)
+    app.cli.add_command(search.rebuild_command)
+    app.cli.add_command(recurring.run_command)
+    app.cli.add_command(changes.prune_command)
+    app.cli.add_command(archive.archive_command)
+    app.cli.add_command(archive.compact_command)
+    
     with app.app_context():
-        db.create_all()
+        migrations.upgrade()
         
         # Create default categories if they don't exist
         from app.models import Category
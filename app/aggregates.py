@@ -0,0 +1,239 @@
+from datetime import datetime
+from app import db, recurring, refdata
+from app.cache import cache, dashboard_key
+from app.models import ArchiveBatch, Budget, Category, MonthlySpend
+from app.money import from_minor
+from sqlalchemy import func, and_, or_, literal, union_all
+from sqlalchemy.orm import aliased
+
+# Percentage of a budget at which a category is flagged with a warning
+WARNING_THRESHOLD = 90
+
+# Sums are taken over integer cents in the database, so they are exact, and
+# returned as Decimal amounts (see app.money).
+
+
+def month_range(year, month):
+    """Half-open [start, end) datetime window covering a calendar month"""
+    start = datetime(year, month, 1)
+    end = datetime(year + 1, 1, 1) if month == 12 else datetime(year, month + 1, 1)
+    return start, end
+
+
+def in_month(column, year, month):
+    """Range filter on a date column that can use the (user_id, date) indexes,
+    unlike comparing func.extract() results"""
+    start, end = month_range(year, month)
+    return and_(column >= start, column < end)
+
+
+def _period_filter(year_col, month_col, periods):
+    return or_(*[and_(year_col == year, month_col == month) for year, month in periods])
+
+
+def monthly_spending(user_id, year, month):
+    """Total spending of a user in a month, read from the rollup"""
+    return from_minor(db.session.query(func.sum(MonthlySpend.total_cents)).filter(
+        MonthlySpend.user_id == user_id,
+        MonthlySpend.year == year,
+        MonthlySpend.month == month
+    ).scalar())
+
+
+def expense_count(user_id, archived=True):
+    """Number of expenses a user has recorded, read from the rollup. With
+    archived=False, only those still in the expense table (see app.archive)."""
+    count = db.session.query(func.sum(MonthlySpend.count)).filter(
+        MonthlySpend.user_id == user_id
+    ).scalar() or 0
+    if not archived:
+        count -= db.session.query(func.sum(ArchiveBatch.row_count)).filter(
+            ArchiveBatch.user_id == user_id, ArchiveBatch.moved
+        ).scalar() or 0
+    return count
+
+
+def monthly_budget(user_id, year, month):
+    """Total budget of a user for a month"""
+    return from_minor(db.session.query(func.sum(Budget.amount_cents)).filter(
+        Budget.user_id == user_id,
+        Budget.year == year,
+        Budget.month == month
+    ).scalar())
+
+
+def _totals_query(user_ids, periods):
+    """Spending (from the monthly rollup) and budget per (user, category, year, month)
+    in one grouped query.
+
+    A category's spending covers its whole subtree: each rollup row is joined
+    to every ancestor of its category, found by materialized path prefix. Only
+    the default categories and the user's own are candidate ancestors.
+    """
+    category = aliased(Category)
+    ancestor = aliased(Category)
+    spending = db.session.query(
+        MonthlySpend.user_id.label('user_id'),
+        ancestor.id.label('category_id'),
+        MonthlySpend.year.label('year'),
+        MonthlySpend.month.label('month'),
+        MonthlySpend.total_cents.label('spending'),
+        literal(0).label('budget')
+    ).join(
+        category, category.id == MonthlySpend.category_id
+    ).join(
+        ancestor, and_(category.path.startswith(ancestor.path),
+                       or_(ancestor.user_id.is_(None), ancestor.user_id == MonthlySpend.user_id))
+    ).filter(
+        MonthlySpend.user_id.in_(user_ids),
+        _period_filter(MonthlySpend.year, MonthlySpend.month, periods)
+    )
+
+    budgets = db.session.query(
+        Budget.user_id,
+        Budget.category_id,
+        Budget.year,
+        Budget.month,
+        literal(0),
+        Budget.amount_cents
+    ).filter(
+        Budget.user_id.in_(user_ids),
+        _period_filter(Budget.year, Budget.month, periods)
+    )
+
+    combined = union_all(spending, budgets).subquery()
+    return db.session.query(
+        combined.c.user_id,
+        combined.c.category_id,
+        combined.c.year,
+        combined.c.month,
+        func.sum(combined.c.spending),
+        func.sum(combined.c.budget)
+    ).group_by(
+        combined.c.user_id,
+        combined.c.category_id,
+        combined.c.year,
+        combined.c.month
+    )
+
+
+def budget_row(category_name, spending, budget_amount):
+    remaining = budget_amount - spending
+
+    # Calculate percentage used
+    percent_used = float(spending / budget_amount * 100) if budget_amount > 0 else 0
+
+    # Alerts: Over budget or 90%+ used
+    alert = budget_amount > 0 and spending > budget_amount
+    warning = budget_amount > 0 and not alert and percent_used >= WARNING_THRESHOLD
+
+    if alert:
+        status = 'Over Budget'
+    elif warning:
+        status = 'Warning (90%+)'
+    elif budget_amount > 0:
+        status = 'OK'
+    else:
+        status = 'No Budget Set'
+
+    return {
+        'category': category_name,
+        'spending': spending,
+        'budget': budget_amount,
+        'remaining': remaining,
+        'percent_used': percent_used,
+        'alert': alert,
+        'warning': warning,
+        'status': status
+    }
+
+
+def budget_vs_spending_tables(user_ids, periods):
+    """Budget vs spending tables for every combination of users and (year, month) periods.
+
+    Returns a dict keyed by (user_id, year, month) whose values are lists of
+    per-category rows in the order of the user's category tree. A row's
+    spending includes its subcategories; 'depth' is 0 for top-level rows.
+    """
+    # Accept a single user id or a single (year, month) pair as well
+    user_ids = [user_ids] if isinstance(user_ids, int) else list(user_ids)
+    periods = [periods] if isinstance(periods, tuple) else list(periods)
+
+    totals = {}
+    for user_id, category_id, year, month, spending, budget in _totals_query(user_ids, periods):
+        totals[(user_id, category_id, int(year), int(month))] = (from_minor(spending), from_minor(budget))
+
+    tables = {}
+    for user_id in user_ids:
+        tree = refdata.category_tree(user_id)
+        for year, month in periods:
+            rows = []
+            for node in tree:
+                spending, budget = totals.get((user_id, node.id, year, month), (from_minor(0), from_minor(0)))
+                row = budget_row(node.label, spending, budget)
+                row.update(category_id=node.id, name=node.name, depth=node.depth)
+                rows.append(row)
+            tables[(user_id, year, month)] = rows
+    return tables
+
+
+def budget_vs_spending(user_id, year, month):
+    """Budget vs spending table for a single user and month"""
+    return budget_vs_spending_tables([user_id], [(year, month)])[(user_id, year, month)]
+
+
+def table_totals(rows):
+    """Total spending and budget across the rows of a budget vs spending table
+    (in category tree order).
+
+    Each subtree is counted once for both. Spending is summed over top-level
+    rows, as they already include their subcategories. A budget covers its
+    category's whole subtree too, so only the topmost budgeted row of each
+    branch counts; budgets of its subcategories are shares of it.
+    """
+    spending = sum((r['spending'] for r in rows if not r.get('depth')), from_minor(0))
+    budget = from_minor(0)
+    budgeted_depth = None # Depth of the budgeted ancestor of the current row, if any
+    for r in rows:
+        depth = r.get('depth') or 0
+        if budgeted_depth is not None and depth <= budgeted_depth:
+            budgeted_depth = None
+        if budgeted_depth is None and r['budget'] > 0:
+            budget += r['budget']
+            budgeted_depth = depth
+    return spending, budget
+
+
+def add_commitments(user_id, rows, committed):
+    """Add the committed (recurring, not yet spent) amount and the projected
+    month-end spending to each row of a user's budget vs spending table.
+    committed maps category ids to cents and is rolled up the tree like spending."""
+    tree = refdata.category_tree(user_id)
+    paths = {node.id: node.path for node in tree}
+    subtree = {}
+    for category_id, cents in committed.items():
+        for ancestor in paths.get(category_id, '').strip('/').split('/'):
+            if ancestor:
+                subtree[int(ancestor)] = subtree.get(int(ancestor), 0) + cents
+    for node, row in zip(tree, rows):
+        row['committed'] = from_minor(subtree.get(node.id, 0))
+        row['projected'] = row['spending'] + row['committed']
+        row['projected_over'] = row['budget'] > 0 and row['projected'] > row['budget']
+    return rows
+
+
+def dashboard_summary(user_id, year, month):
+    """Budget vs spending table plus totals for the dashboard, with the
+    spending recurring expenses are still due to add this month.
+
+    Results are cached per (user_id, year, month) and dropped whenever an
+    expense, budget or recurring expense in that month is written.
+    """
+    def compute():
+        rows = add_commitments(user_id, budget_vs_spending(user_id, year, month),
+                               recurring.committed_spend(user_id, year, month))
+        total_spending, total_budget = table_totals(rows)
+        total_committed = sum((r['committed'] for r in rows if not r['depth']), from_minor(0))
+        return {'budget_vs_spending': rows, 'total_spending': total_spending, 'total_budget': total_budget,
+                'total_committed': total_committed}
+    return cache.get_or_set(dashboard_key(user_id, year, month), compute)
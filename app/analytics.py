@@ -0,0 +1,201 @@
+"""Spending trends and breakdowns over arbitrary date ranges, served as JSON
+under /api/analytics.
+
+Each function answers its whole range with one grouped query. The sparse
+result is then laid out as a dense series, with zero for periods that have
+no spending, so rolling averages and period-over-period changes always
+compare consecutive periods.
+"""
+from collections import defaultdict
+from datetime import date, timedelta
+from decimal import Decimal, ROUND_HALF_UP
+from sqlalchemy import Integer, func, select
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+from app import db, archive, refdata
+from app.aggregates import budget_vs_spending_tables, table_totals
+from app.models import Expense, MonthlySpend
+from app.money import from_minor
+
+GRANULARITIES = ('day', 'week', 'month')
+EPOCH = date(1970, 1, 1)
+DEFAULT_WINDOW = 3
+
+# 1970-01-01 was a Thursday; shifting by three days starts weeks on Monday
+_WEEK_OFFSET = 3
+
+
+class days_since_epoch(FunctionElement):
+    """Whole days between EPOCH and a datetime column, computed by the database
+    so no datetime objects have to be built in Python"""
+    type = Integer()
+    inherit_cache = True
+
+
+@compiles(days_since_epoch)
+def _days_since_epoch(element, compiler, **kw):
+    return f"(CAST({compiler.process(element.clauses, **kw)} AS DATE) - DATE '1970-01-01')"
+
+
+@compiles(days_since_epoch, 'sqlite')
+def _days_since_epoch_sqlite(element, compiler, **kw):
+    return f'CAST(julianday({compiler.process(element.clauses, **kw)}) - 2440587.5 AS INTEGER)'
+
+
+def _month_index(d):
+    return d.year * 12 + d.month - 1
+
+
+def period_key(granularity, d):
+    """Integer index of the day, week or month containing date d"""
+    if granularity == 'day':
+        return (d - EPOCH).days
+    if granularity == 'week':
+        return ((d - EPOCH).days + _WEEK_OFFSET) // 7
+    return _month_index(d)
+
+
+def period_start(granularity, key):
+    """First date of the period with the given index"""
+    if granularity == 'day':
+        return EPOCH + timedelta(days=key)
+    if granularity == 'week':
+        return EPOCH + timedelta(days=key * 7 - _WEEK_OFFSET)
+    return date(key // 12, key % 12 + 1, 1)
+
+
+def period_count(granularity, start, end):
+    return period_key(granularity, end) - period_key(granularity, start) + 1
+
+
+def _in_range(start, end):
+    # Inclusive dates as a half-open range the (user_id, date) index can use
+    return Expense.date >= start, Expense.date < end + timedelta(days=1)
+
+
+def _grouped_spending(user_id, start, end, granularity, category_id=None):
+    """Spending in cents per (period key, category_id)"""
+    if granularity == 'month':
+        # Whole calendar months, already grouped in the monthly rollup
+        key = MonthlySpend.year * 12 + MonthlySpend.month - 1
+        query = db.session.query(key, MonthlySpend.category_id, MonthlySpend.total_cents).filter(
+            MonthlySpend.user_id == user_id,
+            key.between(_month_index(start), _month_index(end))
+        )
+        if category_id:
+            query = query.filter(MonthlySpend.category_id.in_(refdata.subtree_ids(user_id, category_id)))
+    else:
+        days = days_since_epoch(Expense.date)
+        key = days if granularity == 'day' else (days + _WEEK_OFFSET) // 7
+        query = select(key, Expense.category_id, func.sum(Expense.amount_cents)).where(
+            Expense.user_id == user_id, *_in_range(start, end)
+        ).group_by(key, Expense.category_id)
+        if category_id:
+            query = query.where(Expense.category_id.in_(refdata.subtree_ids(user_id, category_id)))
+        # Raw expenses, so the archived ones are added in
+        spending = defaultdict(int)
+        for period, category, cents in archive.rows(query, start, end):
+            spending[(int(period), category)] += cents
+        return dict(spending)
+    return {(int(period), category): cents for period, category, cents in query}
+
+
+def _average(cents, count):
+    return from_minor((Decimal(cents) / count).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def spending_series(user_id, start, end, granularity='month', category_id=None, window=DEFAULT_WINDOW):
+    """Spending per day, week or month from start to end (inclusive dates).
+
+    Every period has its total, a per-category split, the average of the
+    last `window` periods (fewer at the start of the range) and the change
+    from the previous period.
+    """
+    by_period = defaultdict(dict)
+    for (key, category), cents in _grouped_spending(user_id, start, end, granularity, category_id).items():
+        by_period[key][category] = cents
+
+    keys = range(period_key(granularity, start), period_key(granularity, end) + 1)
+    totals = [sum(by_period[key].values()) for key in keys]
+    series = []
+    window_total = 0
+    for i, key in enumerate(keys):
+        total = totals[i]
+        window_total += total - (totals[i - window] if i >= window else 0)
+        previous = totals[i - 1] if i else None
+        series.append({
+            'period': period_start(granularity, key).isoformat(),
+            'total': from_minor(total),
+            'by_category': {str(category): from_minor(cents) for category, cents in sorted(by_period[key].items())},
+            'rolling_average': _average(window_total, min(i + 1, window)),
+            'change': from_minor(total - previous) if previous is not None else None,
+            'change_percent': round((total - previous) / previous * 100, 1) if previous else None
+        })
+    return {
+        'granularity': granularity,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'window': window,
+        'categories': {str(id): name for id, name in refdata.category_names(user_id).items()},
+        'series': series
+    }
+
+
+def category_breakdown(user_id, start, end):
+    """Spending per category from start to end (inclusive dates), largest first"""
+    query = select(
+        Expense.category_id, func.sum(Expense.amount_cents), func.count(Expense.id)
+    ).where(
+        Expense.user_id == user_id, *_in_range(start, end)
+    ).group_by(Expense.category_id)
+    totals = defaultdict(lambda: [0, 0])
+    for category_id, cents, count in archive.rows(query, start, end):
+        totals[category_id][0] += cents
+        totals[category_id][1] += count
+    rows = [(category_id, cents, count) for category_id, (cents, count) in totals.items()]
+
+    names = refdata.category_names(user_id)
+    grand_total = sum(cents for _, cents, _ in rows)
+    categories = [{
+        'id': category_id,
+        'name': names.get(category_id, ''),
+        'total': from_minor(cents),
+        'count': count,
+        'average': _average(cents, count),
+        'share_percent': round(cents / grand_total * 100, 1)
+    } for category_id, cents, count in sorted(rows, key=lambda r: (-r[1], r[0]))]
+    return {
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'total': from_minor(grand_total),
+        'count': sum(count for _, _, count in rows),
+        'categories': categories
+    }
+
+
+def budget_adherence(user_id, start, end):
+    """Budget against spending for every month from start to end"""
+    periods = [(key // 12, key % 12 + 1) for key in range(_month_index(start), _month_index(end) + 1)]
+    tables = budget_vs_spending_tables(user_id, periods)
+
+    months = []
+    for year, month in periods:
+        rows = tables[(user_id, year, month)]
+        spending, budget = table_totals(rows)
+        months.append({
+            'month': f'{year}-{month:02d}',
+            'budget': budget,
+            'spending': spending,
+            'percent_used': round(float(spending / budget * 100), 1) if budget else None,
+            'within_budget': spending <= budget if budget else None,
+            'categories_budgeted': sum(1 for r in rows if r['budget'] > 0),
+            'categories_over_budget': sum(1 for r in rows if r['alert'])
+        })
+    budgeted = [m for m in months if m['budget']]
+    return {
+        'start': f'{periods[0][0]}-{periods[0][1]:02d}',
+        'end': f'{periods[-1][0]}-{periods[-1][1]:02d}',
+        'months_budgeted': len(budgeted),
+        'months_within_budget': sum(1 for m in budgeted if m['within_budget']),
+        'months': months
+    }
@@ -0,0 +1,529 @@
+"""Versioned JSON API for mobile clients, under /api/v1.
+
+Requests authenticate with a bearer token from POST /api/v1/tokens; the
+browser session is not accepted, so the API needs no CSRF protection.
+Collections can be created and deleted in batches, `fields` selects the
+fields returned (and the columns loaded), reads answer conditional requests
+from the change log (app.changes) with an ETag and Last-Modified, and
+/changes returns what changed after a cursor. Responses are gzip-compressed
+for clients that accept it, and request bodies may be sent gzip-compressed.
+"""
+import gzip
+import hashlib
+import json
+import secrets
+import zlib
+from datetime import datetime, timedelta
+from decimal import InvalidOperation
+from flask import Blueprint, Response, abort, current_app, g, jsonify, request
+from sqlalchemy import delete, or_, select, tuple_
+from sqlalchemy.orm import load_only
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import is_resource_modified
+from app import db, aggregates, archive, changes, database, pagination, refdata, throttle
+from app.cache import data_version, touch
+from app.models import User, ApiToken, Expense, Budget, Category
+from app.money import to_minor, DEFAULT_CURRENCY
+from app.passwords import hasher
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+# Items per batch request, and per page of a collection
+MAX_BATCH = 500
+DEFAULT_PER_PAGE = 50
+MAX_PER_PAGE = 200
+MAX_CHANGES = 1000
+# Smaller responses are not worth compressing
+GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+# Largest request body, as sent and once decompressed
+MAX_BODY_SIZE = 5 * 1024 * 1024
+
+
+# Fields of each resource: name -> (columns to load, getter). Getters work on
+# model instances and, for categories, on refdata.CategoryNode.
+EXPENSE_FIELDS = {
+    'id': (('id',), lambda e: e.id),
+    'date': (('date',), lambda e: e.date.strftime('%Y-%m-%d')),
+    'amount': (('amount_cents', 'currency'), lambda e: e.amount),
+    'currency': (('currency',), lambda e: e.currency),
+    'description': (('description',), lambda e: e.description),
+    'category_id': (('category_id',), lambda e: e.category_id),
+    'recurring_id': (('recurring_id',), lambda e: e.recurring_id)
+}
+BUDGET_FIELDS = {
+    'id': (('id',), lambda b: b.id),
+    'category_id': (('category_id',), lambda b: b.category_id),
+    'year': (('year',), lambda b: b.year),
+    'month': (('month',), lambda b: b.month),
+    'amount': (('amount_cents', 'currency'), lambda b: b.amount),
+    'currency': (('currency',), lambda b: b.currency)
+}
+CATEGORY_FIELDS = {
+    'id': (('id',), lambda c: c.id),
+    'name': (('name',), lambda c: c.name),
+    'parent_id': (('parent_id',), lambda c: c.parent_id),
+    'depth': (('path',), lambda c: c.depth)
+}
+RESOURCES = {'expense': (Expense, EXPENSE_FIELDS), 'budget': (Budget, BUDGET_FIELDS),
+             'category': (Category, CATEGORY_FIELDS)}
+
+
+def hash_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+@api.before_request
+def _authenticate():
+    """Sets g.api_user and g.api_token_id from the 'Authorization: Bearer' header"""
+    if request.endpoint == 'api.create_token':
+        return None
+    # Flask-Login's current_user is not used: it would also accept the
+    # browser session cookie
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    row = None
+    if scheme.lower() == 'bearer' and token.strip():
+        row = db.session.query(User, ApiToken.id).join(ApiToken, ApiToken.user_id == User.id).filter(
+            ApiToken.token_hash == hash_token(token.strip())
+        ).first()
+    if row is None:
+        response = jsonify(error='A valid bearer token is required')
+        response.status_code = 401
+        response.headers['WWW-Authenticate'] = 'Bearer'
+        return response
+    g.api_user, g.api_token_id = row
+
+
+@api.errorhandler(HTTPException)
+def _json_error(e):
+    response = jsonify(error=e.description)
+    response.status_code = e.code
+    return response
+
+
+@api.after_request
+def _finish(response):
+    response.headers.setdefault('Cache-Control', 'private, no-cache')
+    response.vary.add('Authorization')
+    response.vary.add('Accept-Encoding')
+    if (response.direct_passthrough or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers or not request.accept_encodings['gzip']):
+        return response
+    data = response.get_data()
+    if len(data) >= current_app.config.get('API_GZIP_MIN_SIZE', GZIP_MIN_SIZE):
+        response.set_data(gzip.compress(data, GZIP_LEVEL))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def _body():
+    """The JSON object sent in the request body, gunzipped if need be"""
+    if (request.content_length or 0) > MAX_BODY_SIZE:
+        abort(413, 'Request body is too large')
+    # Bounded as well, for bodies sent without a Content-Length
+    data = request.stream.read(MAX_BODY_SIZE + 1)
+    if len(data) > MAX_BODY_SIZE:
+        abort(413, 'Request body is too large')
+    if request.headers.get('Content-Encoding', '').lower() == 'gzip':
+        decompressor = zlib.decompressobj(wbits=31)
+        try:
+            data = decompressor.decompress(data, MAX_BODY_SIZE)
+        except zlib.error:
+            abort(400, 'Request body is not valid gzip')
+        if decompressor.unconsumed_tail:
+            abort(413, 'Request body is too large')
+    try:
+        body = json.loads(data)
+    except ValueError:
+        abort(400, 'Request body must be JSON')
+    if not isinstance(body, dict):
+        abort(400, 'Request body must be a JSON object')
+    return body
+
+
+def _batch(body, key):
+    items = body.get(key)
+    if not isinstance(items, list) or not items:
+        abort(400, f'{key} must be a non-empty list')
+    if len(items) > MAX_BATCH:
+        abort(413, f'At most {MAX_BATCH} {key} per request')
+    return items
+
+
+def _ids(body):
+    ids = _batch(body, 'ids')
+    if not all(isinstance(id, int) and not isinstance(id, bool) for id in ids):
+        abort(400, 'ids must be integers')
+    return ids
+
+
+def _fields(resource_fields):
+    """Field names selected by the fields argument, by default all of them"""
+    requested = request.args.get('fields')
+    if not requested:
+        return list(resource_fields)
+    names = [name.strip() for name in requested.split(',') if name.strip()]
+    unknown = [name for name in names if name not in resource_fields]
+    if unknown or not names:
+        abort(400, f"Unknown fields: {', '.join(unknown)}; available: {', '.join(resource_fields)}")
+    return names
+
+
+def _load_only(model, resource_fields, names, *always):
+    columns = {column for name in names for column in resource_fields[name][0]} | set(always)
+    return load_only(*(getattr(model, column) for column in columns))
+
+
+def _serialize(obj, resource_fields, names):
+    return {name: resource_fields[name][1](obj) for name in names}
+
+
+def _conditional(compute, extra='', archived=False):
+    """JSON response validated against the newest change the user can see.
+
+    The ETag is weak, as the same data may be sent gzip-compressed or not;
+    an unchanged result is answered with 304 before anything else is queried.
+    With archived, moving the user's expenses to the archives counts as a
+    change too: it drops them from the expense table without logging one.
+    """
+    change_id, changed_at = changes.latest(g.api_user.id)
+    if archived:
+        batch_id, moved_at = archive.latest_batch(g.api_user.id)
+        extra = f'{extra}:{batch_id}'
+        if moved_at is not None and (changed_at is None or moved_at > changed_at):
+            changed_at = moved_at
+    etag = hashlib.sha1(f'{change_id}:{extra}:{request.full_path}'.encode()).hexdigest()
+    if not is_resource_modified(request.environ, etag=etag, last_modified=changed_at):
+        response = Response(status=304)
+    else:
+        response = jsonify(compute())
+    response.set_etag(etag, weak=True)
+    if changed_at is not None:
+        response.last_modified = changed_at
+    return response
+
+
+def _int_arg(name, default, minimum, maximum):
+    value = request.args.get(name, default, type=int)
+    if value is None or not minimum <= value <= maximum:
+        abort(400, f'{name} must be between {minimum} and {maximum}')
+    return value
+
+
+def _date_arg(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        abort(400, f'Invalid {name} date, expected YYYY-MM-DD')
+
+
+def _validation_failed(errors):
+    response = jsonify(error='Validation failed', errors=errors)
+    response.status_code = 422
+    return response
+
+
+def _parse_items(items, parse):
+    """Parse every item of a batch; all of them must be valid"""
+    values, errors = [], []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors.append({'index': index, 'field': None, 'message': 'Must be an object'})
+            continue
+        item_errors = {}
+        value = parse(item, item_errors)
+        errors.extend({'index': index, 'field': field, 'message': message} for field, message in item_errors.items())
+        values.append(value)
+    return values, errors
+
+
+def _amount(item, errors):
+    try:
+        cents = to_minor(str(item.get('amount')))
+    except (InvalidOperation, ValueError, OverflowError):
+        errors['amount'] = 'Must be a decimal number'
+        return None
+    if cents <= 0:
+        errors['amount'] = 'Must be greater than zero'
+    return cents
+
+
+def _category(item, errors, categories):
+    category_id = item.get('category_id')
+    if not isinstance(category_id, int) or isinstance(category_id, bool):
+        errors['category_id'] = 'Must be an integer'
+        return None
+    if category_id not in categories:
+        errors['category_id'] = 'Unknown category'
+    return category_id
+
+
+# Tokens
+
+@api.route('/tokens', methods=['POST'])
+def create_token():
+    """Exchange an email and password for a bearer token"""
+    body = _body()
+    email, password = body.get('email'), body.get('password')
+    if not isinstance(email, str) or not isinstance(password, str):
+        abort(400, 'email and password are required')
+    retry_after = throttle.login_attempt(request.remote_addr, email)
+    if retry_after:
+        response = jsonify(error='Too many attempts')
+        response.status_code = 429
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+    user = User.query.filter_by(email=email).first()
+    if user is None or not hasher.check(user.password, password):
+        abort(401, 'Incorrect email or password')
+    token = secrets.token_urlsafe(32)
+    record = ApiToken(user_id=user.id, name=str(body.get('name') or '')[:100] or None, token_hash=hash_token(token))
+    db.session.add(record)
+    db.session.commit()
+    # The token itself is only ever shown here
+    return jsonify(id=record.id, token=token), 201
+
+
+@api.route('/tokens/current', methods=['DELETE'])
+def revoke_token():
+    """Revoke the token this request was made with"""
+    db.session.execute(delete(ApiToken).where(ApiToken.id == g.api_token_id))
+    db.session.commit()
+    return Response(status=204)
+
+
+# Expenses
+
+@api.route('/expenses', methods=['GET'])
+def list_expenses():
+    """A page of expenses, newest first, filtered by date range and category"""
+    names = _fields(EXPENSE_FIELDS)
+    per_page = _int_arg('per_page', DEFAULT_PER_PAGE, 1, MAX_PER_PAGE)
+    start, end = _date_arg('start'), _date_arg('end')
+    category_id = request.args.get('category', type=int)
+    cursor = request.args.get('cursor')
+
+    def compute():
+        query = Expense.query.filter(Expense.user_id == g.api_user.id).options(
+            _load_only(Expense, EXPENSE_FIELDS, names, 'id', 'date'))
+        if start:
+            query = query.filter(Expense.date >= start)
+        if end:
+            query = query.filter(Expense.date < end + timedelta(days=1))
+        if category_id:
+            query = query.filter(Expense.category_id.in_(refdata.subtree_ids(g.api_user.id, category_id)))
+        try:
+            page = pagination.keyset_paginate(query, Expense, cursor=cursor, per_page=per_page)
+        except ValueError as e:
+            abort(400, str(e))
+        return {
+            'expenses': [_serialize(expense, EXPENSE_FIELDS, names) for expense in page.items],
+            'next_cursor': page.next_cursor,
+            'prev_cursor': page.prev_cursor
+        }
+    return _conditional(compute, archived=True)
+
+
+@api.route('/expenses/<int:expense_id>', methods=['GET'])
+def get_expense(expense_id):
+    names = _fields(EXPENSE_FIELDS)
+
+    def compute():
+        expense = Expense.query.filter_by(id=expense_id, user_id=g.api_user.id).options(
+            _load_only(Expense, EXPENSE_FIELDS, names, 'id')).first()
+        if expense is None:
+            abort(404, 'No such expense')
+        return _serialize(expense, EXPENSE_FIELDS, names)
+    return _conditional(compute, archived=True)
+
+
+@api.route('/expenses', methods=['POST'])
+def create_expenses():
+    """Create a batch of expenses in one transaction; if any is invalid, none are"""
+    items = _batch(_body(), 'expenses')
+    categories = refdata.category_names(g.api_user.id)
+
+    def parse(item, errors):
+        cents = _amount(item, errors)
+        try:
+            date = datetime.strptime(str(item.get('date')), '%Y-%m-%d')
+        except ValueError:
+            errors['date'] = 'Expected YYYY-MM-DD'
+            date = None
+        description = item.get('description')
+        if description is not None and (not isinstance(description, str) or len(description) > 200):
+            errors['description'] = 'Must be text of at most 200 characters'
+        category_id = _category(item, errors, categories)
+        return Expense(amount_cents=cents, currency=DEFAULT_CURRENCY, date=date, description=description,
+                       category_id=category_id, user_id=g.api_user.id)
+
+    expenses, errors = _parse_items(items, parse)
+    if errors:
+        return _validation_failed(errors)
+    db.session.add_all(expenses)
+    db.session.commit()
+    # Same order as the request, so clients can match up the new ids
+    return jsonify(expenses=[_serialize(expense, EXPENSE_FIELDS, EXPENSE_FIELDS) for expense in expenses]), 201
+
+
+@api.route('/expenses', methods=['DELETE'])
+def delete_expenses():
+    """Delete a batch of expenses by id; ids that are not the user's are ignored"""
+    ids = _ids(_body())
+    # An ORM bulk delete, which app.rollup accounts for
+    deleted = db.session.execute(
+        delete(Expense).where(Expense.user_id == g.api_user.id, Expense.id.in_(ids)).returning(Expense.id)
+    ).scalars().all()
+    db.session.commit()
+    return jsonify(deleted=sorted(deleted))
+
+
+# Budgets
+
+@api.route('/budgets', methods=['GET'])
+def list_budgets():
+    """The user's budgets, optionally for one year or month"""
+    names = _fields(BUDGET_FIELDS)
+    year = request.args.get('year', type=int)
+    month = request.args.get('month', type=int)
+
+    def compute():
+        query = Budget.query.filter(Budget.user_id == g.api_user.id).options(
+            _load_only(Budget, BUDGET_FIELDS, names, 'id'))
+        if year:
+            query = query.filter(Budget.year == year)
+        if month:
+            query = query.filter(Budget.month == month)
+        budgets = query.order_by(Budget.year, Budget.month, Budget.category_id)
+        return {'budgets': [_serialize(budget, BUDGET_FIELDS, names) for budget in budgets]}
+    return _conditional(compute)
+
+
+@api.route('/budgets', methods=['PUT'])
+def save_budgets():
+    """Set a batch of budgets, each inserted or updated by (category, year, month)"""
+    items = _batch(_body(), 'budgets')
+    categories = refdata.category_names(g.api_user.id)
+
+    def parse(item, errors):
+        row = {'user_id': g.api_user.id, 'amount_cents': _amount(item, errors), 'currency': DEFAULT_CURRENCY,
+               'category_id': _category(item, errors, categories)}
+        for field, low, high in (('year', 1900, 9999), ('month', 1, 12)):
+            value = item.get(field)
+            if not isinstance(value, int) or not low <= value <= high:
+                errors[field] = f'Must be an integer from {low} to {high}'
+            row[field] = value
+        return row
+
+    rows, errors = _parse_items(items, parse)
+    if errors:
+        return _validation_failed(errors)
+    # The last of any duplicates wins, as it would in separate requests
+    rows = list({(r['category_id'], r['year'], r['month']): r for r in rows}.values())
+    database.upsert(db.session.connection(), Budget.__table__, rows,
+                    ['user_id', 'year', 'month', 'category_id'], ['amount_cents', 'currency'])
+    for year, month in {(r['year'], r['month']) for r in rows}:
+        touch(db.session, g.api_user.id, year, month)
+    db.session.commit()
+    budgets = Budget.query.filter(
+        Budget.user_id == g.api_user.id,
+        tuple_(Budget.category_id, Budget.year, Budget.month).in_(
+            [(r['category_id'], r['year'], r['month']) for r in rows])
+    ).order_by(Budget.year, Budget.month, Budget.category_id)
+    return jsonify(budgets=[_serialize(budget, BUDGET_FIELDS, BUDGET_FIELDS) for budget in budgets])
+
+
+@api.route('/budgets', methods=['DELETE'])
+def delete_budgets():
+    """Delete a batch of budgets by id; ids that are not the user's are ignored"""
+    ids = _ids(_body())
+    deleted = db.session.execute(
+        delete(Budget).where(Budget.user_id == g.api_user.id, Budget.id.in_(ids))
+        .returning(Budget.id, Budget.year, Budget.month)
+    ).all()
+    # Bulk statements bypass the ORM events that invalidate the dashboard
+    for id, year, month in deleted:
+        touch(db.session, g.api_user.id, year, month)
+    db.session.commit()
+    return jsonify(deleted=sorted(id for id, _, _ in deleted))
+
+
+# Categories and summaries
+
+@api.route('/categories', methods=['GET'])
+def list_categories():
+    """The default categories and the user's own, parents before children"""
+    names = _fields(CATEGORY_FIELDS)
+    return _conditional(lambda: {
+        'categories': [_serialize(node, CATEGORY_FIELDS, names) for node in refdata.category_tree(g.api_user.id)]
+    })
+
+
+@api.route('/summary', methods=['GET'])
+def summary():
+    """Budget vs spending for a month (the current one by default), as on the dashboard"""
+    today = datetime.now()
+    year = _int_arg('year', today.year, 1900, 9999)
+    month = _int_arg('month', today.month, 1, 12)
+
+    def compute():
+        result = aggregates.dashboard_summary(g.api_user.id, year, month)
+        return {
+            'year': year,
+            'month': month,
+            'total_spending': result['total_spending'],
+            'total_budget': result['total_budget'],
+            'total_committed': result['total_committed'],
+            'categories': [{
+                'category_id': row['category_id'],
+                'name': row['name'],
+                'depth': row['depth'],
+                'budget': row['budget'],
+                'spending': row['spending'],
+                'committed': row['committed'],
+                'remaining': row['remaining'],
+                'percent_used': round(row['percent_used'], 1),
+                'status': row['status']
+            } for row in result['budget_vs_spending']]
+        }
+    # Recurring expense projections are not in the change log, and the
+    # default month moves with the date
+    return _conditional(compute, extra=f'{data_version(g.api_user.id)}:{today.date()}')
+
+
+# Delta sync
+
+@api.route('/changes', methods=['GET'])
+def list_changes():
+    """Expenses, budgets and categories changed after a cursor.
+
+    Without a cursor only the current cursor is returned: fetch the
+    collections, then poll from it. Each changed row appears once, with its
+    current fields, or as deleted.
+    """
+    if 'cursor' not in request.args:
+        return jsonify(changes=[], cursor=changes.head(), has_more=False)
+    cursor = _int_arg('cursor', None, 0, 2 ** 63 - 1)
+    limit = _int_arg('limit', changes.DEFAULT_LIMIT, 1, MAX_CHANGES)
+    if changes.is_expired(cursor):
+        abort(410, 'Changes after this cursor are no longer kept; sync from scratch')
+
+    changed, next_cursor, has_more = changes.since(g.api_user.id, cursor, limit)
+    current = {}
+    for entity, (model, resource_fields) in RESOURCES.items():
+        ids = [entity_id for kind, entity_id, deleted in changed if kind == entity and not deleted]
+        if ids:
+            owner = model.user_id == g.api_user.id
+            if model is Category:
+                owner = or_(owner, Category.user_id.is_(None))
+            for obj in db.session.scalars(select(model).where(model.id.in_(ids), owner)):
+                current[(entity, obj.id)] = _serialize(obj, resource_fields, resource_fields)
+    items = []
+    for entity, entity_id, deleted in changed:
+        data = None if deleted else current.get((entity, entity_id))
+        # A row gone since is reported as deleted
+        items.append({'type': entity, 'id': entity_id, 'deleted': data is None, 'data': data})
+    return jsonify(changes=items, cursor=next_cursor, has_more=has_more)
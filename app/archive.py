@@ -0,0 +1,301 @@
+"""Archival of old expenses and compaction of the database.
+
+Expenses dated before the horizon (ARCHIVE_AFTER_MONTHS, default 24 months
+before the current month) are moved out of the expense table into one
+SQLite database per year in ARCHIVE_DIR. Their totals stay in the monthly
+rollup, so dashboards and budgets are unchanged. Reports that read raw
+expenses (exports, day and week analytics, the category breakdown, the
+rollup rebuild) run the same query on every archive that overlaps their
+range via results() or rows().
+
+A batch is moved without ever being visible twice:
+
+1. Under the main database's write lock, the rows are copied into the
+   archive's expense_pending table, tagged with the batch id.
+2. The main transaction deletes them from the expense table and marks the
+   ArchiveBatch moved.
+3. The pending rows are promoted into the archive's expense table.
+
+Readers only see the archive's expense table. A crash between steps leaves
+pending rows behind: repair() (run before every batch) promotes those of
+moved batches and drops the rest. Until then the rows of a batch caught
+between steps 2 and 3 are missing from reports; they are never counted
+twice.
+
+Moving rows is not a change users made, so the entries the change log
+triggers write for it are removed in the same transaction, and API clients
+keep their copies. The API's expense reads validate against latest_batch()
+as well, so their ETags still change. Search and the API read the main database only.
+"""
+import os
+from datetime import date, datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import (Column, DateTime, Index, Integer, MetaData, String, Table, create_engine, delete, insert,
+                        select, text)
+from app import db, changes, search
+from app.models import ArchiveBatch, ArchivePartition, ChangeLog, Expense, User
+
+DEFAULT_AFTER_MONTHS = 24
+DEFAULT_BATCH_SIZE = 10000
+
+# The archive's expense table has the main table's name and columns, so any
+# select on Expense runs against it unchanged. Ids are not unique: SQLite may
+# reuse the id of a deleted expense, which can then be archived again.
+_metadata = MetaData()
+
+
+def _expense_columns():
+    return [
+        Column('id', Integer, nullable=False),
+        Column('amount_cents', Integer, nullable=False),
+        Column('currency', String(3), nullable=False),
+        Column('date', DateTime, nullable=False),
+        Column('description', String(200)),
+        Column('user_id', Integer, nullable=False),
+        Column('category_id', Integer, nullable=False),
+        Column('recurring_id', Integer),
+        Column('batch', Integer, nullable=False)
+    ]
+
+
+archived_expense = Table(
+    'expense', _metadata, *_expense_columns(),
+    Index('ix_expense_user_date', 'user_id', 'date'),
+    Index('ix_expense_user_category_date', 'user_id', 'category_id', 'date')
+)
+pending_expense = Table('expense_pending', _metadata, *_expense_columns(), Index('ix_expense_pending_batch', 'batch'))
+# Batches already promoted, so promoting one again does nothing
+promoted_batch = Table('archive_batch', _metadata, Column('batch', Integer, primary_key=True, autoincrement=False))
+
+MOVED_COLUMNS = [c.name for c in archived_expense.columns if c.name != 'batch']
+
+
+def horizon(months=None, today=None):
+    """First day of the month `months` months before the current one; older
+    expenses are archived"""
+    months = current_app.config.get('ARCHIVE_AFTER_MONTHS', DEFAULT_AFTER_MONTHS) if months is None else months
+    today = today or date.today()
+    index = today.year * 12 + today.month - 1 - months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+class Archive:
+    """The archive databases of one app, with an engine per file"""
+
+    def __init__(self, app):
+        self.directory = app.config.setdefault('ARCHIVE_DIR', os.path.join(app.instance_path, 'archive'))
+        self.busy_timeout = (app.config.get('SQLITE_PRAGMAS') or {}).get('busy_timeout', 5000)
+        self._engines = {}
+
+    @staticmethod
+    def filename(year):
+        return f'expenses-{year}.db'
+
+    def engine(self, filename):
+        engine = self._engines.get(filename)
+        if engine is None:
+            os.makedirs(self.directory, exist_ok=True)
+            engine = create_engine(f'sqlite:///{os.path.join(self.directory, filename)}',
+                                   connect_args={'timeout': self.busy_timeout / 1000})
+            _metadata.create_all(engine)
+            engine = self._engines.setdefault(filename, engine)
+        return engine
+
+    def filenames(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.startswith('expenses-') and name.endswith('.db'))
+
+
+def init_app(app):
+    app.extensions['archive'] = Archive(app)
+
+
+def _archive():
+    return current_app.extensions['archive']
+
+
+def partitions(start=None, end=None, connection=None, oldest_first=False):
+    """(year, filename) of the archives overlapping start..end (dates, either
+    may be None), newest first"""
+    year = ArchivePartition.year
+    query = select(year, ArchivePartition.filename).order_by(year if oldest_first else year.desc())
+    if start:
+        query = query.where(year >= start.year)
+    if end:
+        query = query.where(year <= end.year)
+    return (connection or db.session).execute(query).all()
+
+
+def results(statement, start=None, end=None, connection=None, oldest_first=False):
+    """Run a select on Expense against every archive overlapping start..end,
+    yielding a Result for each, newest year first. The statement may only
+    refer to the expense table."""
+    for year, filename in partitions(start, end, connection, oldest_first):
+        with _archive().engine(filename).connect() as archive_connection:
+            yield archive_connection.execute(statement)
+
+
+def rows(statement, start=None, end=None):
+    """Rows of a select on Expense from the expense table, then from every
+    archive overlapping start..end. Aggregates come back per database, for
+    the caller to add up."""
+    yield from db.session.execute(statement)
+    for result in results(statement, start, end):
+        yield from result
+
+
+def latest_batch(user_id):
+    """(id, created_at) of the newest batch of a user's expenses moved to the
+    archives, or (0, None)"""
+    row = db.session.execute(
+        select(ArchiveBatch.id, ArchiveBatch.created_at)
+        .where(ArchiveBatch.user_id == user_id, ArchiveBatch.moved)
+        .order_by(ArchiveBatch.id.desc()).limit(1)
+    ).first()
+    return tuple(row) if row is not None else (0, None)
+
+
+def _promote(engine, batch_ids):
+    with engine.begin() as connection:
+        done = set(connection.execute(select(promoted_batch.c.batch).where(promoted_batch.c.batch.in_(batch_ids))).scalars())
+        for batch_id in set(batch_ids) - done:
+            connection.execute(insert(archived_expense).from_select(
+                [c.name for c in archived_expense.columns],
+                select(*pending_expense.columns).where(pending_expense.c.batch == batch_id)
+            ))
+            connection.execute(insert(promoted_batch).values(batch=batch_id))
+        connection.execute(delete(pending_expense).where(pending_expense.c.batch.in_(batch_ids)))
+
+
+def repair():
+    """Finish or discard what an interrupted run left in the archives. Call
+    with the main database's write lock held, so no run is in progress."""
+    for filename in _archive().filenames():
+        engine = _archive().engine(filename)
+        with engine.connect() as connection:
+            pending = connection.execute(select(pending_expense.c.batch).distinct()).scalars().all()
+        if not pending:
+            continue
+        moved = db.session.execute(
+            select(ArchiveBatch.id).where(ArchiveBatch.id.in_(pending), ArchiveBatch.moved)
+        ).scalars().all()
+        if moved:
+            _promote(engine, moved)
+        with engine.begin() as connection:
+            connection.execute(delete(pending_expense).where(pending_expense.c.batch.in_(pending)))
+
+
+def _lock(batch):
+    # Writing the batch row takes SQLite's write lock for the transaction;
+    # PostgreSQL needs an explicit one
+    db.session.add(batch)
+    db.session.flush()
+    connection = db.session.connection()
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text("SELECT pg_advisory_xact_lock(hashtext('archive'))"))
+
+
+def _move_batch(user_id, before, batch_size):
+    """Move up to batch_size of a user's expenses dated before `before`; returns the number moved"""
+    batch = ArchiveBatch(user_id=user_id)
+    _lock(batch)
+    repair()
+    connection = db.session.connection()
+    rows = connection.execute(
+        select(*(Expense.__table__.c[name] for name in MOVED_COLUMNS))
+        .where(Expense.user_id == user_id, Expense.date < before)
+        .order_by(Expense.date, Expense.id).limit(batch_size)
+    ).mappings().all()
+    if not rows:
+        db.session.rollback()
+        return 0
+
+    by_year = {}
+    for row in rows:
+        by_year.setdefault(row['date'].year, []).append({**row, 'batch': batch.id})
+    for year, year_rows in by_year.items():
+        with _archive().engine(Archive.filename(year)).begin() as archive_connection:
+            archive_connection.execute(insert(pending_expense), year_rows)
+
+    ids = [row['id'] for row in rows]
+    head = changes.head()
+    # Core, so the rollup keeps the totals (its hooks only see ORM statements)
+    connection.execute(delete(Expense.__table__).where(Expense.__table__.c.id.in_(ids)))
+    connection.execute(delete(ChangeLog).where(ChangeLog.id > head, ChangeLog.entity == 'expense',
+                                               ChangeLog.entity_id.in_(ids)))
+    for year, year_rows in by_year.items():
+        partition = db.session.get(ArchivePartition, year)
+        if partition is None:
+            partition = ArchivePartition(year=year, filename=Archive.filename(year), row_count=0)
+            db.session.add(partition)
+        partition.row_count += len(year_rows)
+        partition.updated_at = datetime.utcnow()
+    batch_id = batch.id
+    batch.moved = True
+    batch.row_count = len(rows)
+    db.session.commit()
+
+    for year in by_year:
+        _promote(_archive().engine(Archive.filename(year)), [batch_id])
+    return len(rows)
+
+
+def archive_before(before, batch_size=None):
+    """Move every expense dated before `before` to the archives, a batch per
+    transaction; returns the number moved"""
+    batch_size = batch_size or current_app.config.get('ARCHIVE_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+    moved = 0
+    # Per user, so each batch is a range on the (user_id, date) index
+    for user_id in db.session.execute(select(User.id).order_by(User.id)).scalars().all():
+        while count := _move_batch(user_id, before, batch_size):
+            moved += count
+    return moved
+
+
+def compact():
+    """Reclaim free pages and refresh the planner statistics of the main
+    database, and prune the change log"""
+    days = current_app.config.get('CHANGE_LOG_RETENTION_DAYS', changes.DEFAULT_RETENTION_DAYS)
+    changes.prune(datetime.utcnow() - timedelta(days=days))
+    with db.engine.connect() as connection:
+        search.optimize(connection)
+        connection.commit()
+    # VACUUM cannot run inside a transaction
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        if connection.dialect.name == 'postgresql':
+            connection.execute(text('VACUUM (ANALYZE)'))
+        else:
+            connection.execute(text('VACUUM'))
+            connection.execute(text('ANALYZE'))
+            # Hand the space back from the write-ahead log too (a no-op outside WAL mode)
+            connection.execute(text('PRAGMA wal_checkpoint(TRUNCATE)'))
+    for filename in _archive().filenames():
+        with _archive().engine(filename).connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            connection.execute(text('VACUUM'))
+            connection.execute(text('ANALYZE'))
+
+
+@click.command('archive')
+@click.option('--months', type=int, default=None, help='Archive expenses older than this many months (default ARCHIVE_AFTER_MONTHS).')
+@click.option('--compact/--no-compact', 'compact_after', default=True, help='VACUUM and ANALYZE afterwards (default on).')
+@with_appcontext
+def archive_command(months, compact_after):
+    """Move old expenses to the per-year archives (run from cron)."""
+    before = horizon(months)
+    moved = archive_before(before)
+    click.echo(f'Archived {moved} expenses dated before {before:%Y-%m-%d}.')
+    if compact_after:
+        compact()
+        click.echo('Database compacted.')
+
+
+@click.command('db-compact')
+@with_appcontext
+def compact_command():
+    """VACUUM and ANALYZE the database and its archives."""
+    compact()
+    click.echo('Database compacted.')
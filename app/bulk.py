@@ -0,0 +1,32 @@
+"""Bulk inserts of expenses, for the importer and the recurring scheduler.
+
+Rows go in with a Core executemany, with the search index's and the change
+log's insert triggers dropped around it, so the batch is indexed and logged
+with an INSERT ... SELECT over the new ids instead of row by row. The
+executemany also skips the ORM's per-row bookkeeping, so the rollup is
+updated here rather than by its session hooks.
+"""
+from sqlalchemy import func, select
+from app import db, changes, rollup, search
+from app.models import Expense
+
+
+def insert_expenses(mappings):
+    """Insert expense mappings in the session's transaction, keeping the
+    search index, the change log and the rollup in step; the caller commits"""
+    if not mappings:
+        return
+    connection = db.session.connection()
+    # The rollup goes first: pysqlite only begins a transaction before DML,
+    # and the DDL below must not run outside one. It also takes SQLite's
+    # write lock, so no one else writes while the triggers are gone and the
+    # new rows are exactly those after `after`
+    rollup.apply_deltas(db.session, rollup.deltas_for_mappings(mappings))
+    after = connection.execute(select(func.max(Expense.id))).scalar() or 0
+    search.drop_insert_trigger(connection)
+    changes.drop_insert_trigger(connection)
+    connection.execute(Expense.__table__.insert(), mappings)
+    search.create_insert_trigger(connection)
+    changes.create_insert_trigger(connection)
+    search.index_after(connection, after)
+    changes.log_inserts_after(connection, after)
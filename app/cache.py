@@ -0,0 +1,301 @@
+import hashlib
+import os
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, inspect
+
+DEFAULT_TIMEOUT = 300
+DEFAULT_MAX_ENTRIES = 1024
+
+
+class LRUBackend:
+    """In-process least-recently-used cache with a per-entry TTL"""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._entries = OrderedDict() # key -> (expires, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                self.evictions += 1
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, value, timeout):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + timeout, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class FileSystemBackend:
+    """Pickled entries in a directory, shared by all workers on a host"""
+
+    def __init__(self, directory, max_entries=DEFAULT_MAX_ENTRIES):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + '.cache')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                expires, value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires < time.time():
+            self._remove(path)
+            self.evictions += 1
+            return None
+        return (expires, value)
+
+    def set(self, key, value, timeout):
+        path = self._path(key)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump((time.time() + timeout, value), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path) # Atomic, so readers never see a partial entry
+        self._prune()
+
+    def _prune(self):
+        entries = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                   if name.endswith('.cache')]
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort(key=lambda path: os.path.getmtime(path) if os.path.exists(path) else 0)
+        for path in entries[:len(entries) - self.max_entries]:
+            self._remove(path)
+            self.evictions += 1
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def delete(self, key):
+        self._remove(self._path(key))
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith('.cache'):
+                self._remove(os.path.join(self.directory, name))
+
+    def __len__(self):
+        return sum(1 for name in os.listdir(self.directory) if name.endswith('.cache'))
+
+
+class RedisBackend:
+    """Entries in a Redis-compatible server; expiry and eviction are left to the server"""
+
+    def __init__(self, url, prefix='expense-tracker:'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("CACHE_TYPE 'redis' needs the redis package: pip install redis")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.evictions = 0
+
+    def get(self, key):
+        data = self.client.get(self.prefix + key)
+        return None if data is None else (None, pickle.loads(data))
+
+    def set(self, key, value, timeout):
+        self.client.setex(self.prefix + key, int(timeout), pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+    def __len__(self):
+        return sum(1 for _ in self.client.scan_iter(self.prefix + '*'))
+
+
+class NullBackend:
+    evictions = 0
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, timeout):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+    def __len__(self):
+        return 0
+
+
+class Cache:
+    """Pluggable result cache, configured by CACHE_TYPE:
+
+    - 'lru' (default): in-process LRU with TTL, sized by CACHE_MAX_ENTRIES
+    - 'filesystem': shared by workers on one host, in CACHE_DIR
+    - 'redis': a Redis-compatible server at CACHE_REDIS_URL
+    - 'null': no caching
+    """
+
+    def __init__(self):
+        self.backend = NullBackend()
+        self.default_timeout = DEFAULT_TIMEOUT
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def init_app(self, app):
+        config = app.config
+        cache_type = config.setdefault('CACHE_TYPE', 'lru')
+        max_entries = config.setdefault('CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES)
+        self.default_timeout = config.setdefault('CACHE_DEFAULT_TIMEOUT', DEFAULT_TIMEOUT)
+        if cache_type == 'lru':
+            self.backend = LRUBackend(max_entries)
+        elif cache_type == 'filesystem':
+            directory = config.get('CACHE_DIR') or os.path.join(app.instance_path, 'cache')
+            self.backend = FileSystemBackend(directory, max_entries)
+        elif cache_type == 'redis':
+            self.backend = RedisBackend(config.get('CACHE_REDIS_URL', 'redis://localhost:6379/0'))
+        elif cache_type == 'null':
+            self.backend = NullBackend()
+        else:
+            raise ValueError(f'Unknown CACHE_TYPE: {cache_type}')
+        self.hits = self.misses = self.invalidations = 0
+
+    def get_or_set(self, key, compute, timeout=None):
+        entry = self.backend.get(key)
+        if entry is not None:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        value = compute()
+        self.backend.set(key, value, timeout or self.default_timeout)
+        return value
+
+    def delete(self, key):
+        self.invalidations += 1
+        self.backend.delete(key)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        return {
+            'backend': type(self.backend).__name__,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.backend.evictions,
+            'invalidations': self.invalidations,
+            'entries': len(self.backend)
+        }
+
+
+cache = Cache()
+
+
+def dashboard_key(user_id, year, month):
+    return f'dashboard:{user_id}:{year}:{month}'
+
+
+# Per-user token replaced on every committed expense or budget write, for
+# ETags that can be checked without querying. Like the category version it
+# goes straight to the backend; if it is evicted a new one is made, which
+# only costs clients one full response.
+DATA_VERSION_TIMEOUT = 24 * 60 * 60
+
+
+def _data_version_key(user_id):
+    return f'data-version:{user_id}'
+
+
+def bump_data_version(user_id):
+    version = uuid.uuid4().hex
+    cache.backend.set(_data_version_key(user_id), version, DATA_VERSION_TIMEOUT)
+    return version
+
+
+def data_version(user_id):
+    entry = cache.backend.get(_data_version_key(user_id))
+    return entry[1] if entry is not None else bump_data_version(user_id)
+
+
+# Write-through invalidation. Writes record the (user_id, year, month) periods
+# they touch on the session, and the cached results are dropped once the
+# transaction commits - invalidating earlier would let a concurrent request
+# re-cache the pre-commit data.
+
+def touch(session, user_id, year, month):
+    session.info.setdefault('touched_periods', set()).add((user_id, year, month))
+
+
+def _budget_periods(budget, committed):
+    state = inspect(budget)
+    values = {}
+    for attr in ('user_id', 'year', 'month'):
+        history = state.attrs[attr].history
+        if committed and (history.deleted or history.unchanged):
+            values[attr] = (history.deleted or history.unchanged)[0]
+        else:
+            values[attr] = getattr(budget, attr)
+    return values['user_id'], values['year'], values['month']
+
+
+@event.listens_for(Session, 'after_flush')
+def _record_budget_writes(session, flush_context):
+    # Expense writes are recorded by app.rollup along with the rollup deltas
+    from app.models import Budget
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, Budget):
+            touch(session, *_budget_periods(obj, committed=False))
+            touch(session, *_budget_periods(obj, committed=True))
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_touched(session):
+    touched = session.info.pop('touched_periods', ())
+    for user_id, year, month in touched:
+        cache.delete(dashboard_key(user_id, year, month))
+    for user_id in {user_id for user_id, year, month in touched}:
+        bump_data_version(user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_touched(session):
+    session.info.pop('touched_periods', None)
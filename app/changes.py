@@ -0,0 +1,191 @@
+"""Change log for the API's delta sync.
+
+Triggers on the expense, budget and category tables append a row to
+change_log for every insert, update and delete, whatever made it: the ORM,
+the importer's Core executemany, the budget upserts or the recurring
+scheduler. Bulk inserts of expenses (app.bulk) drop the insert trigger
+for the length of their transaction and log a whole batch with one
+INSERT ... SELECT instead. A client
+keeps the id of the last change it has seen as its cursor and asks for what
+changed after it.
+
+Ids are only useful as cursors if they become visible in order. SQLite has a
+single writer; on PostgreSQL the trigger takes a transaction-level advisory
+lock, so transactions that write tracked rows commit in the order of their
+change ids. Old entries are pruned with `flask changes-prune`; a client whose
+cursor is older than that has to sync from scratch.
+"""
+from datetime import datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import delete, event, false, func, insert, literal, literal_column, select, text, or_
+from app import db
+from app.models import ChangeLog, Expense
+
+TABLES = ('expense', 'budget', 'category')
+# Changes returned per request, and kept for this many days
+DEFAULT_LIMIT = 500
+DEFAULT_RETENTION_DAYS = 90
+
+
+def _sqlite_ddl(table):
+    ddl = []
+    for event_name, row, deleted in (('insert', 'new', 0), ('update', 'new', 0), ('delete', 'old', 1)):
+        ddl.append(f"""CREATE TRIGGER IF NOT EXISTS change_log_{table}_{event_name} AFTER {event_name.upper()} ON {table} BEGIN
+            INSERT INTO change_log (user_id, entity, entity_id, deleted, changed_at)
+            VALUES ({row}.user_id, '{table}', {row}.id, {deleted}, CURRENT_TIMESTAMP);
+        END""")
+    return ddl
+
+
+_POSTGRESQL_FUNCTION = """CREATE OR REPLACE FUNCTION change_log_record() RETURNS trigger AS $$
+BEGIN
+    -- Set for its transaction by a bulk insert, which logs the rows itself
+    IF TG_OP = 'INSERT' AND TG_TABLE_NAME = 'expense' AND current_setting('change_log.skip_expense_inserts', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+    -- Held until commit, so change ids become visible in order
+    PERFORM pg_advisory_xact_lock(hashtext('change_log'));
+    IF TG_OP = 'DELETE' THEN
+        INSERT INTO change_log (user_id, entity, entity_id, deleted, changed_at)
+        VALUES (OLD.user_id, TG_TABLE_NAME, OLD.id, true, clock_timestamp() AT TIME ZONE 'UTC');
+    ELSE
+        INSERT INTO change_log (user_id, entity, entity_id, deleted, changed_at)
+        VALUES (NEW.user_id, TG_TABLE_NAME, NEW.id, false, clock_timestamp() AT TIME ZONE 'UTC');
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql"""
+
+
+def install(connection):
+    """Create the change log triggers (idempotent)"""
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text(_POSTGRESQL_FUNCTION))
+        for table in TABLES:
+            connection.execute(text(f'DROP TRIGGER IF EXISTS change_log_{table} ON {table}'))
+            connection.execute(text(
+                f'CREATE TRIGGER change_log_{table} AFTER INSERT OR UPDATE OR DELETE ON {table} '
+                f'FOR EACH ROW EXECUTE FUNCTION change_log_record()'
+            ))
+    else:
+        for table in TABLES:
+            for statement in _sqlite_ddl(table):
+                connection.execute(text(statement))
+
+
+def _skip_expense_inserts(connection, skip):
+    connection.execute(text("SELECT set_config('change_log.skip_expense_inserts', :value, true)"),
+                       {'value': 'on' if skip else 'off'})
+
+
+def drop_insert_trigger(connection):
+    """Stop logging expense inserts until create_insert_trigger(). Only
+    within a transaction that holds the write lock. PostgreSQL's trigger
+    covers every operation, so there it is told to skip expense inserts for
+    the transaction instead; dropping it would lock the table."""
+    if connection.dialect.name == 'postgresql':
+        _skip_expense_inserts(connection, True)
+    else:
+        connection.execute(text('DROP TRIGGER IF EXISTS change_log_expense_insert'))
+
+
+def create_insert_trigger(connection):
+    if connection.dialect.name == 'postgresql':
+        _skip_expense_inserts(connection, False)
+    else:
+        connection.execute(text(_sqlite_ddl('expense')[0]))
+
+
+def log_inserts_after(connection, after):
+    """Log the expenses with ids above `after` as inserted, for bulk inserts
+    made with the insert trigger dropped"""
+    if connection.dialect.name == 'postgresql':
+        # As the trigger does. Rows other transactions committed meanwhile
+        # may be logged a second time, which since() collapses
+        connection.execute(text("SELECT pg_advisory_xact_lock(hashtext('change_log'))"))
+        changed_at = "clock_timestamp() AT TIME ZONE 'UTC'"
+    else:
+        changed_at = 'CURRENT_TIMESTAMP'
+    connection.execute(insert(ChangeLog).from_select(
+        ['user_id', 'entity', 'entity_id', 'deleted', 'changed_at'],
+        select(Expense.user_id, literal('expense'), Expense.id, false(), literal_column(changed_at))
+        .where(Expense.id > after).order_by(Expense.id)
+    ))
+
+
+@event.listens_for(db.metadata, 'after_create')
+def _create_triggers(target, connection, tables=(), **kw):
+    # Only for a new database: existing ones get the triggers from a
+    # migration, after the earlier migrations have rewritten their rows
+    if Expense.__table__ in tables:
+        install(connection)
+
+
+def _visible_to(user_id):
+    # The shared default categories are logged without an owner
+    return or_(ChangeLog.user_id == user_id, ChangeLog.user_id.is_(None))
+
+
+def latest(user_id):
+    """(id, changed_at) of the newest change visible to a user, or (0, None).
+
+    Two seeks on (user_id, id) rather than one OR query, which would have to
+    sort every change the user has.
+    """
+    newest = (0, None)
+    for condition in (ChangeLog.user_id == user_id, ChangeLog.user_id.is_(None)):
+        row = db.session.execute(
+            select(ChangeLog.id, ChangeLog.changed_at).where(condition).order_by(ChangeLog.id.desc()).limit(1)
+        ).first()
+        if row is not None and row[0] > newest[0]:
+            newest = tuple(row)
+    return newest
+
+
+def head():
+    """Id of the newest change of anyone; the cursor to start syncing from"""
+    return db.session.execute(select(func.max(ChangeLog.id))).scalar() or 0
+
+
+def is_expired(cursor):
+    """Whether changes after cursor may have been pruned"""
+    oldest = db.session.execute(select(func.min(ChangeLog.id))).scalar()
+    return oldest is not None and cursor < oldest - 1
+
+
+def since(user_id, cursor, limit=DEFAULT_LIMIT):
+    """Changes visible to a user after cursor, oldest first, collapsed to the
+    last change of each row. Returns (changes, next_cursor, has_more), where
+    changes are (entity, entity_id, deleted) tuples."""
+    rows = db.session.execute(
+        select(ChangeLog.id, ChangeLog.entity, ChangeLog.entity_id, ChangeLog.deleted)
+        .where(ChangeLog.id > cursor, _visible_to(user_id))
+        .order_by(ChangeLog.id).limit(limit + 1)
+    ).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    latest_change = {}
+    for id, entity, entity_id, deleted in rows:
+        latest_change.pop((entity, entity_id), None) # Re-inserted, so it sorts by its last change
+        latest_change[(entity, entity_id)] = bool(deleted)
+    changes = [(entity, entity_id, deleted) for (entity, entity_id), deleted in latest_change.items()]
+    return changes, rows[-1][0] if rows else cursor, has_more
+
+
+def prune(before):
+    """Delete changes made before a datetime; returns the number deleted"""
+    result = db.session.execute(delete(ChangeLog).where(ChangeLog.changed_at < before))
+    db.session.commit()
+    return result.rowcount
+
+
+@click.command('changes-prune')
+@click.option('--days', type=int, default=None, help='Keep this many days of changes (default CHANGE_LOG_RETENTION_DAYS).')
+@with_appcontext
+def prune_command(days):
+    """Delete old change log entries (run from cron)."""
+    days = days if days is not None else current_app.config.get('CHANGE_LOG_RETENTION_DAYS', DEFAULT_RETENTION_DAYS)
+    deleted = prune(datetime.utcnow() - timedelta(days=days))
+    click.echo(f'Deleted {deleted} change log entries.')
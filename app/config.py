@@ -0,0 +1,76 @@
+import os
+
+
+def _database_url():
+    # PostgreSQL (or any SQLAlchemy URL) can be selected with DATABASE_URL;
+    # hosting platforms often still hand out the old postgres:// scheme
+    url = os.environ.get('DATABASE_URL')
+    if url and url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+
+class Config:
+    APP_ENV = 'development'
+    SECRET_KEY = os.environ.get('SECRET_KEY', '5791628bb0b13ce0c676dfde280ba245') # Change this in production!
+    SQLALCHEMY_DATABASE_URI = _database_url() or 'sqlite:///site.db'
+    EXPENSES_PER_PAGE = 5
+    # Seconds load_user may trust the user snapshot in the session cookie (0 disables it)
+    USER_SNAPSHOT_TTL = 60
+    # Login and registration attempts allowed per window (0 disables a limit)
+    LOGIN_ATTEMPT_WINDOW = 60
+    LOGIN_ATTEMPTS_PER_IP = 20
+    LOGIN_ATTEMPTS_PER_EMAIL = 5
+    REGISTRATIONS_PER_IP = 10
+    # Seconds between runs of the in-process recurring expense scheduler;
+    # 0 leaves it to cron (flask recurring-run)
+    RECURRING_INTERVAL = 0
+    # Expenses older than this many months are moved to the archives by
+    # flask archive (their totals stay on the dashboards)
+    ARCHIVE_AFTER_MONTHS = 24
+    # PRAGMAs run on every new SQLite connection
+    SQLITE_PRAGMAS = {
+        'busy_timeout': 5000 # ms to wait for a lock instead of failing with "database is locked"
+    }
+
+
+class DevelopmentConfig(Config):
+    pass
+
+
+class ProductionConfig(Config):
+    APP_ENV = 'production'
+    SECRET_KEY = os.environ.get('SECRET_KEY')
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL', # Readers no longer block on a writer (and vice versa)
+        'synchronous': 'NORMAL', # Safe with WAL; skips an fsync per commit
+        'busy_timeout': 5000,
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64 * 1024, # 64 MiB of page cache per connection
+        'temp_store': 'MEMORY'
+    }
+    # Pool sized for the threads of one worker process
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 8)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 8)),
+        'pool_timeout': 30,
+        'pool_pre_ping': True
+    }
+    # Shared by all worker processes, so a write in one invalidates the others
+    CACHE_TYPE = 'filesystem'
+    # gunicorn already runs several workers per core; one hashing process each
+    PASSWORD_HASH_WORKERS = 1
+    RECURRING_INTERVAL = 15 * 60
+
+
+CONFIGS = {
+    'development': DevelopmentConfig,
+    'production': ProductionConfig
+}
+
+
+def config_for(name):
+    try:
+        return CONFIGS[name]
+    except KeyError:
+        raise ValueError(f"Unknown APP_ENV '{name}', expected one of: {', '.join(CONFIGS)}")
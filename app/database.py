@@ -0,0 +1,68 @@
+from flask_sqlalchemy.session import Session as BaseSession
+from sqlalchemy import event, insert, inspect, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+# Models whose writes must go through ORM statements, so the do_orm_execute
+# and flush hooks that keep derived data in step (app.rollup) see them
+STATEMENT_ONLY = set()
+
+
+def _statement_only(mapper):
+    return inspect(mapper).class_ in STATEMENT_ONLY
+
+
+class Session(BaseSession):
+    """db.session's class.
+
+    The legacy bulk_* methods write without firing the session events. For
+    the models in STATEMENT_ONLY, bulk_insert_mappings and bulk_update_mappings
+    run as the equivalent ORM bulk INSERT and UPDATE statements instead, and
+    bulk_save_objects refuses them.
+    """
+
+    def bulk_insert_mappings(self, mapper, mappings, return_defaults=False, render_nulls=False):
+        if not _statement_only(mapper):
+            return super().bulk_insert_mappings(mapper, mappings, return_defaults, render_nulls)
+        if return_defaults:
+            raise ValueError('return_defaults is not supported here; use insert().returning()')
+        mappings = list(mappings)
+        if mappings:
+            self.execute(insert(mapper), mappings)
+
+    def bulk_update_mappings(self, mapper, mappings):
+        if not _statement_only(mapper):
+            return super().bulk_update_mappings(mapper, mappings)
+        mappings = list(mappings)
+        if mappings:
+            self.execute(update(mapper), mappings)
+
+    def bulk_save_objects(self, objects, *args, **kwargs):
+        objects = list(objects)
+        if any(type(obj) in STATEMENT_ONLY for obj in objects):
+            raise TypeError('bulk_save_objects bypasses the session events; use add_all() or insert()')
+        return super().bulk_save_objects(objects, *args, **kwargs)
+
+
+def init_engine(app, engine):
+    """Apply the configured SQLITE_PRAGMAS to every connection the engine opens"""
+    pragmas = app.config.get('SQLITE_PRAGMAS') or {}
+    if engine.dialect.name != 'sqlite' or not pragmas:
+        return
+
+    @event.listens_for(engine, 'connect')
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+        cursor.close()
+
+
+def upsert(connection, table, rows, index_elements, update_columns):
+    """INSERT rows, updating update_columns of any row that conflicts on the
+    unique index over index_elements, as one atomic statement (no
+    check-then-insert race). SQLite and PostgreSQL only."""
+    insert_fn = postgresql.insert if connection.dialect.name == 'postgresql' else sqlite.insert
+    stmt = insert_fn(table)
+    stmt = stmt.on_conflict_do_update(index_elements=index_elements,
+                                      set_={column: stmt.excluded[column] for column in update_columns})
+    return connection.execute(stmt, rows)
@@ -0,0 +1,135 @@
+import csv
+import heapq
+import itertools
+import re
+import zlib
+from datetime import timedelta
+from io import StringIO
+from sqlalchemy import select
+from app import db, aggregates, archive, refdata
+from app.models import Expense
+from app.money import from_minor
+
+EXPENSE_HEADERS = ['Date', 'Category', 'Description', 'Amount']
+BUDGET_HEADERS = ['Category', 'Budget', 'Spending', 'Remaining', 'Percent Used', 'Status']
+
+# Rows fetched from the cursor per round trip, and rows per CSV chunk sent
+BATCH_SIZE = 1000
+
+
+def expense_rows(user_id, start=None, end=None, category_id=None, batch_size=BATCH_SIZE):
+    """Yield CSV rows for a user's expenses, newest first.
+
+    start and end are inclusive dates; a category includes its subcategories. Rows are read from a server-side
+    cursor in batches and category names are resolved from a lookup built
+    once up front, so memory use does not depend on the number of expenses.
+    Archived expenses are merged in by date from the archives that overlap
+    the range.
+    """
+    categories = refdata.category_names(user_id)
+
+    query = select(
+        Expense.date, Expense.id, Expense.category_id, Expense.description, Expense.amount_cents, Expense.currency
+    ).where(Expense.user_id == user_id)
+    if start:
+        query = query.where(Expense.date >= start)
+    if end:
+        query = query.where(Expense.date < end + timedelta(days=1))
+    if category_id:
+        query = query.where(Expense.category_id.in_(refdata.subtree_ids(user_id, category_id)))
+    query = query.order_by(Expense.date.desc(), Expense.id.desc()).execution_options(
+        stream_results=True, yield_per=batch_size
+    )
+
+    # The archives hold a year each, so read newest first they are in order too
+    archived = itertools.chain.from_iterable(archive.results(query, start, end))
+    merged = heapq.merge(db.session.execute(query), archived, key=lambda row: (row.date, row.id), reverse=True)
+    for date, _, category_id, description, amount_cents, currency in merged:
+        yield [
+            date.strftime('%Y-%m-%d'),
+            categories.get(category_id, ''),
+            description or '',
+            from_minor(amount_cents, currency)
+        ]
+
+
+def budget_spending_rows(user_id, year, month):
+    """Yield rows of the budget vs spending report for a month"""
+    for row in aggregates.budget_vs_spending(user_id, year, month):
+        yield [
+            row['category'],
+            row['budget'],
+            row['spending'],
+            row['remaining'],
+            f"{row['percent_used']:.1f}%",
+            row['status']
+        ]
+
+
+def csv_chunks(rows, headers=EXPENSE_HEADERS, chunk_rows=BATCH_SIZE):
+    """Encode rows as CSV, yielding a chunk of text every chunk_rows rows"""
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(headers)
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % chunk_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def gzip_chunks(chunks, encoding='utf-8'):
+    """Gzip-compress a stream of text chunks"""
+    compressor = zlib.compressobj(wbits=31) # 31 selects the gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode(encoding))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# File writers used by background report jobs (app.jobs). XLSX and PDF need
+# optional packages, so they are imported on use.
+
+def write_csv(path, headers, rows, title=None):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        for chunk in csv_chunks(rows, headers):
+            f.write(chunk)
+
+
+def write_xlsx(path, headers, rows, title='Report'):
+    try:
+        from openpyxl import Workbook
+    except ImportError:
+        raise RuntimeError('XLSX reports need the openpyxl package: pip install openpyxl')
+    # Write-only mode streams rows to the file instead of holding every cell
+    workbook = Workbook(write_only=True)
+    # Excel's sheet names are limited to 31 characters, without []:*?/\
+    sheet = workbook.create_sheet(re.sub(r'[\[\]:*?/\\]', '-', title)[:31])
+    sheet.append(headers)
+    for row in rows:
+        sheet.append(row)
+    workbook.save(path)
+
+
+def write_pdf(path, headers, rows, title='Report'):
+    try:
+        from reportlab.lib import colors
+        from reportlab.lib.pagesizes import A4
+        from reportlab.lib.styles import getSampleStyleSheet
+        from reportlab.platypus import SimpleDocTemplate, Paragraph, Table, TableStyle
+    except ImportError:
+        raise RuntimeError('PDF reports need the reportlab package: pip install reportlab')
+    table = Table([headers] + [[str(value) for value in row] for row in rows], repeatRows=1)
+    table.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), colors.lightgrey),
+        ('GRID', (0, 0), (-1, -1), 0.25, colors.grey),
+        ('ALIGN', (1, 1), (-1, -1), 'RIGHT')
+    ]))
+    SimpleDocTemplate(path, pagesize=A4, title=title).build(
+        [Paragraph(title, getSampleStyleSheet()['Title']), table])
+
+
+WRITERS = {'csv': write_csv, 'xlsx': write_xlsx, 'pdf': write_pdf}
@@ -1,6 +1,10 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, SubmitField, BooleanField, FloatField, SelectField, DateField
-from wtforms.validators import DataRequired, Length, Email, EqualTo, ValidationError
+from flask_wtf.file import FileField, FileRequired, FileAllowed
+from wtforms import (StringField, PasswordField, SubmitField, BooleanField, DecimalField, SelectField, DateField,
+                     IntegerField, SelectMultipleField)
+from wtforms.validators import DataRequired, Length, Email, EqualTo, ValidationError, Optional, NumberRange
+from app.jobs import REPORTS
+from app.recurring import FREQUENCIES
 from app.models import User
 from datetime import datetime
 
@@ -32,15 +36,86 @@ class LoginForm(FlaskForm):
     submit = SubmitField('Login')
 
 class ExpenseForm(FlaskForm):
-    amount = FloatField('Amount', validators=[DataRequired()])
+    amount = DecimalField('Amount', places=2, validators=[DataRequired()])
     category = SelectField('Category', coerce=int, validators=[DataRequired()])
     description = StringField('Description')
     date = DateField('Date', format='%Y-%m-%d', validators=[DataRequired()])
     submit = SubmitField('Add Expense')
 
 class BudgetForm(FlaskForm):
-    amount = FloatField('Amount', validators=[DataRequired()])
+    amount = DecimalField('Amount', places=2, validators=[DataRequired()])
     category = SelectField('Category', coerce=int, validators=[DataRequired()])
     month = SelectField('Month', coerce=int, choices=[(i, i) for i in range(1, 13)], validators=[DataRequired()])
     year = SelectField('Year', coerce=int, choices=[(i, i) for i in range(2023, 2030)], validators=[DataRequired()])
     submit = SubmitField('Set Budget')
+
+class RecurringExpenseForm(FlaskForm):
+    amount = DecimalField('Amount', places=2, validators=[DataRequired()])
+    category = SelectField('Category', coerce=int, validators=[DataRequired()])
+    description = StringField('Description', validators=[Length(max=200)])
+    frequency = SelectField('Repeats', choices=[(f, f.capitalize()) for f in FREQUENCIES])
+    interval = IntegerField('Every', default=1, validators=[DataRequired(), NumberRange(min=1, max=366)])
+    start_date = DateField('First date', format='%Y-%m-%d', validators=[DataRequired()])
+    end_date = DateField('Until', format='%Y-%m-%d', validators=[Optional()])
+    submit = SubmitField('Add Recurring Expense')
+
+    def validate_end_date(self, end_date):
+        if end_date.data and self.start_date.data and end_date.data < self.start_date.data:
+            raise ValidationError('The end date must not be before the first date.')
+
+class CategoryForm(FlaskForm):
+    name = StringField('Name', validators=[DataRequired(), Length(max=100)])
+    parent = SelectField('Inside', coerce=int, validators=[Optional()])
+    submit = SubmitField('Add Category')
+
+class GroupForm(FlaskForm):
+    name = StringField('Name', validators=[DataRequired(), Length(max=100)])
+    submit = SubmitField('Create Group')
+
+class GroupMemberForm(FlaskForm):
+    email = StringField('Email', validators=[DataRequired(), Email()])
+    role = SelectField('Role', choices=[('member', 'Member'), ('viewer', 'Viewer'), ('owner', 'Owner')])
+    submit = SubmitField('Add Member')
+
+class SharedExpenseForm(FlaskForm):
+    amount = DecimalField('Amount', places=2, validators=[DataRequired(), NumberRange(min=0.01)])
+    category = SelectField('Category', coerce=int, validators=[DataRequired()])
+    description = StringField('Description', validators=[DataRequired(), Length(max=200)])
+    date = DateField('Date', format='%Y-%m-%d', validators=[DataRequired()])
+    paid_by = SelectField('Paid by', coerce=int, validators=[DataRequired()])
+    # Split equally between the selected members
+    split_between = SelectMultipleField('Split between', coerce=int, validators=[DataRequired()])
+    submit = SubmitField('Add Shared Expense')
+
+class ImportForm(FlaskForm):
+    file = FileField('CSV or OFX file', validators=[FileRequired(), FileAllowed(['csv', 'ofx', 'qfx'], 'CSV or OFX files only')])
+    submit = SubmitField('Import')
+
+class ReportJobForm(FlaskForm):
+    kind = SelectField('Report', choices=[('expenses', 'Expenses'), ('budget_spending', 'Budget vs Spending')])
+    format = SelectField('Format', choices=[('csv', 'CSV'), ('xlsx', 'Excel (XLSX)'), ('pdf', 'PDF summary')])
+    # Expenses report filters
+    start = DateField('From', format='%Y-%m-%d', validators=[Optional()])
+    end = DateField('To', format='%Y-%m-%d', validators=[Optional()])
+    category = IntegerField('Category', validators=[Optional()])
+    # Budget vs spending period, the current month by default
+    month = IntegerField('Month', validators=[Optional(), NumberRange(min=1, max=12)])
+    year = IntegerField('Year', validators=[Optional(), NumberRange(min=1900, max=9999)])
+    submit = SubmitField('Generate')
+
+    def validate_format(self, format):
+        if format.data not in REPORTS.get(self.kind.data, ()):
+            raise ValidationError(f'{self.kind.data} reports are not available as {format.data}.')
+
+class SearchForm(FlaskForm):
+    # Submitted by GET, so results pages can be linked and bookmarked
+    class Meta:
+        csrf = False
+
+    q = StringField('Search', validators=[Optional(), Length(max=200)])
+    category = SelectField('Category', coerce=int, validators=[Optional()])
+    start = DateField('From', format='%Y-%m-%d', validators=[Optional()])
+    end = DateField('To', format='%Y-%m-%d', validators=[Optional()])
+    min_amount = DecimalField('Min amount', places=2, validators=[Optional()])
+    max_amount = DecimalField('Max amount', places=2, validators=[Optional()])
+    submit = SubmitField('Search')
@@ -0,0 +1,208 @@
+"""Shared ledgers.
+
+A Group has members with a role: owners manage the membership, members
+record shared expenses and set the group's budgets, viewers only look.
+A shared expense is paid by one member and split between several; the
+splits always add up to the amount exactly. Balances are what a member paid
+minus what they owe.
+
+The group dashboard (budget vs spending per category for a month, plus
+every member's balance) is one UNION ALL query over indexed group columns,
+so its cost does not grow with the number of members. It is cached under a
+per-group version token that any write to the group replaces, like the
+category tree in app.refdata.
+"""
+import uuid
+from collections import namedtuple
+from datetime import datetime
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, func, literal, select, union_all
+from app import db, database, refdata
+from app.aggregates import in_month, budget_row
+from app.cache import cache
+from app.models import User, Group, GroupMember, SharedExpense, ExpenseSplit, GroupBudget
+from app.money import from_minor, to_minor, DEFAULT_CURRENCY
+
+ROLES = ('owner', 'member', 'viewer')
+WRITE_ROLES = ('owner', 'member')
+VERSION_TIMEOUT = 24 * 60 * 60
+
+Balance = namedtuple('Balance', ['user_id', 'username', 'paid', 'owed', 'balance'])
+
+
+def create(user_id, name):
+    group = Group(name=name, created_by=user_id)
+    db.session.add(group)
+    db.session.flush()
+    db.session.add(GroupMember(group_id=group.id, user_id=user_id, role='owner'))
+    db.session.commit()
+    return group
+
+
+def membership(group_id, user_id):
+    return GroupMember.query.filter_by(group_id=group_id, user_id=user_id).first()
+
+
+def user_groups(user_id):
+    """(group, role) pairs of the groups a user belongs to"""
+    return db.session.query(Group, GroupMember.role).join(
+        GroupMember, GroupMember.group_id == Group.id
+    ).filter(GroupMember.user_id == user_id).order_by(Group.name).all()
+
+
+def members(group_id):
+    """(user_id, username, role) of every member, by username"""
+    return db.session.query(User.id, User.username, GroupMember.role).join(
+        GroupMember, GroupMember.user_id == User.id
+    ).filter(GroupMember.group_id == group_id).order_by(User.username).all()
+
+
+def set_member(group_id, user_id, role):
+    """Add a member, or change the role of an existing one, atomically.
+    Raises ValueError rather than leave the group without an owner."""
+    if role not in ROLES:
+        raise ValueError(f'Unknown role: {role}')
+    # Locks the group on PostgreSQL (SQLite has a single writer anyway), so
+    # two owners demoting each other cannot both succeed
+    db.session.execute(select(Group.id).where(Group.id == group_id).with_for_update())
+    database.upsert(db.session.connection(), GroupMember.__table__,
+                    [{'group_id': group_id, 'user_id': user_id, 'role': role, 'joined_at': datetime.utcnow()}],
+                    ['group_id', 'user_id'], ['role'])
+    if role != 'owner' and _owner_count(group_id) == 0:
+        db.session.rollback()
+        raise ValueError('A group must keep at least one owner')
+    _changed(db.session, group_id)
+    db.session.commit()
+
+
+def _owner_count(group_id):
+    return db.session.execute(select(func.count()).select_from(GroupMember).where(
+        GroupMember.group_id == group_id, GroupMember.role == 'owner')).scalar()
+
+
+def split_cents(total, weights):
+    """Split total cents in proportion to weights ({user_id: weight}). Leftover
+    cents go to the largest remainders (then lowest user ids), so the shares
+    always add up to total exactly."""
+    weight_sum = sum(weights.values())
+    if weight_sum <= 0:
+        raise ValueError('Split weights must add up to more than zero')
+    shares, remainders = {}, []
+    for user_id, weight in weights.items():
+        shares[user_id], remainder = divmod(total * weight, weight_sum)
+        remainders.append((-remainder, user_id))
+    for _, user_id in sorted(remainders)[:total - sum(shares.values())]:
+        shares[user_id] += 1
+    return shares
+
+
+def add_expense(group_id, paid_by, amount, description, date=None, category_id=None, weights=None):
+    """Record a shared expense split between members, equally unless weights
+    ({user_id: weight}) are given"""
+    if weights is None:
+        weights = {user_id: 1 for user_id, _, _ in members(group_id)}
+    expense = SharedExpense(group_id=group_id, paid_by=paid_by, amount=amount, description=description,
+                            date=date or datetime.utcnow(), category_id=category_id)
+    expense.splits = [ExpenseSplit(user_id=user_id, owed_cents=cents)
+                      for user_id, cents in split_cents(expense.amount_cents, weights).items()]
+    db.session.add(expense)
+    db.session.commit()
+    return expense
+
+
+def set_budget(group_id, category_id, year, month, amount):
+    """Set a group's budget for a category and month in one atomic upsert"""
+    database.upsert(db.session.connection(), GroupBudget.__table__, [{
+        'group_id': group_id, 'category_id': category_id, 'year': year, 'month': month,
+        'amount_cents': to_minor(amount), 'currency': DEFAULT_CURRENCY
+    }], ['group_id', 'year', 'month', 'category_id'], ['amount_cents', 'currency'])
+    _changed(db.session, group_id)
+    db.session.commit()
+
+
+def _version_key(group_id):
+    return f'group-version:{group_id}'
+
+
+def bump_version(group_id):
+    version = uuid.uuid4().hex
+    cache.backend.set(_version_key(group_id), version, VERSION_TIMEOUT)
+    return version
+
+
+def version(group_id):
+    entry = cache.backend.get(_version_key(group_id))
+    return entry[1] if entry is not None else bump_version(group_id)
+
+
+def _changed(session, group_id):
+    session.info.setdefault('groups_changed', set()).add(group_id)
+
+
+@event.listens_for(Session, 'after_flush')
+def _record_group_writes(session, flush_context):
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, (GroupMember, SharedExpense, GroupBudget)):
+            _changed(session, obj.group_id)
+        elif isinstance(obj, Group):
+            _changed(session, obj.id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_groups(session):
+    for group_id in session.info.pop('groups_changed', ()):
+        bump_version(group_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_group_writes(session):
+    session.info.pop('groups_changed', None)
+
+
+def _dashboard_query(group_id, year, month):
+    """Rows of (kind, key, a, b): ('c', category_id, spending, budget) for the
+    month and ('m', user_id, paid, owed) over the group's whole history"""
+    spending = select(
+        literal('c').label('kind'), SharedExpense.category_id.label('key'),
+        SharedExpense.amount_cents.label('a'), literal(0).label('b')
+    ).where(SharedExpense.group_id == group_id, in_month(SharedExpense.date, year, month))
+    budgets = select(
+        literal('c'), GroupBudget.category_id, literal(0), GroupBudget.amount_cents
+    ).where(GroupBudget.group_id == group_id, GroupBudget.year == year, GroupBudget.month == month)
+    paid = select(
+        literal('m'), SharedExpense.paid_by, SharedExpense.amount_cents, literal(0)
+    ).where(SharedExpense.group_id == group_id)
+    owed = select(
+        literal('m'), ExpenseSplit.user_id, literal(0), ExpenseSplit.owed_cents
+    ).join(SharedExpense, SharedExpense.id == ExpenseSplit.shared_expense_id).where(SharedExpense.group_id == group_id)
+
+    combined = union_all(spending, budgets, paid, owed).subquery()
+    return select(
+        combined.c.kind, combined.c.key, func.sum(combined.c.a), func.sum(combined.c.b)
+    ).group_by(combined.c.kind, combined.c.key)
+
+
+def dashboard(group_id, year, month):
+    """Budget vs spending rows for the default categories, the totals, and
+    every member's balance, cached until the group is next written"""
+    def compute():
+        totals = {'c': {}, 'm': {}}
+        for kind, key, a, b in db.session.execute(_dashboard_query(group_id, year, month)):
+            totals[kind][key] = (a or 0, b or 0)
+        rows = []
+        for category in refdata.categories():
+            spending, budget = totals['c'].get(category.id, (0, 0))
+            rows.append(budget_row(category.name, from_minor(spending), from_minor(budget)))
+        if None in totals['c']:
+            rows.append(budget_row('Uncategorized', from_minor(totals['c'][None][0]), from_minor(0)))
+        balances = []
+        for user_id, username, role in members(group_id):
+            paid, owed = totals['m'].get(user_id, (0, 0))
+            balances.append(Balance(user_id, username, from_minor(paid), from_minor(owed), from_minor(paid - owed)))
+        return {
+            'budget_vs_spending': rows,
+            'total_spending': sum((r['spending'] for r in rows), from_minor(0)),
+            'total_budget': sum((r['budget'] for r in rows), from_minor(0)),
+            'balances': balances
+        }
+    return cache.get_or_set(f'group-dashboard:{group_id}:{year}:{month}:{version(group_id)}', compute)
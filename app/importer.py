@@ -0,0 +1,206 @@
+import csv
+import io
+import re
+from datetime import datetime
+from decimal import InvalidOperation
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from app import db, bulk, refdata
+from app.models import User
+from app.money import to_minor
+
+DEFAULT_BATCH_SIZE = 10000
+
+# Only the first errors are kept in the report; the rest are just counted
+MAX_REPORTED_ERRORS = 1000
+
+OFX_CATEGORY = 'Other'
+
+
+class RowError(ValueError):
+    pass
+
+
+class ImportReport:
+    def __init__(self):
+        self.imported = 0
+        self.skipped = 0
+        self.error_count = 0
+        self.errors = [] # (line number, message)
+
+    def add_error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, message))
+
+    def __repr__(self):
+        return f"ImportReport(imported={self.imported}, skipped={self.skipped}, errors={self.error_count})"
+
+
+class CategoryLookup:
+    """Case-insensitive category name to id map, built once per import. Full
+    names ('Food / Groceries', as exported) and plain names both match."""
+
+    def __init__(self, user_id):
+        self._ids = {}
+        for node in refdata.category_tree(user_id):
+            self._ids[node.label.strip().lower()] = node.id
+        for node in refdata.category_tree(user_id):
+            self._ids.setdefault(node.name.strip().lower(), node.id)
+
+    def get(self, name):
+        return self._ids.get((name or '').strip().lower())
+
+
+def _parse_date(value):
+    value = value.strip()
+    try:
+        return datetime.fromisoformat(value[:10])
+    except ValueError:
+        raise RowError(f"Invalid date '{value}', expected YYYY-MM-DD")
+
+
+def _parse_cents(value):
+    """Amount in integer cents, parsed as a decimal so '0.29' is exactly 29"""
+    try:
+        return to_minor(value.strip().replace(',', '').replace('$', ''))
+    except (InvalidOperation, ValueError, AttributeError):
+        raise RowError(f"Invalid amount '{value}'")
+
+
+def _parse_amount(value):
+    amount = _parse_cents(value)
+    if amount <= 0:
+        raise RowError('Amount must be positive')
+    return amount
+
+
+def parse_csv(stream):
+    """Yield (line, fields) from a CSV with Date, Category, Description and Amount
+    columns - the same layout as the expenses export"""
+    reader = csv.reader(stream)
+    header = [h.strip().lower() for h in next(reader, [])]
+    missing = {'date', 'category', 'amount'} - set(header)
+    if missing:
+        raise RowError(f"CSV is missing column(s): {', '.join(sorted(missing))}")
+    columns = {name: header.index(name) for name in ('date', 'category', 'description', 'amount') if name in header}
+    for row in reader:
+        if not any(row):
+            continue
+        yield reader.line_num, {name: row[i] if i < len(row) else '' for name, i in columns.items()}
+
+
+_OFX_TAG = re.compile(r'<(/?)([A-Z0-9.]+)>([^<\r\n]*)', re.IGNORECASE)
+
+
+def parse_ofx(stream):
+    """Yield (line, fields) for each <STMTTRN> in an OFX/QFX statement.
+
+    Handles both the SGML (unclosed tags) and XML flavours line by line.
+    Debits become expenses in the 'Other' category; credits are skipped.
+    """
+    transaction = None
+    for line_num, line in enumerate(stream, 1):
+        for closing, tag, value in _OFX_TAG.findall(line):
+            tag = tag.upper()
+            if tag == 'STMTTRN':
+                if closing and transaction is not None:
+                    yield transaction[0], transaction[1]
+                    transaction = None
+                elif not closing:
+                    transaction = (line_num, {'category': OFX_CATEGORY, 'description': ''})
+            elif transaction is not None and not closing:
+                fields = transaction[1]
+                value = value.strip()
+                if tag == 'DTPOSTED':
+                    fields['date'] = f'{value[:4]}-{value[4:6]}-{value[6:8]}'
+                elif tag == 'TRNAMT':
+                    fields['amount'] = value
+                elif tag == 'NAME' or (tag == 'MEMO' and not fields['description']):
+                    fields['description'] = value
+
+
+PARSERS = {'csv': parse_csv, 'ofx': parse_ofx, 'qfx': parse_ofx}
+
+
+def _mappings(records, user_id, categories, report, is_ofx):
+    for line, fields in records:
+        try:
+            if is_ofx:
+                amount = -_parse_cents(fields.get('amount') or '0')
+                if amount <= 0:
+                    report.skipped += 1 # Deposits are not expenses
+                    continue
+            else:
+                amount = _parse_amount(fields.get('amount'))
+            category_id = categories.get(fields.get('category'))
+            if category_id is None:
+                raise RowError(f"Unknown category '{fields.get('category')}'")
+            yield {
+                'amount_cents': amount,
+                'date': _parse_date(fields.get('date') or ''),
+                'description': (fields.get('description') or '')[:200] or None,
+                'user_id': user_id,
+                'category_id': category_id
+            }
+        except (RowError, ValueError) as e:
+            report.add_error(line, str(e))
+
+
+def import_expenses(user_id, stream, file_format='csv', batch_size=None):
+    """Import expenses for a user from a text stream.
+
+    Rows are parsed as they are read and inserted with executemany in
+    batches of batch_size, one transaction per batch. Invalid rows are
+    recorded in the returned ImportReport instead of aborting the import.
+    """
+    batch_size = batch_size or current_app.config.get('IMPORT_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+    report = ImportReport()
+    try:
+        records = PARSERS[file_format](stream)
+        batch = []
+        for mapping in _mappings(records, user_id, CategoryLookup(user_id), report, file_format != 'csv'):
+            batch.append(mapping)
+            if len(batch) >= batch_size:
+                _insert_batch(batch, report)
+                batch = []
+        if batch:
+            _insert_batch(batch, report)
+    except (RowError, UnicodeDecodeError, csv.Error) as e:
+        report.add_error(0, str(e))
+    return report
+
+
+def _insert_batch(batch, report):
+    bulk.insert_expenses(batch)
+    db.session.commit()
+    report.imported += len(batch)
+
+
+def text_stream(binary):
+    """Wrap an uploaded binary file for line-by-line text parsing"""
+    return io.TextIOWrapper(binary, encoding='utf-8-sig', newline='')
+
+
+def detect_format(filename):
+    extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    return extension if extension in PARSERS else 'csv'
+
+
+@click.command('import-expenses')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--user', 'email', required=True, help='Email of the user to import for.')
+@click.option('--format', 'file_format', type=click.Choice(sorted(PARSERS)), help='Defaults to the file extension.')
+@click.option('--batch-size', type=int, help='Rows per insert batch and transaction.')
+@with_appcontext
+def import_command(path, email, file_format, batch_size):
+    """Import expenses from a CSV or OFX file."""
+    user = User.query.filter_by(email=email).first()
+    if user is None:
+        raise click.BadParameter(f'No user with email {email}', param_hint='--user')
+    with open(path, 'rb') as f:
+        report = import_expenses(user.id, text_stream(f), file_format or detect_format(path), batch_size)
+    for line, message in report.errors:
+        click.echo(f'line {line}: {message}', err=True)
+    click.echo(f'Imported {report.imported} expenses, skipped {report.skipped}, {report.error_count} errors.')
@@ -0,0 +1,199 @@
+import hmac
+import threading
+import time
+from collections import Counter, defaultdict
+from flask import abort, g, request, Response, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app.cache import cache
+
+# Upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# A statement repeated more than this many times in one request is
+# reported as a likely N+1 query pattern
+DEFAULT_N_PLUS_ONE_THRESHOLD = 5
+
+# Addresses allowed to scrape /metrics without a token
+DEFAULT_METRICS_ALLOWED_IPS = ('127.0.0.1', '::1')
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+
+
+class Metrics:
+    """Per-endpoint request and database metrics for one app, counted in each
+    worker process separately"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = defaultdict(Histogram)
+        self.requests = Counter() # (endpoint, status) -> count
+        self.statements = Counter() # endpoint -> SQL statements executed
+        self.db_time = Counter() # endpoint -> seconds spent in the database
+        self.n_plus_one = Counter() # endpoint -> requests flagged
+
+    def record(self, endpoint, status, elapsed, stats, flagged):
+        with self.lock:
+            self.latency[endpoint].observe(elapsed)
+            self.requests[(endpoint, status)] += 1
+            self.statements[endpoint] += stats.count
+            self.db_time[endpoint] += stats.db_time
+            if flagged:
+                self.n_plus_one[endpoint] += 1
+
+    def render(self, cache_stats=None):
+        """Prometheus text exposition format"""
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for suffix, labels, value in samples:
+                label_text = ','.join(f'{k}="{_escape(v)}"' for k, v in labels)
+                lines.append(f'{name}{suffix}{{{label_text}}} {value}' if label_text else f'{name}{suffix} {value}')
+
+        with self.lock:
+            latency = []
+            for endpoint, histogram in sorted(self.latency.items()):
+                for bound, count in histogram.cumulative():
+                    latency.append(('_bucket', [('endpoint', endpoint), ('le', bound)], count))
+                latency.append(('_bucket', [('endpoint', endpoint), ('le', '+Inf')], histogram.count))
+                latency.append(('_sum', [('endpoint', endpoint)], histogram.sum))
+                latency.append(('_count', [('endpoint', endpoint)], histogram.count))
+            metric('http_request_duration_seconds', 'histogram', 'Request latency by endpoint.', latency)
+            metric('http_requests_total', 'counter', 'Requests by endpoint and status.',
+                   [('', [('endpoint', e), ('status', s)], n) for (e, s), n in sorted(self.requests.items())])
+            metric('db_statements_total', 'counter', 'SQL statements executed by endpoint.',
+                   [('', [('endpoint', e)], n) for e, n in sorted(self.statements.items())])
+            metric('db_time_seconds_total', 'counter', 'Time spent executing SQL by endpoint.',
+                   [('', [('endpoint', e)], n) for e, n in sorted(self.db_time.items())])
+            metric('db_n_plus_one_requests_total', 'counter', 'Requests repeating a statement more than the threshold.',
+                   [('', [('endpoint', e)], n) for e, n in sorted(self.n_plus_one.items())])
+
+        if cache_stats:
+            for name in ('hits', 'misses', 'evictions', 'invalidations'):
+                metric(f'cache_{name}_total', 'counter', f'Result cache {name}.', [('', [], cache_stats[name])])
+            metric('cache_entries', 'gauge', 'Entries in the result cache.', [('', [], cache_stats['entries'])])
+        return '\n'.join(lines) + '\n'
+
+
+def _may_scrape(config):
+    token = config['METRICS_TOKEN']
+    if token:
+        scheme, _, given = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() == 'bearer' and hmac.compare_digest(given.encode(), token.encode()):
+            return True
+    return request.remote_addr in config['METRICS_ALLOWED_IPS']
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class RequestStats:
+    """SQL executed while handling the current request"""
+
+    def __init__(self):
+        self.count = 0
+        self.db_time = 0.0
+        self.by_statement = Counter()
+        self.timings = [] # (seconds, statement) in execution order
+
+    def add(self, statement, elapsed):
+        self.count += 1
+        self.db_time += elapsed
+        self.by_statement[statement] += 1
+        self.timings.append((elapsed, statement))
+
+
+def _current_stats():
+    if has_app_context():
+        return g.get('_request_stats')
+    return None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the statement's own context, so one that raises (and never
+    # reaches after_cursor_execute) leaves nothing behind on the connection
+    context._query_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = context._query_start
+    stats = _current_stats()
+    if stats is not None:
+        stats.add(statement, time.perf_counter() - started)
+
+
+def init_app(app):
+    """Record latency and SQL statistics for every request and serve them at /metrics.
+
+    Config:
+    - METRICS_ENABLED: set False to disable collection and the endpoint
+    - N_PLUS_ONE_THRESHOLD: repeats of one statement in a request before it is flagged
+    - SLOW_REQUEST_MS: log requests slower than this, with their statements
+    - METRICS_ALLOWED_IPS: addresses that may read /metrics (default loopback)
+    - METRICS_TOKEN: if set, any address may read /metrics with this bearer token
+    """
+    if not app.config.setdefault('METRICS_ENABLED', True):
+        return
+    app.config.setdefault('N_PLUS_ONE_THRESHOLD', DEFAULT_N_PLUS_ONE_THRESHOLD)
+    app.config.setdefault('SLOW_REQUEST_MS', None)
+    app.config.setdefault('METRICS_ALLOWED_IPS', DEFAULT_METRICS_ALLOWED_IPS)
+    app.config.setdefault('METRICS_TOKEN', None)
+    metrics = app.extensions['metrics'] = Metrics()
+
+    @app.before_request
+    def _start_request():
+        g._request_started = time.perf_counter()
+        g._request_stats = RequestStats()
+
+    @app.after_request
+    def _finish_request(response):
+        stats = g.pop('_request_stats', None)
+        if stats is None:
+            return response
+        elapsed = time.perf_counter() - g.pop('_request_started')
+        endpoint = request.endpoint or 'unmatched'
+        threshold = app.config['N_PLUS_ONE_THRESHOLD']
+        slow_ms = app.config['SLOW_REQUEST_MS']
+
+        repeated = [(sql, n) for sql, n in stats.by_statement.items() if n > threshold]
+        for sql, n in repeated:
+            app.logger.warning('Possible N+1 query in %s: statement ran %d times: %s', endpoint, n, sql)
+        if slow_ms is not None and elapsed * 1000 > slow_ms:
+            app.logger.warning('Slow request %s %s (%s): %.1f ms, %d statements, %.1f ms in the database\n%s',
+                               request.method, request.path, endpoint, elapsed * 1000, stats.count,
+                               stats.db_time * 1000,
+                               '\n'.join(f'  {t * 1000:.2f} ms  {sql}' for t, sql in stats.timings))
+
+        metrics.record(endpoint, response.status_code, elapsed, stats, bool(repeated))
+        return response
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        if not _may_scrape(app.config):
+            abort(403)
+        return Response(metrics.render(cache.stats()), mimetype='text/plain; version=0.0.4')
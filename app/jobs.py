@@ -0,0 +1,236 @@
+"""Background report generation.
+
+Reports are recorded in the report_job table and generated by a thread pool
+in each server process, so a large export never runs inside a request. The
+table is the queue: a job is claimed with a conditional UPDATE, so however
+many processes see a queued job only one runs it, and jobs left queued or
+stuck running by a restart are picked up again on each process's first
+request. Finished files are kept in
+JOB_RESULTS_DIR until JOB_RESULT_TTL seconds have passed.
+
+Identical requests (same user, report, format and parameters) share one
+job while it is queued, running or its result is still available, as long
+as the user's data and categories have not changed since it was requested.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from app import db, exports, refdata
+from app.cache import data_version
+from app.models import ReportJob
+
+log = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 2
+DEFAULT_RESULT_TTL = 60 * 60
+# A job still running after this many seconds is assumed to have died with its process
+DEFAULT_STALE_AFTER = 30 * 60
+
+REPORTS = {
+    'expenses': ('csv', 'xlsx'),
+    'budget_spending': ('csv', 'xlsx', 'pdf')
+}
+MIMETYPES = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'pdf': 'application/pdf'
+}
+
+
+class JobRunner:
+    """Runs report jobs for one app. JOB_WORKERS = 0 runs them inline on submit."""
+
+    def __init__(self, app):
+        self.app = app
+        self.workers = app.config.setdefault('JOB_WORKERS', DEFAULT_WORKERS)
+        self.result_ttl = app.config.setdefault('JOB_RESULT_TTL', DEFAULT_RESULT_TTL)
+        self.stale_after = app.config.setdefault('JOB_STALE_AFTER', DEFAULT_STALE_AFTER)
+        self.directory = app.config.setdefault('JOB_RESULTS_DIR', os.path.join(app.instance_path, 'reports'))
+        self._executor = None
+        self._pid = None
+        self._recovered_pid = None
+        self._lock = threading.Lock()
+        app.before_request(self.ensure_recovered)
+
+    def _pool(self):
+        with self._lock:
+            # Threads do not survive a fork, so each server process starts its own pool
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='report-job')
+                self._pid = os.getpid()
+        return self._executor
+
+    def ensure_recovered(self):
+        # Once per server process, on its first request, so jobs a restart
+        # left behind run without waiting for another submission
+        with self._lock:
+            if self._recovered_pid == os.getpid():
+                return
+            self._recovered_pid = os.getpid()
+        self._recover()
+
+    def _recover(self):
+        """Requeue jobs that died with their process and run everything queued"""
+        stale = datetime.utcnow() - timedelta(seconds=self.stale_after)
+        db.session.execute(update(ReportJob).where(
+            ReportJob.status == 'running', ReportJob.started_at < stale
+        ).values(status='queued', started_at=None))
+        db.session.commit()
+        # Listed up front, as inline jobs commit as they run
+        queued = db.session.query(ReportJob.id).filter_by(status='queued').order_by(ReportJob.id).all()
+        for (job_id,) in queued:
+            self.enqueue(job_id)
+
+    def enqueue(self, job_id):
+        if not self.workers:
+            run(job_id)
+        else:
+            self._pool().submit(self._run_in_context, job_id)
+
+    def _run_in_context(self, job_id):
+        with self.app.app_context():
+            try:
+                run(job_id)
+            except Exception:
+                log.exception('Report job %s crashed', job_id)
+
+    def shutdown(self):
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown()
+
+
+def init_app(app):
+    app.extensions['jobs'] = JobRunner(app)
+
+
+def _runner():
+    return current_app.extensions['jobs']
+
+
+def dedupe_key(user_id, kind, file_format, params):
+    # The version tokens change on every write to the user's expenses,
+    # budgets or categories, so a result is never shared once it is stale
+    versions = [data_version(user_id), refdata.category_version(user_id)]
+    payload = json.dumps([user_id, kind, file_format, params, versions], sort_keys=True)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def submit(user_id, kind, file_format, params):
+    """Queue a report, or return the job already producing an identical one"""
+    if file_format not in REPORTS.get(kind, ()):
+        raise ValueError(f"Report '{kind}' is not available as {file_format}")
+    purge_expired()
+    key = dedupe_key(user_id, kind, file_format, params)
+    job = ReportJob.query.filter_by(dedupe_key=key).first()
+    if job is not None:
+        return job
+
+    job = ReportJob(user_id=user_id, kind=kind, format=file_format, params=json.dumps(params, sort_keys=True),
+                    dedupe_key=key, status='queued')
+    db.session.add(job)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # An identical request committed its job first; share it
+        db.session.rollback()
+        return ReportJob.query.filter_by(dedupe_key=key).one()
+    _runner().enqueue(job.id)
+    return job
+
+
+def _generate(job, path):
+    params = json.loads(job.params)
+    if job.kind == 'expenses':
+        start = datetime.fromisoformat(params['start']).date() if params.get('start') else None
+        end = datetime.fromisoformat(params['end']).date() if params.get('end') else None
+        rows = exports.expense_rows(job.user_id, start, end, params.get('category'))
+        exports.WRITERS[job.format](path, exports.EXPENSE_HEADERS, rows, 'Expenses')
+    elif job.kind == 'budget_spending':
+        year, month = params['year'], params['month']
+        rows = exports.budget_spending_rows(job.user_id, year, month)
+        exports.WRITERS[job.format](path, exports.BUDGET_HEADERS, rows, f'Budget vs spending {year}-{month:02d}')
+    else:
+        raise ValueError(f"Unknown report '{job.kind}'")
+
+
+def run(job_id):
+    """Generate a queued job's file, unless another worker has claimed it"""
+    claimed = db.session.execute(update(ReportJob).where(
+        ReportJob.id == job_id, ReportJob.status == 'queued'
+    ).values(status='running', started_at=datetime.utcnow())).rowcount
+    db.session.commit()
+    if not claimed:
+        return
+
+    runner = _runner()
+    job = db.session.get(ReportJob, job_id)
+    os.makedirs(runner.directory, exist_ok=True)
+    path = os.path.join(runner.directory, f'{job.id}.{job.format}')
+    tmp = f'{path}.tmp'
+    try:
+        _generate(job, tmp)
+        os.replace(tmp, path) # Never serve a half-written file
+    except Exception as e:
+        log.exception('Report job %s failed', job_id)
+        db.session.rollback()
+        _remove(tmp)
+        job = db.session.get(ReportJob, job_id)
+        # Failed jobs are not shared; the next identical request retries
+        job.status, job.error, job.dedupe_key = 'failed', str(e), None
+        job.finished_at = datetime.utcnow()
+    else:
+        job.status, job.path = 'done', path
+        job.finished_at = datetime.utcnow()
+        job.expires_at = job.finished_at + timedelta(seconds=runner.result_ttl)
+    db.session.commit()
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except (OSError, TypeError):
+        pass
+
+
+def purge_expired():
+    """Delete result files past their expiry; returns the number of jobs expired"""
+    expired = ReportJob.query.filter(ReportJob.status == 'done', ReportJob.expires_at < datetime.utcnow()).all()
+    for job in expired:
+        _remove(job.path)
+        job.status, job.path, job.dedupe_key = 'expired', None, None
+    if expired:
+        db.session.commit()
+    return len(expired)
+
+
+def describe(job):
+    """JSON-ready status of a job"""
+    def iso(value):
+        return value.isoformat() + 'Z' if value else None
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'format': job.format,
+        'params': json.loads(job.params),
+        'status': job.status,
+        'error': job.error,
+        'created_at': iso(job.created_at),
+        'finished_at': iso(job.finished_at),
+        'expires_at': iso(job.expires_at)
+    }
+
+
+@click.command('jobs-purge')
+@with_appcontext
+def purge_command():
+    """Delete expired report files."""
+    click.echo(f'Expired {purge_expired()} report jobs.')
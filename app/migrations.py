@@ -0,0 +1,249 @@
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import inspect, text
+from app import db
+from app.models import Expense, Budget, Category
+from app.money import DEFAULT_CURRENCY
+
+# Schema changes that db.create_all() cannot apply to an existing database
+# (it only creates missing tables). Each migration is a (version, description,
+# function) tuple and runs once, in order; the applied version is recorded in
+# the schema_version table.
+MIGRATIONS = []
+
+
+def migration(version, description):
+    def decorator(fn):
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return decorator
+
+
+def head():
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def current_version(conn):
+    conn.execute(text('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)'))
+    version = conn.execute(text('SELECT version FROM schema_version')).scalar()
+    if version is None:
+        conn.execute(text('INSERT INTO schema_version (version) VALUES (0)'))
+        version = 0
+    return version
+
+
+def set_version(conn, version):
+    conn.execute(text('UPDATE schema_version SET version = :version'), {'version': version})
+
+
+def upgrade(engine=None):
+    """Create missing tables and bring an existing database up to the latest schema.
+
+    A brand new database gets the current schema from create_all() and is
+    stamped at the head version; an existing one runs pending migrations.
+    Returns the list of migrations applied.
+    """
+    engine = engine or db.engine
+    existing = inspect(engine).has_table(Expense.__tablename__)
+    db.metadata.create_all(engine)
+
+    applied = []
+    with engine.begin() as conn:
+        version = current_version(conn)
+        if not existing:
+            set_version(conn, head())
+            return applied
+        for number, description, fn in MIGRATIONS:
+            if number <= version:
+                continue
+            fn(conn)
+            set_version(conn, number)
+            applied.append((number, description))
+    return applied
+
+
+@migration(1, 'Composite indexes for month-range queries and unique budgets')
+def _add_period_indexes(conn):
+    # Older versions could race into duplicate budgets; keep the newest row
+    # so the unique index can be built
+    conn.execute(text(
+        'DELETE FROM budget WHERE id NOT IN ('
+        'SELECT MAX(id) FROM budget GROUP BY user_id, year, month, category_id)'
+    ))
+    # Only the indexes this migration introduced; later ones need columns
+    # that later migrations add
+    names = {'ix_expense_user_date', 'ix_expense_user_category_date', 'ux_budget_user_period_category'}
+    for table in (Expense.__table__, Budget.__table__):
+        for index in table.indexes:
+            if index.name in names:
+                index.create(conn, checkfirst=True)
+
+
+@migration(2, 'Monthly spending rollup')
+def _build_monthly_rollup(conn):
+    # rollup.rebuild() follows the current schema; at this version expenses
+    # still have float amounts, so build the rollup from those directly
+    year = "CAST(STRFTIME('%Y', date) AS INTEGER)"
+    month = "CAST(STRFTIME('%m', date) AS INTEGER)"
+    if conn.dialect.name == 'postgresql':
+        year, month = 'EXTRACT(YEAR FROM date)', 'EXTRACT(MONTH FROM date)'
+    conn.execute(text('DELETE FROM monthly_spend'))
+    conn.execute(text(
+        'INSERT INTO monthly_spend (user_id, category_id, year, month, total_cents, count) '
+        f'SELECT user_id, category_id, {year}, {month}, CAST(ROUND(SUM(amount) * 100) AS INTEGER), COUNT(id) '
+        f'FROM expense GROUP BY user_id, category_id, {year}, {month}'
+    ))
+
+
+def _columns(conn, table):
+    return {c['name'] for c in inspect(conn).get_columns(table)}
+
+
+@migration(3, 'Amounts in integer cents with a currency code')
+def _amounts_to_cents(conn):
+    from app import rollup
+    for table in ('expense', 'budget'):
+        columns = _columns(conn, table)
+        if 'amount_cents' not in columns:
+            conn.execute(text(f'ALTER TABLE {table} ADD COLUMN amount_cents INTEGER NOT NULL DEFAULT 0'))
+        if 'currency' not in columns:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN currency VARCHAR(3) NOT NULL DEFAULT '{DEFAULT_CURRENCY}'"))
+        if 'amount' in columns:
+            # ROUND absorbs float error, e.g. 0.29 * 100 = 28.999999999999996
+            conn.execute(text(f'UPDATE {table} SET amount_cents = CAST(ROUND(amount * 100) AS INTEGER)'))
+            conn.execute(text(f'ALTER TABLE {table} DROP COLUMN amount'))
+
+    columns = _columns(conn, 'monthly_spend')
+    if 'total_cents' not in columns:
+        conn.execute(text('ALTER TABLE monthly_spend ADD COLUMN total_cents INTEGER NOT NULL DEFAULT 0'))
+    if 'total' in columns:
+        conn.execute(text('ALTER TABLE monthly_spend DROP COLUMN total'))
+    rollup.rebuild(conn)
+
+
+@migration(4, 'Full-text search index on expense descriptions')
+def _add_search_index(conn):
+    from app import search
+    search.install(conn)
+    search.rebuild(conn)
+
+
+@migration(5, 'Recurring expenses')
+def _add_recurring_link(conn):
+    # The recurring_expense table itself comes from create_all()
+    if 'recurring_id' not in _columns(conn, 'expense'):
+        conn.execute(text('ALTER TABLE expense ADD COLUMN recurring_id INTEGER REFERENCES recurring_expense (id)'))
+    for index in Expense.__table__.indexes:
+        index.create(conn, checkfirst=True)
+
+
+@migration(6, 'Per-user categories nested by materialized path')
+def _add_category_tree(conn):
+    columns = _columns(conn, 'category')
+    if 'user_id' not in columns:
+        conn.execute(text('ALTER TABLE category ADD COLUMN user_id INTEGER REFERENCES user (id)'))
+    if 'parent_id' not in columns:
+        conn.execute(text('ALTER TABLE category ADD COLUMN parent_id INTEGER REFERENCES category (id)'))
+    if 'path' not in columns:
+        conn.execute(text('ALTER TABLE category ADD COLUMN path VARCHAR(255)'))
+    # Every existing category is a shared top-level one
+    conn.execute(text("UPDATE category SET path = '/' || id || '/' WHERE path IS NULL"))
+    for index in Category.__table__.indexes:
+        index.create(conn, checkfirst=True)
+
+
+@migration(7, 'Shared ledgers: member roles and amounts in cents')
+def _upgrade_group_tables(conn):
+    # Older databases have these tables with float amounts and no roles;
+    # newer ones got them, complete, from create_all()
+    from app.models import GroupMember, SharedExpense, ExpenseSplit
+    if 'role' not in _columns(conn, 'group_member'):
+        conn.execute(text("ALTER TABLE group_member ADD COLUMN role VARCHAR(10) NOT NULL DEFAULT 'member'"))
+        conn.execute(text(
+            "UPDATE group_member SET role = 'owner' WHERE user_id = "
+            '(SELECT created_by FROM "group" WHERE "group".id = group_member.group_id)'
+        ))
+        conn.execute(text(
+            'DELETE FROM group_member WHERE id NOT IN (SELECT MIN(id) FROM group_member GROUP BY group_id, user_id)'
+        ))
+    columns = _columns(conn, 'shared_expense')
+    if 'amount' in columns:
+        conn.execute(text('ALTER TABLE shared_expense ADD COLUMN amount_cents INTEGER NOT NULL DEFAULT 0'))
+        conn.execute(text(f"ALTER TABLE shared_expense ADD COLUMN currency VARCHAR(3) NOT NULL DEFAULT '{DEFAULT_CURRENCY}'"))
+        conn.execute(text('UPDATE shared_expense SET amount_cents = CAST(ROUND(amount * 100) AS INTEGER)'))
+        conn.execute(text('ALTER TABLE shared_expense DROP COLUMN amount'))
+    if 'amount_owed' in _columns(conn, 'expense_split'):
+        conn.execute(text('ALTER TABLE expense_split ADD COLUMN owed_cents INTEGER NOT NULL DEFAULT 0'))
+        conn.execute(text('UPDATE expense_split SET owed_cents = CAST(ROUND(amount_owed * 100) AS INTEGER)'))
+        conn.execute(text('ALTER TABLE expense_split DROP COLUMN amount_owed'))
+    for model in (GroupMember, SharedExpense, ExpenseSplit):
+        for index in model.__table__.indexes:
+            index.create(conn, checkfirst=True)
+
+
+@migration(8, 'Change log for API delta sync')
+def _add_change_log(conn):
+    # The change_log and api_token tables come from create_all(); the
+    # triggers only record changes from here on, as clients start with a
+    # full sync
+    from app import changes
+    changes.install(conn)
+
+
+@migration(9, 'Search index insert trigger skips bulk inserts')
+def _skip_bulk_in_search_trigger(conn):
+    # The bulk_write table comes from create_all()
+    from app import search
+    if search.is_supported(conn):
+        conn.execute(text('DROP TRIGGER IF EXISTS expense_fts_insert'))
+        search.install(conn)
+
+
+@migration(10, 'Change log insert trigger skips bulk inserts')
+def _skip_bulk_in_change_log_trigger(conn):
+    from app import changes
+    if conn.dialect.name != 'postgresql':
+        # install() recreates the PostgreSQL function and triggers anyway
+        conn.execute(text('DROP TRIGGER IF EXISTS change_log_expense_insert'))
+    changes.install(conn)
+
+
+@migration(11, 'Search trigger without the bulk insert guard; one-off expenses out of the recurring index')
+def _drop_bulk_guard_from_search_trigger(conn):
+    from app import search
+    if search.is_supported(conn):
+        conn.execute(text('DROP TRIGGER IF EXISTS expense_fts_insert'))
+        search.install(conn)
+    conn.execute(text('DROP INDEX IF EXISTS ux_expense_recurring_date'))
+    for index in Expense.__table__.indexes:
+        if index.name == 'ux_expense_recurring_date':
+            index.create(conn)
+
+
+@migration(12, 'Change log trigger without the bulk insert guard')
+def _drop_bulk_guard_from_change_log_trigger(conn):
+    from app import changes
+    if conn.dialect.name != 'postgresql':
+        # install() recreates the PostgreSQL function and triggers anyway
+        conn.execute(text('DROP TRIGGER IF EXISTS change_log_expense_insert'))
+    changes.install(conn)
+    conn.execute(text('DROP TABLE IF EXISTS bulk_write'))
+
+
+@migration(13, 'Monthly rollup rebuilt without emptied months')
+def _rebuild_monthly_rollup(conn):
+    # Deleting a month's last expense leaves a zero row behind; rebuilding
+    # drops those and brings every database to the same rollup
+    from app import rollup
+    rollup.rebuild(conn)
+
+
+@click.command('db-upgrade')
+@with_appcontext
+def upgrade_command():
+    """Upgrade the database schema in place."""
+    applied = upgrade()
+    for number, description in applied:
+        click.echo(f'Applied migration {number}: {description}')
+    click.echo(f'Database is at schema version {head()}.')
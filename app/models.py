@@ -1,10 +1,11 @@
 from datetime import datetime
-from app import db, login_manager
+from app import db, login_manager, money
 from flask_login import UserMixin
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    from app import refdata
+    return refdata.load_user(user_id)
 
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
@@ -20,33 +21,288 @@ class User(db.Model, UserMixin):
 class Category(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
-    # For simplicity, categories can be global or user-specific. 
-    # Let's make them global for now, or we can add user_id to make them custom.
-    # To keep it simple and meet requirements: "Expenses are categorized"
-    
+    # NULL for the default categories every user shares; otherwise the owner
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    parent_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=True)
+    parent = db.relationship('Category', remote_side=[id], backref='children')
+    # Materialized path of ids from the root, e.g. '/1/7/12/'. A subtree is
+    # every category whose path starts with its root's path. Set on insert
+    # (see app.refdata); categories are not moved, so it never changes.
+    path = db.Column(db.String(255), nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_category_path', 'path'),
+        db.Index('ix_category_user', 'user_id'),
+    )
+
+    @property
+    def depth(self):
+        return self.path.count('/') - 2 if self.path else 0
+
     def __repr__(self):
         return f"Category('{self.name}')"
 
-class Budget(db.Model):
+class MoneyMixin:
+    # Stored in the currency's minor unit (cents) so totals are exact;
+    # `amount` reads and writes the Decimal value in major units
+    amount_cents = db.Column(db.Integer, nullable=False)
+    currency = db.Column(db.String(3), nullable=False, default=money.DEFAULT_CURRENCY,
+                         server_default=money.DEFAULT_CURRENCY)
+
+    @property
+    def amount(self):
+        return money.from_minor(self.amount_cents, self.currency or money.DEFAULT_CURRENCY)
+
+    @amount.setter
+    def amount(self, value):
+        self.amount_cents = money.to_minor(value, self.currency or money.DEFAULT_CURRENCY)
+
+class Budget(MoneyMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    amount = db.Column(db.Float, nullable=False)
     month = db.Column(db.Integer, nullable=False) # 1-12
     year = db.Column(db.Integer, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False)
     category = db.relationship('Category', backref='budgets')
 
+    __table_args__ = (
+        # One budget per user, month and category; also serves period lookups
+        db.Index('ux_budget_user_period_category', 'user_id', 'year', 'month', 'category_id', unique=True),
+    )
+
     def __repr__(self):
         return f"Budget('{self.amount}', '{self.month}/{self.year}', '{self.category.name}')"
 
-class Expense(db.Model):
+class Expense(MoneyMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    amount = db.Column(db.Float, nullable=False)
     date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     description = db.Column(db.String(200), nullable=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False)
     category = db.relationship('Category', backref='expenses')
+    # Set on occurrences materialized from a RecurringExpense
+    recurring_id = db.Column(db.Integer, db.ForeignKey('recurring_expense.id'), nullable=True)
+
+    __table_args__ = (
+        # Monthly totals filter on a date range per user (and category)
+        db.Index('ix_expense_user_date', 'user_id', 'date'),
+        db.Index('ix_expense_user_category_date', 'user_id', 'category_id', 'date'),
+        # A rule can never produce the same occurrence twice; partial, so
+        # one-off expenses (most rows) are not written to it at all
+        db.Index('ux_expense_recurring_date', 'recurring_id', 'date', unique=True,
+                 sqlite_where=db.text('recurring_id IS NOT NULL'),
+                 postgresql_where=db.text('recurring_id IS NOT NULL')),
+    )
 
     def __repr__(self):
         return f"Expense('{self.amount}', '{self.date}', '{self.category.name}')"
+
+class RecurringExpense(MoneyMixin, db.Model):
+    # A rule such as "rent on the 1st of every month"; app.recurring turns due
+    # occurrences into Expense rows
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False)
+    category = db.relationship('Category')
+    description = db.Column(db.String(200), nullable=True)
+    frequency = db.Column(db.String(10), nullable=False) # monthly, weekly or daily
+    interval = db.Column(db.Integer, nullable=False, default=1) # Every N months, weeks or days
+    start_date = db.Column(db.Date, nullable=False)
+    end_date = db.Column(db.Date, nullable=True) # Last day an occurrence may fall on
+    # High-water mark: occurrences 0..materialized-1 have been written as
+    # expenses, and next_due is the date of the next one (NULL once the rule
+    # has ended)
+    materialized = db.Column(db.Integer, nullable=False, default=0)
+    next_due = db.Column(db.Date, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_recurring_next_due', 'next_due'),
+        db.Index('ix_recurring_user_next_due', 'user_id', 'next_due'),
+    )
+
+    def __repr__(self):
+        return f"RecurringExpense('{self.amount}', '{self.frequency}', '{self.start_date}')"
+
+class Group(db.Model):
+    # A shared ledger (household, flatmates); see app.groups
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    members = db.relationship('GroupMember', backref='group', lazy=True)
+
+    def __repr__(self):
+        return f"Group('{self.name}')"
+
+class GroupMember(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    group_id = db.Column(db.Integer, db.ForeignKey('group.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user = db.relationship('User')
+    role = db.Column(db.String(10), nullable=False, default='member', server_default='member') # owner, member or viewer
+    joined_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ux_group_member', 'group_id', 'user_id', unique=True),
+        db.Index('ix_group_member_user', 'user_id'),
+    )
+
+    def __repr__(self):
+        return f"GroupMember('{self.group_id}', '{self.user_id}', '{self.role}')"
+
+class SharedExpense(MoneyMixin, db.Model):
+    # An expense paid by one member and split between several
+    id = db.Column(db.Integer, primary_key=True)
+    group_id = db.Column(db.Integer, db.ForeignKey('group.id'), nullable=False)
+    paid_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    description = db.Column(db.String(200), nullable=False)
+    date = db.Column(db.DateTime, default=datetime.utcnow)
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=True)
+    splits = db.relationship('ExpenseSplit', backref='shared_expense', lazy=True, cascade='all, delete-orphan')
+
+    __table_args__ = (
+        db.Index('ix_shared_expense_group_date', 'group_id', 'date'),
+        db.Index('ix_shared_expense_group_payer', 'group_id', 'paid_by', 'amount_cents'),
+    )
+
+    def __repr__(self):
+        return f"SharedExpense('{self.amount}', '{self.description}')"
+
+class ExpenseSplit(db.Model):
+    # One member's share of a SharedExpense; the shares add up to its amount
+    id = db.Column(db.Integer, primary_key=True)
+    shared_expense_id = db.Column(db.Integer, db.ForeignKey('shared_expense.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    owed_cents = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index('ux_expense_split', 'shared_expense_id', 'user_id', unique=True),
+        db.Index('ix_expense_split_user', 'user_id', 'shared_expense_id'),
+    )
+
+    @property
+    def owed(self):
+        return money.from_minor(self.owed_cents)
+
+    def __repr__(self):
+        return f"ExpenseSplit('{self.user_id}', '{self.owed}')"
+
+class GroupBudget(MoneyMixin, db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    group_id = db.Column(db.Integer, db.ForeignKey('group.id'), nullable=False)
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False)
+    month = db.Column(db.Integer, nullable=False) # 1-12
+    year = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index('ux_group_budget_period_category', 'group_id', 'year', 'month', 'category_id', unique=True),
+    )
+
+    def __repr__(self):
+        return f"GroupBudget('{self.amount}', '{self.month}/{self.year}')"
+
+class MonthlySpend(db.Model):
+    # Rollup of Expense totals per user, category and month, maintained by
+    # app.rollup on every write so reads don't have to re-sum raw expenses
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), primary_key=True)
+    year = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.Integer, primary_key=True)
+    total_cents = db.Column(db.Integer, nullable=False, default=0)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    @property
+    def total(self):
+        return money.from_minor(self.total_cents)
+
+    def __repr__(self):
+        return f"MonthlySpend('{self.month}/{self.year}', '{self.total}', '{self.count}')"
+
+class ReportJob(db.Model):
+    # A report generated off-request by app.jobs; the file lives on disk until expires_at
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    kind = db.Column(db.String(30), nullable=False)
+    format = db.Column(db.String(10), nullable=False)
+    params = db.Column(db.Text, nullable=False) # JSON
+    # Set while the job is queued, running or has a live result, so identical
+    # requests find it; unique, so concurrent identical requests cannot both insert
+    dedupe_key = db.Column(db.String(40), unique=True, nullable=True)
+    status = db.Column(db.String(10), nullable=False, default='queued')
+    error = db.Column(db.Text, nullable=True)
+    path = db.Column(db.String(500), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    expires_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_report_job_status', 'status'),
+    )
+
+    def __repr__(self):
+        return f"ReportJob('{self.id}', '{self.kind}', '{self.format}', '{self.status}')"
+
+class ApiToken(db.Model):
+    # A bearer token for the JSON API (app.api); only its SHA-256 is stored
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    name = db.Column(db.String(100), nullable=True) # e.g. the device it was issued to
+    token_hash = db.Column(db.String(64), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ux_api_token_hash', 'token_hash', unique=True),
+        db.Index('ix_api_token_user', 'user_id'),
+    )
+
+    def __repr__(self):
+        return f"ApiToken('{self.id}', '{self.name}')"
+
+class ChangeLog(db.Model):
+    # One row per insert, update or delete of an expense, budget or category,
+    # written by database triggers (app.changes) for the API's delta sync
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=True) # NULL for the shared default categories
+    entity = db.Column(db.String(20), nullable=False) # The table name
+    entity_id = db.Column(db.Integer, nullable=False)
+    deleted = db.Column(db.Boolean, nullable=False, default=False)
+    changed_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
+
+    __table_args__ = (
+        db.Index('ix_change_log_user', 'user_id', 'id'),
+        # Ids are never reused, so a client's cursor cannot skip a change
+        {'sqlite_autoincrement': True},
+    )
+
+    def __repr__(self):
+        return f"ChangeLog('{self.id}', '{self.entity}', '{self.entity_id}')"
+
+class ArchivePartition(db.Model):
+    # A year of expenses moved out of the expense table into its own
+    # database by app.archive; the rollup keeps their totals
+    year = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    filename = db.Column(db.String(100), nullable=False) # In ARCHIVE_DIR
+    row_count = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"ArchivePartition('{self.year}', '{self.row_count}')"
+
+class ArchiveBatch(db.Model):
+    # One batch of a user's expenses moved by app.archive; moved is set in
+    # the transaction that deletes them from the expense table
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    moved = db.Column(db.Boolean, nullable=False, default=False)
+    row_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_archive_batch_user', 'user_id'),
+        {'sqlite_autoincrement': True},
+    )
+
+    def __repr__(self):
+        return f"ArchiveBatch('{self.id}', '{self.moved}')"
@@ -0,0 +1,37 @@
+from decimal import Decimal, ROUND_HALF_UP
+
+# Amounts are stored as integers in the currency's minor unit (cents for
+# USD), so sums are exact; Decimal is used wherever they are shown or entered.
+DEFAULT_CURRENCY = 'USD'
+
+# ISO 4217 currencies whose minor unit is not a hundredth
+_EXPONENTS = {
+    'BHD': 3, 'CLP': 0, 'ISK': 0, 'JOD': 3, 'JPY': 0, 'KRW': 0, 'KWD': 3, 'OMR': 3, 'TND': 3, 'VND': 0
+}
+_SYMBOLS = {'USD': '$', 'EUR': '€', 'GBP': '£', 'JPY': '¥', 'INR': '₹'}
+
+
+def exponent(currency=DEFAULT_CURRENCY):
+    return _EXPONENTS.get(currency, 2)
+
+
+def to_minor(amount, currency=DEFAULT_CURRENCY):
+    """Integer minor units for an amount in major units (Decimal, str, int or float),
+    rounded half up"""
+    if isinstance(amount, float):
+        amount = repr(amount) # Shortest repr, so 0.29 is not 0.28999...
+    value = Decimal(amount).scaleb(exponent(currency))
+    return int(value.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def from_minor(minor, currency=DEFAULT_CURRENCY):
+    """Exact Decimal in major units, e.g. 1250 -> Decimal('12.50')"""
+    return Decimal(int(minor or 0)).scaleb(-exponent(currency))
+
+
+def format_money(amount, currency=DEFAULT_CURRENCY):
+    """Template filter: '$12.50' for Decimal('12.5'), or 'CHF 12.50' without a known symbol"""
+    value = from_minor(to_minor(amount, currency), currency)
+    sign = '-' if value < 0 else ''
+    symbol = _SYMBOLS.get(currency)
+    return f'{sign}{symbol}{abs(value):,}' if symbol else f'{sign}{currency} {abs(value):,}'
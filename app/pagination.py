@@ -0,0 +1,80 @@
+import base64
+import json
+from datetime import datetime
+from sqlalchemy import tuple_
+
+# Cursor directions: 'after' fetches the next (older) page, 'before' the
+# previous (newer) one
+AFTER = 'after'
+BEFORE = 'before'
+
+
+def encode_cursor(date, id, direction):
+    """Opaque token for the page after/before the row at (date, id)"""
+    payload = json.dumps([date.isoformat(), id, direction], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """Inverse of encode_cursor; raises ValueError for a malformed token"""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        date, id, direction = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if direction not in (AFTER, BEFORE):
+            raise ValueError(direction)
+        return datetime.fromisoformat(date), int(id), direction
+    except (TypeError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f'Invalid cursor: {token}') from e
+
+
+class KeysetPage:
+    def __init__(self, items, per_page, has_next, has_prev, total=None):
+        self.items = items
+        self.per_page = per_page
+        self.has_next = has_next
+        self.has_prev = has_prev
+        self.total = total
+
+    @property
+    def next_cursor(self):
+        if self.has_next and self.items:
+            last = self.items[-1]
+            return encode_cursor(last.date, last.id, AFTER)
+
+    @property
+    def prev_cursor(self):
+        if self.has_prev and self.items:
+            first = self.items[0]
+            return encode_cursor(first.date, first.id, BEFORE)
+
+
+def keyset_paginate(query, model, cursor=None, per_page=20, total=None):
+    """Page through query newest first, seeking on (model.date, model.id).
+
+    Unlike OFFSET pagination every page costs the same: the cursor is
+    turned into a range condition the (user_id, date) index can seek to,
+    and no COUNT(*) is issued. Pass total if a cached count is available.
+    """
+    key = tuple_(model.date, model.id)
+    direction = AFTER
+    if cursor:
+        date, id, direction = decode_cursor(cursor)
+        if direction == AFTER:
+            query = query.filter(key < tuple_(date, id))
+        else:
+            query = query.filter(key > tuple_(date, id))
+
+    if direction == AFTER:
+        query = query.order_by(model.date.desc(), model.id.desc())
+    else:
+        query = query.order_by(model.date.asc(), model.id.asc())
+
+    # One extra row tells us whether there is another page in this direction
+    rows = query.limit(per_page + 1).all()
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+
+    if direction == AFTER:
+        return KeysetPage(rows, per_page, has_next=more, has_prev=cursor is not None, total=total)
+    rows.reverse()
+    return KeysetPage(rows, per_page, has_next=True, has_prev=more, total=total)
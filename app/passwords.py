@@ -0,0 +1,97 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from werkzeug.exceptions import ServiceUnavailable
+from app import bcrypt
+
+# Hashes queued or running per hashing process before further ones are refused
+QUEUE_PER_WORKER = 2
+# Hashing processes run at a lower scheduling priority, so on a busy host
+# the CPU goes to serving pages first and logins absorb the slowdown
+DEFAULT_NICE = 10
+
+
+class HashQueueFull(ServiceUnavailable):
+    """Every hashing slot is taken"""
+    description = 'The server is busy. Please try again in a moment.'
+
+
+def _lower_priority(increment):
+    if increment and hasattr(os, 'nice'):
+        os.nice(increment)
+
+
+class PasswordHasher:
+    """Runs bcrypt on a process pool instead of the request thread.
+
+    A request waiting on its hash holds no CPU or GIL, so other requests in
+    the same worker keep being served during a login surge. At most
+    PASSWORD_HASH_QUEUE hashes per server process are queued or running, and
+    requests beyond that fail straight away with 503 - waiting for a slot
+    would tie up the server threads other pages need.
+    PASSWORD_HASH_WORKERS = 0 hashes on the request thread.
+    """
+
+    def __init__(self):
+        self.workers = 0
+        self.log_rounds = 12
+        self.nice = DEFAULT_NICE
+        self._slots = threading.BoundedSemaphore(QUEUE_PER_WORKER)
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        config = app.config
+        workers = config.setdefault('PASSWORD_HASH_WORKERS', os.cpu_count() or 1)
+        queue_size = config.get('PASSWORD_HASH_QUEUE') or QUEUE_PER_WORKER * max(workers, 1)
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self.log_rounds = config.get('BCRYPT_LOG_ROUNDS', 12)
+        self.nice = config.setdefault('PASSWORD_HASH_NICE', DEFAULT_NICE)
+        if workers != self.workers:
+            self.shutdown()
+            self.workers = workers
+
+    def _pool(self):
+        with self._lock:
+            # A pool inherited from the parent of a forked server worker is unusable
+            if self._executor is None or self._pid != os.getpid():
+                # spawn rather than fork: forking a threaded server process can
+                # copy locks held by other threads into the children
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                                     initializer=_lower_priority, initargs=(self.nice,))
+                self._pid = os.getpid()
+            return self._executor
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+        if not self._slots.acquire(blocking=False):
+            raise HashQueueFull(retry_after=1)
+        try:
+            return self._pool().submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(bcrypt.generate_password_hash, password).decode('utf-8')
+
+    def check(self, pw_hash, password):
+        return self._run(bcrypt.check_password_hash, pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        """Whether pw_hash was made with a cost factor other than BCRYPT_LOG_ROUNDS"""
+        try:
+            return int(pw_hash.split('$')[2]) != self.log_rounds
+        except (IndexError, ValueError):
+            return True
+
+
+hasher = PasswordHasher()
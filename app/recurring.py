@@ -0,0 +1,210 @@
+"""Recurring expenses.
+
+A RecurringExpense is a rule; its occurrences are numbered from 0 at
+start_date. materialize_due() writes every occurrence that has come due as
+an Expense row and advances the rule's high-water mark (materialized and
+next_due) in the same transaction. A rule is claimed with a conditional
+UPDATE on its old mark, so concurrent runs (cron, several server processes)
+never write an occurrence twice, and an occurrence the user deleted is not
+brought back. Rows go in with app.bulk, in batches like the importer's.
+
+Occurrences that are not yet due are never stored: committed_spend() works
+them out from the rules for the dashboard projections, which are cached
+with the rest of the dashboard.
+"""
+import calendar
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+import click
+from flask.cli import with_appcontext
+from flask_sqlalchemy.session import Session
+from sqlalchemy import bindparam, event, update
+from app import db, bulk
+from app.cache import touch
+from app.models import RecurringExpense
+
+log = logging.getLogger(__name__)
+
+FREQUENCIES = ('monthly', 'weekly', 'daily')
+# Rules claimed per transaction, and rows per insert statement
+RULES_PER_BATCH = 500
+BATCH_SIZE = 10000
+
+
+def _add_months(day, months):
+    month0 = day.month - 1 + months
+    year, month = day.year + month0 // 12, month0 % 12 + 1
+    # The 31st falls on the last day of shorter months
+    return date(year, month, min(day.day, calendar.monthrange(year, month)[1]))
+
+
+def occurrence(rule, n):
+    """Date of the rule's n-th occurrence (counting from 0), ignoring end_date"""
+    if rule.frequency == 'monthly':
+        # Counted from start_date each time, so a rule starting on the 31st
+        # is back on the 31st after February
+        return _add_months(rule.start_date, n * rule.interval)
+    days = 7 if rule.frequency == 'weekly' else 1
+    return rule.start_date + timedelta(days=n * rule.interval * days)
+
+
+def _due_date(rule, n):
+    day = occurrence(rule, n)
+    return day if rule.end_date is None or day <= rule.end_date else None
+
+
+def reset(rule):
+    """Point a new or edited rule's high-water mark at its first occurrence"""
+    rule.materialized = 0
+    rule.next_due = _due_date(rule, 0)
+
+
+def _pending(rule, until):
+    """(n, date) of the unmaterialized occurrences on or before until"""
+    n = rule.materialized
+    day = rule.next_due
+    while day is not None and day <= until:
+        yield n, day
+        n += 1
+        day = _due_date(rule, n)
+
+
+# Advances a rule's mark only if no one else has moved it since it was read
+_CLAIM = update(RecurringExpense.__table__).where(
+    RecurringExpense.__table__.c.id == bindparam('rule_id'),
+    RecurringExpense.__table__.c.materialized == bindparam('old')
+).values(materialized=bindparam('new'), next_due=bindparam('new_due'))
+
+
+def _insert(mappings):
+    for i in range(0, len(mappings), BATCH_SIZE):
+        bulk.insert_expenses(mappings[i:i + BATCH_SIZE])
+
+
+def materialize(rules, until=None):
+    """Write the occurrences of rules due on or before until (today); returns the number written"""
+    until = until or date.today()
+    claims, mappings = [], []
+    for rule in rules:
+        pending = list(_pending(rule, until))
+        if not pending:
+            continue
+        new = rule.materialized + len(pending)
+        claims.append({'rule_id': rule.id, 'old': rule.materialized, 'new': new, 'new_due': _due_date(rule, new)})
+        mappings.extend({
+            'amount_cents': rule.amount_cents,
+            'currency': rule.currency,
+            'date': datetime.combine(day, datetime.min.time()),
+            'description': rule.description,
+            'user_id': rule.user_id,
+            'category_id': rule.category_id,
+            'recurring_id': rule.id
+        } for n, day in pending)
+    if not claims:
+        return 0
+
+    connection = db.session.connection()
+    # All claims go in one executemany where the driver reports its total
+    # rowcount; if any claim lost a race, retry the rules one at a time
+    # (rolling back reloads them with the winner's mark)
+    if len(claims) > 1 and not connection.dialect.supports_sane_multi_rowcount:
+        return sum(materialize([rule], until) for rule in rules)
+    if connection.execute(_CLAIM, claims).rowcount != len(claims):
+        db.session.rollback()
+        return 0 if len(rules) == 1 else sum(materialize([rule], until) for rule in rules)
+    _insert(mappings)
+    db.session.commit()
+    return len(mappings)
+
+
+def materialize_due(until=None, rules_per_batch=RULES_PER_BATCH):
+    """Materialize every rule that has come due, committing per batch of rules"""
+    until = until or date.today()
+    written = 0
+    last_id = 0
+    while True:
+        rules = RecurringExpense.query.filter(
+            RecurringExpense.next_due <= until, RecurringExpense.id > last_id
+        ).order_by(RecurringExpense.id).limit(rules_per_batch).all()
+        if not rules:
+            return written
+        last_id = rules[-1].id
+        written += materialize(rules, until)
+
+
+def committed_spend(user_id, year, month):
+    """Amount in cents per category of the user's occurrences in a month that
+    have not been written as expenses yet"""
+    start = date(year, month, 1)
+    end = _add_months(start, 1)
+    totals = defaultdict(int)
+    rules = RecurringExpense.query.filter(
+        RecurringExpense.user_id == user_id,
+        RecurringExpense.next_due < end
+    )
+    for rule in rules:
+        for n, day in _pending(rule, end - timedelta(days=1)):
+            if day >= start:
+                totals[rule.category_id] += rule.amount_cents
+    return totals
+
+
+@event.listens_for(Session, 'after_flush')
+def _record_rule_writes(session, flush_context):
+    # Projections are part of the cached dashboard, which is only ever shown
+    # for the current month; drop it whenever a rule changes
+    today = date.today()
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, RecurringExpense):
+            touch(session, obj.user_id, today.year, today.month)
+
+
+class Scheduler:
+    """Runs materialize_due() every RECURRING_INTERVAL seconds in a daemon
+    thread of each server process (0, the default, leaves it to cron)"""
+
+    def __init__(self, app):
+        self.app = app
+        self.interval = app.config.setdefault('RECURRING_INTERVAL', 0)
+        self._pid = None
+        self._lock = threading.Lock()
+        if self.interval:
+            app.before_request(self.ensure_started)
+
+    def ensure_started(self):
+        # Started on the first request rather than at import, as threads
+        # do not survive gunicorn forking its workers
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self._loop, name='recurring-scheduler', daemon=True).start()
+
+    def _loop(self):
+        while True:
+            with self.app.app_context():
+                try:
+                    written = materialize_due()
+                    if written:
+                        log.info('Materialized %s recurring expenses', written)
+                except Exception:
+                    log.exception('Materializing recurring expenses failed')
+                    db.session.rollback()
+            time.sleep(self.interval)
+
+
+def init_app(app):
+    app.extensions['recurring'] = Scheduler(app)
+
+
+@click.command('recurring-run')
+@click.option('--until', type=click.DateTime(formats=['%Y-%m-%d']), help='Materialize up to this date (default today).')
+@with_appcontext
+def run_command(until):
+    """Write recurring expenses that have come due (run from cron)."""
+    written = materialize_due(until.date() if until else None)
+    click.echo(f'Materialized {written} recurring expenses.')
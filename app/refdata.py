@@ -0,0 +1,196 @@
+import time
+import uuid
+from datetime import datetime
+from collections import namedtuple
+from flask import current_app, session as flask_session
+from flask_login import user_logged_out
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, or_, select, update
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from app import db
+from app.cache import cache, touch, LRUBackend
+from app.models import User, Category
+
+CategoryRef = namedtuple('CategoryRef', ['id', 'name'])
+# A category in a user's tree: label is the name with its ancestors
+# ('Food / Groceries') and depth is 0 for top-level categories
+CategoryNode = namedtuple('CategoryNode', ['id', 'name', 'parent_id', 'path', 'depth', 'label'])
+
+# Shared tokens identifying the current version of the default categories
+# and of each user's own. Any write replaces the token, so every worker
+# sharing the cache backend reloads its copy on the next request; the long
+# timeout just bounds an idle entry. They go straight to the backend to keep
+# the result cache hit rates meaningful.
+CATEGORY_VERSION_KEY = 'refdata:categories:version'
+VERSION_TIMEOUT = 24 * 60 * 60
+# Users whose category trees are kept in each process
+DEFAULT_TREE_CACHE_SIZE = 1024
+
+SNAPSHOT_KEY = '_user_snapshot'
+
+
+def _version_key(user_id):
+    return CATEGORY_VERSION_KEY if user_id is None else f'{CATEGORY_VERSION_KEY}:{user_id}'
+
+
+def _version(user_id=None):
+    entry = cache.backend.get(_version_key(user_id))
+    return entry[1] if entry is not None else bump_category_version(user_id)
+
+
+def category_version(user_id=None):
+    """Token that changes whenever the default categories (or, given a user,
+    that user's categories) are written"""
+    return _version() if user_id is None else f'{_version()}:{_version(user_id)}'
+
+
+def bump_category_version(user_id=None):
+    version = uuid.uuid4().hex
+    cache.backend.set(_version_key(user_id), version, VERSION_TIMEOUT)
+    return version
+
+
+def _local():
+    local = current_app.extensions.get('refdata')
+    if local is None:
+        size = current_app.config.get('CATEGORY_TREE_CACHE_SIZE', DEFAULT_TREE_CACHE_SIZE)
+        local = current_app.extensions['refdata'] = {'trees': LRUBackend(size)}
+    return local
+
+
+def categories(user_id=None):
+    """The default categories as (id, name) tuples, ordered by id; given a
+    user, their whole tree (see category_tree) in tree order.
+
+    Kept in process memory and only reloaded from the database when the
+    shared version token changes, so most requests issue no query for them.
+    """
+    if user_id is not None:
+        return [CategoryRef(node.id, node.name) for node in category_tree(user_id)]
+    local = _local()
+    version = _version()
+    if local.get('category_version') != version:
+        local['categories'] = [CategoryRef(id, name) for id, name in db.session.query(Category.id, Category.name)
+                               .filter(Category.user_id.is_(None)).order_by(Category.id)]
+        local['category_version'] = version
+    return local['categories']
+
+
+def _build_tree(rows):
+    """Depth-first order, children after their parent, siblings by id"""
+    children = {}
+    for row in rows:
+        children.setdefault(row.parent_id, []).append(row)
+    nodes = []
+
+    def visit(parent_id, prefix):
+        for row in sorted(children.get(parent_id, ()), key=lambda r: r.id):
+            label = f'{prefix}{row.name}'
+            nodes.append(CategoryNode(row.id, row.name, row.parent_id, row.path, row.path.count('/') - 2, label))
+            visit(row.id, f'{label} / ')
+    visit(None, '')
+    return nodes
+
+
+def category_tree(user_id):
+    """The default categories and the user's own as CategoryNodes, in tree order.
+
+    Each process keeps the trees of its recently active users in an LRU,
+    checked against the version tokens on every lookup.
+    """
+    version = category_version(user_id)
+    trees = _local()['trees']
+    entry = trees.get(user_id)
+    if entry is not None and entry[1][0] == version:
+        return entry[1][1]
+    rows = db.session.query(Category.id, Category.name, Category.parent_id, Category.path).filter(
+        or_(Category.user_id.is_(None), Category.user_id == user_id)
+    ).all()
+    nodes = _build_tree(rows)
+    trees.set(user_id, (version, nodes), VERSION_TIMEOUT)
+    return nodes
+
+
+def category_names(user_id=None):
+    """Category id to name map; with a user, names include their ancestors"""
+    if user_id is None:
+        return {c.id: c.name for c in categories()}
+    return {node.id: node.label for node in category_tree(user_id)}
+
+
+def category_choices(user_id=None):
+    """Choices for a category SelectField, indented to show the tree"""
+    if user_id is None:
+        return [(c.id, c.name) for c in categories()]
+    return [(node.id, '\u2014 ' * node.depth + node.name) for node in category_tree(user_id)]
+
+
+def subtree_ids(user_id, category_id):
+    """Ids of a category in the user's tree and all of its descendants"""
+    tree = category_tree(user_id)
+    root = next((node for node in tree if node.id == category_id), None)
+    if root is None:
+        return [category_id]
+    return [node.id for node in tree if node.path.startswith(root.path)]
+
+
+@event.listens_for(Category, 'after_insert')
+def _set_path(mapper, connection, target):
+    # The path needs the new row's id, so it is written right after the INSERT
+    parent_path = '/'
+    if target.parent_id is not None:
+        parent_path = connection.execute(select(Category.path).where(Category.id == target.parent_id)).scalar_one()
+    path = f'{parent_path}{target.id}/'
+    connection.execute(update(Category.__table__).where(Category.__table__.c.id == target.id).values(path=path))
+    set_committed_value(target, 'path', path)
+
+
+@event.listens_for(Session, 'after_flush')
+def _record_category_writes(session, flush_context):
+    owners = {obj.user_id for obj in session.new | session.dirty | session.deleted if isinstance(obj, Category)}
+    if owners:
+        session.info.setdefault('categories_changed', set()).update(owners)
+        # The user's dashboard lists their categories
+        today = datetime.now()
+        for user_id in owners - {None}:
+            touch(session, user_id, today.year, today.month)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_categories(session):
+    for user_id in session.info.pop('categories_changed', ()):
+        # A default category is part of every user's tree
+        bump_category_version(user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_category_writes(session):
+    session.info.pop('categories_changed', None)
+
+
+def load_user(user_id):
+    """User loader that can skip the database for recently seen users.
+
+    With USER_SNAPSHOT_TTL set, the user's id, username and email are kept in
+    the signed session cookie for that many seconds and the User is rebuilt
+    from it without a query; other attributes still load on first access.
+    """
+    user_id = int(user_id)
+    ttl = current_app.config.get('USER_SNAPSHOT_TTL')
+    snapshot = flask_session.get(SNAPSHOT_KEY)
+    if ttl and snapshot and snapshot['id'] == user_id and time.time() - snapshot['at'] < ttl:
+        user = User(id=user_id, username=snapshot['username'], email=snapshot['email'])
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    user = db.session.get(User, user_id)
+    if user is not None and ttl:
+        flask_session[SNAPSHOT_KEY] = {'id': user.id, 'username': user.username, 'email': user.email,
+                                       'at': time.time()}
+    return user
+
+
+@user_logged_out.connect
+def _drop_snapshot(sender, user, **extra):
+    flask_session.pop(SNAPSHOT_KEY, None)
@@ -0,0 +1,273 @@
+from collections import defaultdict
+from datetime import datetime
+import click
+from flask.cli import with_appcontext
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, func, inspect, select, delete, insert
+from sqlalchemy.dialects import postgresql, sqlite
+from app import db, archive, database
+from app.cache import cache, touch
+from app.money import from_minor
+from app.models import Expense, MonthlySpend
+
+_TRACKED = ('amount_cents', 'date', 'user_id', 'category_id')
+# Expense ids per IN list when re-reading the rows of a bulk UPDATE
+ID_CHUNK = 5000
+
+# The legacy bulk_* methods would skip the hooks below
+database.STATEMENT_ONLY.add(Expense)
+
+
+def _keep_old_value(target, value, oldvalue, initiator):
+    pass
+
+
+# Make changes to expired expenses load the previous value first, so an edit
+# can be moved out of the month/category it was previously counted in
+for _attr in _TRACKED:
+    event.listen(getattr(Expense, _attr), 'set', _keep_old_value, active_history=True)
+
+
+def _key(user_id, category_id, date):
+    return (user_id, category_id, date.year, date.month)
+
+
+def _committed(expense, attr):
+    """Value of an attribute as currently stored in the database"""
+    history = inspect(expense).attrs[attr].history
+    if history.deleted:
+        return history.deleted[0]
+    if history.unchanged:
+        return history.unchanged[0]
+    return getattr(expense, attr)
+
+
+def _flush_deltas(session):
+    deltas = defaultdict(lambda: [0, 0])
+
+    def add(values, sign):
+        delta = deltas[_key(values['user_id'], values['category_id'], values['date'])]
+        delta[0] += sign * values['amount_cents']
+        delta[1] += sign
+
+    def current(expense):
+        return {attr: getattr(expense, attr) for attr in _TRACKED}
+
+    def committed(expense):
+        return {attr: _committed(expense, attr) for attr in _TRACKED}
+
+    for obj in session.new:
+        if isinstance(obj, Expense):
+            add(current(obj), 1)
+    for obj in session.deleted:
+        if isinstance(obj, Expense):
+            add(committed(obj), -1)
+    for obj in session.dirty:
+        if isinstance(obj, Expense) and obj not in session.deleted:
+            state = inspect(obj)
+            if any(state.attrs[attr].history.has_changes() for attr in _TRACKED):
+                add(committed(obj), -1)
+                add(current(obj), 1)
+    return deltas
+
+
+def _upsert(dialect_name):
+    insert_fn = postgresql.insert if dialect_name == 'postgresql' else sqlite.insert
+    stmt = insert_fn(MonthlySpend)
+    return stmt.on_conflict_do_update(
+        index_elements=['user_id', 'category_id', 'year', 'month'],
+        set_={
+            'total_cents': MonthlySpend.total_cents + stmt.excluded.total_cents,
+            'count': MonthlySpend.count + stmt.excluded.count
+        }
+    )
+
+
+def apply_deltas(session, deltas):
+    """Add {(user_id, category_id, year, month): (total_cents, count)} deltas to the rollup.
+
+    The touched months are recorded so cached results for them are dropped
+    when the session commits.
+    """
+    rows = [
+        {'user_id': user_id, 'category_id': category_id, 'year': year, 'month': month,
+         'total_cents': total, 'count': count}
+        for (user_id, category_id, year, month), (total, count) in deltas.items()
+        if count or total
+    ]
+    if rows:
+        connection = session.connection()
+        connection.execute(_upsert(connection.dialect.name), rows)
+        for row in rows:
+            touch(session, row['user_id'], row['year'], row['month'])
+
+
+def deltas_for_mappings(mappings, sign=1):
+    """Rollup deltas for a batch of expense column mappings (bulk inserts)"""
+    deltas = defaultdict(lambda: [0, 0])
+    for row in mappings:
+        date = row.get('date') or datetime.utcnow()
+        delta = deltas[_key(row['user_id'], row['category_id'], date)]
+        delta[0] += sign * row['amount_cents']
+        delta[1] += sign
+    return deltas
+
+
+@event.listens_for(Session, 'after_flush')
+def _after_flush(session, flush_context):
+    # new/dirty/deleted still describe the flush that just ran, and the
+    # rollup is written on the same connection so it commits or rolls back
+    # together with the expenses themselves
+    deltas = _flush_deltas(session)
+    if deltas:
+        apply_deltas(session, deltas)
+
+
+def _is_expense_statement(orm_execute_state):
+    mapper = orm_execute_state.bind_mapper
+    return mapper is not None and mapper.class_ is Expense
+
+
+def _updated_columns(orm_execute_state):
+    statement = orm_execute_state.statement
+    columns = {getattr(key, 'key', key) for key in statement._values or ()}
+    params = orm_execute_state.parameters
+    for row in params if isinstance(params, list) else [params] if params else []:
+        columns.update(row)
+    return columns
+
+
+def _add_totals(session, deltas, ids, sign):
+    for i in range(0, len(ids), ID_CHUNK):
+        grouped = _grouped_expenses(Expense.id.in_(ids[i:i + ID_CHUNK]))
+        for user_id, category_id, year, month, total, count in session.execute(grouped):
+            delta = deltas[(user_id, category_id, int(year), int(month))]
+            delta[0] += sign * total
+            delta[1] += sign * count
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _bulk_execute(orm_execute_state):
+    # Bulk INSERT/UPDATE/DELETE statements bypass the unit of work, so
+    # account for them here
+    if not _is_expense_statement(orm_execute_state):
+        return
+    session = orm_execute_state.session
+    if orm_execute_state.is_insert:
+        params = orm_execute_state.parameters
+        mappings = params if isinstance(params, list) else [params] if params else []
+        if mappings and all('amount_cents' in row for row in mappings):
+            apply_deltas(session, deltas_for_mappings(mappings))
+    elif orm_execute_state.is_update:
+        if not _updated_columns(orm_execute_state) & set(_TRACKED):
+            return
+        # Take the rows out of the rollup as they were and add them back as
+        # they are. They are found by id, since the update may change what
+        # the WHERE clause matches.
+        params = orm_execute_state.parameters
+        if isinstance(params, list):
+            ids = [row['id'] for row in params] # Bulk UPDATE by primary key
+        else:
+            query = select(Expense.id)
+            if orm_execute_state.statement.whereclause is not None:
+                query = query.where(orm_execute_state.statement.whereclause)
+            ids = session.execute(query, params or {}).scalars().all()
+        deltas = defaultdict(lambda: [0, 0])
+        _add_totals(session, deltas, ids, -1)
+        result = orm_execute_state.invoke_statement()
+        _add_totals(session, deltas, ids, 1)
+        apply_deltas(session, deltas)
+        return result
+    elif orm_execute_state.is_delete:
+        # Sum up the rows about to be deleted before they are gone
+        deltas = {}
+        grouped = _grouped_expenses(orm_execute_state.statement.whereclause)
+        for user_id, category_id, year, month, total, count in session.execute(grouped):
+            deltas[(user_id, category_id, int(year), int(month))] = (-total, -count)
+        apply_deltas(session, deltas)
+
+
+def _grouped_expenses(where=None):
+    year = func.extract('year', Expense.date)
+    month = func.extract('month', Expense.date)
+    query = select(
+        Expense.user_id, Expense.category_id, year, month,
+        func.sum(Expense.amount_cents), func.count(Expense.id)
+    ).group_by(Expense.user_id, Expense.category_id, year, month)
+    if where is not None:
+        query = query.where(where)
+    return query
+
+
+def _archived_totals(connection=None):
+    """{(user_id, category_id, year, month): [total_cents, count]} of the archives"""
+    totals = defaultdict(lambda: [0, 0])
+    for result in archive.results(_grouped_expenses(), connection=connection):
+        for user_id, category_id, year, month, total, count in result:
+            key = (user_id, category_id, int(year), int(month))
+            totals[key][0] += total
+            totals[key][1] += count
+    return totals
+
+
+def rebuild(connection=None):
+    """Recompute the whole rollup from the expense table and the archives.
+
+    Runs on the given connection (as migrations do) or on db.session, in
+    which case the rebuild is committed.
+    """
+    target = connection if connection is not None else db.session.connection()
+    target.execute(delete(MonthlySpend))
+    target.execute(insert(MonthlySpend).from_select(
+        ['user_id', 'category_id', 'year', 'month', 'total_cents', 'count'], _grouped_expenses()
+    ))
+    archived = [
+        {'user_id': user_id, 'category_id': category_id, 'year': year, 'month': month,
+         'total_cents': total, 'count': count}
+        for (user_id, category_id, year, month), (total, count) in _archived_totals(target).items()
+    ]
+    if archived:
+        target.execute(_upsert(target.dialect.name), archived)
+    if connection is None:
+        db.session.commit()
+        cache.clear()
+
+
+def verify():
+    """Compare the rollup with the expense table and the archives.
+
+    Returns a list of (user_id, category_id, year, month, expected, actual)
+    tuples, where expected and actual are (total_cents, count) pairs. Totals
+    are integers, so any difference at all is drift.
+    """
+    expected = _archived_totals()
+    for user_id, category_id, year, month, total, count in db.session.execute(_grouped_expenses()):
+        key = (user_id, category_id, int(year), int(month))
+        expected[key][0] += total
+        expected[key][1] += count
+    expected = {key: tuple(value) for key, value in expected.items()}
+    actual = {
+        (r.user_id, r.category_id, r.year, r.month): (r.total_cents, r.count)
+        for r in MonthlySpend.query.filter(MonthlySpend.count != 0)
+    }
+    drift = []
+    for key in sorted(set(expected) | set(actual)):
+        want, have = expected.get(key, (0, 0)), actual.get(key, (0, 0))
+        if want != have:
+            drift.append(key + (want, have))
+    return drift
+
+
+@click.command('rollup')
+@click.option('--verify-only', is_flag=True, help='Report drift without rebuilding.')
+@with_appcontext
+def rollup_command(verify_only):
+    """Verify the monthly spending rollup and rebuild it from expenses."""
+    drift = verify()
+    for user_id, category_id, year, month, want, have in drift:
+        click.echo(f'user {user_id} category {category_id} {month}/{year}: '
+                   f'expected {from_minor(want[0])} ({want[1]} expenses), found {from_minor(have[0])} ({have[1]})')
+    click.echo(f'{len(drift)} rollup rows drifted.')
+    if not verify_only:
+        rebuild()
+        click.echo('Rollup rebuilt.')
@@ -1,79 +1,40 @@
-from flask import render_template, url_for, flash, redirect, request, Blueprint, make_response
-from app import db, bcrypt
-from app.forms import RegistrationForm, LoginForm, ExpenseForm, BudgetForm
-from app.models import User, Expense, Category, Budget
+from flask import (render_template, url_for, flash, redirect, request, Blueprint, make_response,
+                   Response, stream_with_context, abort, current_app, jsonify, send_file)
+from app import (db, aggregates, analytics, database, exports, groups, importer, jobs, pagination, recurring,
+                 refdata, search, throttle)
+from app.cache import data_version, touch
+from app.passwords import hasher, HashQueueFull
+from app.money import to_minor, DEFAULT_CURRENCY
+from app.forms import (RegistrationForm, LoginForm, ExpenseForm, BudgetForm, ImportForm, ReportJobForm, SearchForm,
+                       RecurringExpenseForm, CategoryForm, GroupForm, GroupMemberForm, SharedExpenseForm)
+from app.models import (User, Expense, Category, Budget, MonthlySpend, ReportJob, RecurringExpense, Group,
+                        SharedExpense)
 from flask_login import login_user, current_user, logout_user, login_required
-from sqlalchemy import func
-from datetime import datetime
-import csv
-from io import StringIO
+from sqlalchemy.orm import joinedload
+from datetime import datetime, timedelta
+import hashlib
 
 main = Blueprint('main', __name__)
 
+MAX_EXPENSES_PER_PAGE = 100
+# Longest series the analytics endpoints will return
+MAX_ANALYTICS_PERIODS = 1000
+
 @main.route("/")
 @main.route("/dashboard")
 @login_required
 def dashboard():
-    # Total spending per month (current month)
     current_month = datetime.now().month
     current_year = datetime.now().year
     
-    total_spending = db.session.query(func.sum(Expense.amount)).filter(
-        Expense.user_id == current_user.id,
-        func.extract('month', Expense.date) == current_month,
-        func.extract('year', Expense.date) == current_year
-    ).scalar() or 0
-    
-    # Calculate total budget for current month
-    total_budget = db.session.query(func.sum(Budget.amount)).filter(
-        Budget.user_id == current_user.id,
-        Budget.month == current_month,
-        Budget.year == current_year
-    ).scalar() or 0
-    
     # Compare spending vs budget per category
-    categories = Category.query.all()
-    budget_vs_spending = []
-    
-    for category in categories:
-        spending = db.session.query(func.sum(Expense.amount)).filter(
-            Expense.user_id == current_user.id,
-            Expense.category_id == category.id,
-            func.extract('month', Expense.date) == current_month,
-            func.extract('year', Expense.date) == current_year
-        ).scalar() or 0
-        
-        budget = Budget.query.filter_by(
-            user_id=current_user.id,
-            category_id=category.id,
-            month=current_month,
-            year=current_year
-        ).first()
-        
-        budget_amount = budget.amount if budget else 0
-        remaining = budget_amount - spending
-        
-        # Calculate percentage used
-        percent_used = (spending / budget_amount * 100) if budget_amount > 0 else 0
-        
-        # Alerts: Over budget or 90%+ used
-        alert = budget_amount > 0 and spending > budget_amount
-        warning = budget_amount > 0 and not alert and percent_used >= 90
-        
-        budget_vs_spending.append({
-            'category': category.name,
-            'spending': spending,
-            'budget': budget_amount,
-            'remaining': remaining,
-            'percent_used': percent_used,
-            'alert': alert,
-            'warning': warning
-        })
+    summary = aggregates.dashboard_summary(current_user.id, current_year, current_month)
 
     return render_template('dashboard.html', title='Dashboard', 
-                           total_spending=total_spending,
-                           total_budget=total_budget,
-                           budget_vs_spending=budget_vs_spending,
+                           total_spending=summary['total_spending'],
+                           total_budget=summary['total_budget'],
+                           total_committed=summary['total_committed'],
+                           budget_vs_spending=summary['budget_vs_spending'],
                            current_month_name=datetime.now().strftime('%B'),
                            current_year=current_year)
 
@@ -83,7 +44,10 @@ def register():
         return redirect(url_for('main.dashboard'))
     form = RegistrationForm()
     if form.validate_on_submit():
-        hashed_password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
+        retry_after = throttle.registration_attempt(request.remote_addr)
+        if retry_after:
+            return _throttled('register.html', 'Register', form, retry_after)
+        hashed_password = hasher.hash(form.password.data)
         user = User(username=form.username.data, email=form.email.data, password=hashed_password)
         db.session.add(user)
         db.session.commit()
@@ -97,8 +61,19 @@ def login():
         return redirect(url_for('main.dashboard'))
     form = LoginForm()
     if form.validate_on_submit():
+        # Rejected before the user lookup and the (expensive) hash check
+        retry_after = throttle.login_attempt(request.remote_addr, form.email.data)
+        if retry_after:
+            return _throttled('login.html', 'Login', form, retry_after)
         user = User.query.filter_by(email=form.email.data).first()
-        if user and bcrypt.check_password_hash(user.password, form.password.data):
+        if user and hasher.check(user.password, form.password.data):
+            if hasher.needs_rehash(user.password):
+                # BCRYPT_LOG_ROUNDS changed since this hash was made
+                try:
+                    user.password = hasher.hash(form.password.data)
+                    db.session.commit()
+                except HashQueueFull:
+                    pass # Try again on the next login
             login_user(user, remember=form.remember.data)
             next_page = request.args.get('next')
             return redirect(next_page) if next_page else redirect(url_for('main.dashboard'))
@@ -106,6 +81,10 @@ def login():
             flash('Login Unsuccessful. Please check email and password', 'danger')
     return render_template('login.html', title='Login', form=form)
 
+def _throttled(template, title, form, retry_after):
+    flash(f'Too many attempts. Please try again in {retry_after} seconds.', 'danger')
+    return render_template(template, title=title, form=form), 429, {'Retry-After': str(retry_after)}
+
 @main.route("/logout")
 def logout():
     logout_user()
@@ -115,7 +94,7 @@ def logout():
 @login_required
 def expenses():
     form = ExpenseForm()
-    form.category.choices = [(c.id, c.name) for c in Category.query.all()]
+    form.category.choices = refdata.category_choices(current_user.id)
     
     # Set default value for date
     if request.method == 'GET':
@@ -132,15 +111,64 @@ def expenses():
         flash('Expense added!', 'success')
         return redirect(url_for('main.expenses'))
         
-    page = request.args.get('page', 1, type=int)
-    expenses = Expense.query.filter_by(user_id=current_user.id).order_by(Expense.date.desc()).paginate(page=page, per_page=5)
+    per_page = min(request.args.get('per_page', current_app.config['EXPENSES_PER_PAGE'], type=int),
+                   MAX_EXPENSES_PER_PAGE)
+    try:
+        expenses = pagination.keyset_paginate(
+            Expense.query.filter_by(user_id=current_user.id).options(joinedload(Expense.category)), Expense,
+            cursor=request.args.get('cursor'),
+            per_page=max(per_page, 1),
+            # Maintained by the rollup, no COUNT(*); archived expenses are not listed
+            total=aggregates.expense_count(current_user.id, archived=False)
+        )
+    except ValueError:
+        abort(400, 'Invalid page cursor')
     return render_template('expenses.html', title='Expenses', form=form, expenses=expenses)
 
+@main.route("/expenses/search")
+@login_required
+def search_expenses():
+    """Full-text search over descriptions, ranked by relevance and narrowed by optional filters"""
+    form = SearchForm(request.args)
+    form.category.choices = [(0, 'All categories')] + refdata.category_choices(current_user.id)
+    results = None
+    if request.args and form.validate():
+        per_page = min(request.args.get('per_page', 20, type=int), MAX_EXPENSES_PER_PAGE)
+        try:
+            results = search.search(
+                current_user.id, form.q.data,
+                start=form.start.data,
+                end=form.end.data + timedelta(days=1) if form.end.data else None,
+                category_id=form.category.data or None,
+                min_cents=to_minor(form.min_amount.data) if form.min_amount.data is not None else None,
+                max_cents=to_minor(form.max_amount.data) if form.max_amount.data is not None else None,
+                cursor=request.args.get('cursor'),
+                per_page=max(per_page, 1)
+            )
+        except ValueError:
+            abort(400, 'Invalid page cursor')
+    return render_template('search.html', title='Search Expenses', form=form, results=results,
+                           categories=refdata.category_names(current_user.id))
+
+@main.route("/expenses/import", methods=['GET', 'POST'])
+@login_required
+def import_expenses():
+    """Bulk import expenses from an uploaded CSV or OFX file"""
+    form = ImportForm()
+    report = None
+    if form.validate_on_submit():
+        upload = form.file.data
+        report = importer.import_expenses(current_user.id,
+                                          importer.text_stream(upload.stream),
+                                          importer.detect_format(upload.filename))
+        flash(f'Imported {report.imported} expenses.', 'success' if not report.error_count else 'warning')
+    return render_template('import.html', title='Import Expenses', form=form, report=report)
+
 @main.route("/budgets", methods=['GET', 'POST'])
 @login_required
 def budgets():
     form = BudgetForm()
-    form.category.choices = [(c.id, c.name) for c in Category.query.all()]
+    form.category.choices = refdata.category_choices(current_user.id)
     
     # Set default values for month and year
     if request.method == 'GET':
@@ -148,32 +176,67 @@ def budgets():
         form.year.data = datetime.now().year
     
     if form.validate_on_submit():
-        # Check if budget exists, update if so
-        existing_budget = Budget.query.filter_by(
-            user_id=current_user.id,
-            category_id=form.category.data,
-            month=form.month.data,
-            year=form.year.data
-        ).first()
-        
-        if existing_budget:
-            existing_budget.amount = form.amount.data
-            flash('Budget updated!', 'info')
-        else:
-            budget = Budget(amount=form.amount.data, 
-                            category_id=form.category.data, 
-                            month=form.month.data, 
-                            year=form.year.data, 
-                            user=current_user)
-            db.session.add(budget)
-            flash('Budget set!', 'success')
-            
+        # Insert or update in one statement: a check-then-insert lets two
+        # concurrent posts for the same month and category both insert
+        database.upsert(db.session.connection(), Budget.__table__, [{
+            'user_id': current_user.id,
+            'category_id': form.category.data,
+            'month': form.month.data,
+            'year': form.year.data,
+            'amount_cents': to_minor(form.amount.data),
+            'currency': DEFAULT_CURRENCY
+        }], ['user_id', 'year', 'month', 'category_id'], ['amount_cents', 'currency'])
+        # Core statements bypass the ORM events that invalidate the dashboard
+        touch(db.session, current_user.id, form.year.data, form.month.data)
         db.session.commit()
+        flash('Budget saved!', 'success')
         return redirect(url_for('main.budgets'))
         
     budgets = Budget.query.filter_by(user_id=current_user.id).all()
     return render_template('budgets.html', title='Budgets', form=form, budgets=budgets)
 
+@main.route("/categories", methods=['GET', 'POST'])
+@login_required
+def categories():
+    """The user's category tree, where they can add their own (sub)categories"""
+    form = CategoryForm()
+    tree = refdata.category_tree(current_user.id)
+    form.parent.choices = [(0, '(Top level)')] + refdata.category_choices(current_user.id)
+
+    if form.validate_on_submit():
+        parent_id = form.parent.data or None
+        name = form.name.data.strip()
+        if any(node.parent_id == parent_id and node.name.lower() == name.lower() for node in tree):
+            form.name.errors.append('There is already a category with that name here.')
+        else:
+            db.session.add(Category(name=name, parent_id=parent_id, user_id=current_user.id))
+            db.session.commit()
+            flash('Category added!', 'success')
+            return redirect(url_for('main.categories'))
+
+    owned = {id for (id,) in db.session.query(Category.id).filter_by(user_id=current_user.id)}
+    return render_template('categories.html', title='Categories', form=form, tree=tree, owned=owned)
+
+@main.route("/category/delete/<int:category_id>")
+@login_required
+def delete_category(category_id):
+    category = db.session.get(Category, category_id)
+    if category is None or category.user_id != current_user.id:
+        flash('You can only delete your own categories.', 'danger')
+        return redirect(url_for('main.categories'))
+    in_use = (Category.query.filter_by(parent_id=category.id).first() or
+              # The rollup also counts archived expenses
+              MonthlySpend.query.filter(MonthlySpend.category_id == category.id, MonthlySpend.count != 0).first() or
+              Budget.query.filter_by(category_id=category.id).first() or
+              RecurringExpense.query.filter_by(category_id=category.id).first())
+    if in_use:
+        flash('Only categories without subcategories, expenses or budgets can be deleted.', 'danger')
+        return redirect(url_for('main.categories'))
+    db.session.delete(category)
+    db.session.commit()
+    flash('Category deleted!', 'success')
+    return redirect(url_for('main.categories'))
+
 @main.route("/budget/delete/<int:budget_id>")
 @login_required
 def delete_budget(budget_id):
@@ -198,6 +261,126 @@ def delete_expense(expense_id):
     flash('Expense deleted!', 'success')
     return redirect(url_for('main.expenses'))
 
+@main.route("/recurring", methods=['GET', 'POST'])
+@login_required
+def recurring_expenses():
+    form = RecurringExpenseForm()
+    form.category.choices = refdata.category_choices(current_user.id)
+    if request.method == 'GET':
+        form.start_date.data = datetime.now().date()
+
+    if form.validate_on_submit():
+        rule = RecurringExpense(amount=form.amount.data,
+                                category_id=form.category.data,
+                                description=form.description.data,
+                                frequency=form.frequency.data,
+                                interval=form.interval.data,
+                                start_date=form.start_date.data,
+                                end_date=form.end_date.data,
+                                user_id=current_user.id)
+        recurring.reset(rule)
+        db.session.add(rule)
+        db.session.commit()
+        # Occurrences already due (e.g. a rule starting today) are written now
+        written = recurring.materialize([rule])
+        flash(f'Recurring expense added! {written} expenses recorded so far.', 'success')
+        return redirect(url_for('main.recurring_expenses'))
+
+    rules = RecurringExpense.query.filter_by(user_id=current_user.id).order_by(RecurringExpense.id).all()
+    return render_template('recurring.html', title='Recurring Expenses', form=form, rules=rules,
+                           categories=refdata.category_names(current_user.id))
+
+@main.route("/recurring/delete/<int:rule_id>")
+@login_required
+def delete_recurring_expense(rule_id):
+    """Stop a recurring expense; the expenses it already recorded are kept"""
+    rule = db.session.get(RecurringExpense, rule_id)
+    if rule is None or rule.user_id != current_user.id:
+        abort(404)
+    Expense.query.filter_by(recurring_id=rule.id).update({'recurring_id': None})
+    db.session.delete(rule)
+    db.session.commit()
+    flash('Recurring expense deleted!', 'success')
+    return redirect(url_for('main.recurring_expenses'))
+
+@main.route("/groups", methods=['GET', 'POST'])
+@login_required
+def group_list():
+    """Shared ledgers the user belongs to"""
+    form = GroupForm()
+    if form.validate_on_submit():
+        group = groups.create(current_user.id, form.name.data)
+        flash('Group created!', 'success')
+        return redirect(url_for('main.group_dashboard', group_id=group.id))
+    return render_template('groups.html', title='Groups', form=form, memberships=groups.user_groups(current_user.id))
+
+@main.route("/groups/<int:group_id>", methods=['GET', 'POST'])
+@login_required
+def group_dashboard(group_id):
+    """A group's budget vs spending, balances and shared expenses"""
+    membership = groups.membership(group_id, current_user.id)
+    if membership is None:
+        abort(404)
+    group = db.session.get(Group, group_id)
+    member_rows = groups.members(group_id)
+    member_choices = [(user_id, username) for user_id, username, role in member_rows]
+    now = datetime.now()
+
+    # Three forms on one page, told apart by their prefixes
+    expense_form = SharedExpenseForm(prefix='expense')
+    expense_form.category.choices = refdata.category_choices()
+    expense_form.paid_by.choices = member_choices
+    expense_form.split_between.choices = member_choices
+    budget_form = BudgetForm(prefix='budget')
+    budget_form.category.choices = refdata.category_choices()
+    member_form = GroupMemberForm(prefix='member')
+
+    if request.method == 'POST':
+        if membership.role not in groups.WRITE_ROLES:
+            abort(403)
+        if expense_form.submit.data and expense_form.validate():
+            groups.add_expense(group_id, expense_form.paid_by.data, expense_form.amount.data,
+                               expense_form.description.data,
+                               date=datetime.combine(expense_form.date.data, datetime.min.time()),
+                               category_id=expense_form.category.data,
+                               weights={user_id: 1 for user_id in expense_form.split_between.data})
+            flash('Shared expense added!', 'success')
+            return redirect(url_for('main.group_dashboard', group_id=group_id))
+        if budget_form.submit.data and budget_form.validate():
+            groups.set_budget(group_id, budget_form.category.data, budget_form.year.data, budget_form.month.data,
+                              budget_form.amount.data)
+            flash('Group budget saved!', 'success')
+            return redirect(url_for('main.group_dashboard', group_id=group_id))
+        if member_form.submit.data and member_form.validate():
+            if membership.role != 'owner':
+                abort(403)
+            user = User.query.filter_by(email=member_form.email.data).first()
+            if user is None:
+                member_form.email.errors.append('There is no account with that email.')
+            else:
+                try:
+                    groups.set_member(group_id, user.id, member_form.role.data)
+                except ValueError as e:
+                    member_form.role.errors.append(str(e))
+                else:
+                    flash(f'{user.username} is now a {member_form.role.data} of {group.name}.', 'success')
+                    return redirect(url_for('main.group_dashboard', group_id=group_id))
+    else:
+        expense_form.date.data = now.date()
+        expense_form.paid_by.data = current_user.id
+        expense_form.split_between.data = [user_id for user_id, _ in member_choices]
+        budget_form.month.data = now.month
+        budget_form.year.data = now.year
+
+    recent = SharedExpense.query.filter_by(group_id=group_id).order_by(
+        SharedExpense.date.desc(), SharedExpense.id.desc()).limit(20).all()
+    return render_template('group.html', title=group.name, group=group, role=membership.role,
+                           summary=groups.dashboard(group_id, now.year, now.month),
+                           members=member_rows, usernames=dict(member_choices), recent=recent,
+                           categories=refdata.category_names(), current_month_name=now.strftime('%B'),
+                           current_year=now.year, expense_form=expense_form, budget_form=budget_form,
+                           member_form=member_form)
+
 @main.route("/reports")
 @login_required
 def reports():
@@ -206,24 +389,17 @@ def reports():
     current_year = datetime.now().year
     
     # Get all expenses for current user
-    total_expenses = Expense.query.filter_by(user_id=current_user.id).count()
+    total_expenses = aggregates.expense_count(current_user.id)
     total_budgets = Budget.query.filter_by(user_id=current_user.id).count()
     
     # Monthly summary
-    monthly_spending = db.session.query(func.sum(Expense.amount)).filter(
-        Expense.user_id == current_user.id,
-        func.extract('month', Expense.date) == current_month,
-        func.extract('year', Expense.date) == current_year
-    ).scalar() or 0
-    
-    monthly_budget = db.session.query(func.sum(Budget.amount)).filter(
-        Budget.user_id == current_user.id,
-        Budget.month == current_month,
-        Budget.year == current_year
-    ).scalar() or 0
+    monthly_spending = aggregates.monthly_spending(current_user.id, current_year, current_month)
+    monthly_budget = aggregates.monthly_budget(current_user.id, current_year, current_month)
     
     return render_template('reports.html', 
                           title='Reports',
+                          job_form=ReportJobForm(),
+                          categories=refdata.categories(current_user.id),
                           total_expenses=total_expenses,
                           total_budgets=total_budgets,
                           monthly_spending=monthly_spending,
@@ -238,89 +414,154 @@ def download_budget_spending():
     current_month = datetime.now().month
     current_year = datetime.now().year
     
-    # Get budget vs spending data
-    categories = Category.query.all()
-    
     # Create CSV in memory
-    si = StringIO()
-    writer = csv.writer(si)
-    
-    # Write headers
-    writer.writerow(['Category', 'Budget', 'Spending', 'Remaining', 'Percent Used', 'Status'])
-    
-    # Write data
-    for category in categories:
-        spending = db.session.query(func.sum(Expense.amount)).filter(
-            Expense.user_id == current_user.id,
-            Expense.category_id == category.id,
-            func.extract('month', Expense.date) == current_month,
-            func.extract('year', Expense.date) == current_year
-        ).scalar() or 0
-        
-        budget = Budget.query.filter_by(
-            user_id=current_user.id,
-            category_id=category.id,
-            month=current_month,
-            year=current_year
-        ).first()
-        
-        budget_amount = budget.amount if budget else 0
-        remaining = budget_amount - spending
-        percent_used = (spending / budget_amount * 100) if budget_amount > 0 else 0
-        
-        # Determine status
-        if budget_amount > 0 and spending > budget_amount:
-            status = 'Over Budget'
-        elif budget_amount > 0 and percent_used >= 90:
-            status = 'Warning (90%+)'
-        elif budget_amount > 0:
-            status = 'OK'
-        else:
-            status = 'No Budget Set'
-        
-        writer.writerow([
-            category.name,
-            f'{budget_amount:.2f}',
-            f'{spending:.2f}',
-            f'{remaining:.2f}',
-            f'{percent_used:.1f}%',
-            status
-        ])
+    rows = exports.budget_spending_rows(current_user.id, current_year, current_month)
+    csv_text = ''.join(exports.csv_chunks(rows, exports.BUDGET_HEADERS))
     
     # Create response
-    output = make_response(si.getvalue())
+    output = make_response(csv_text)
     output.headers["Content-Disposition"] = f"attachment; filename=budget_spending_{current_month}_{current_year}.csv"
     output.headers["Content-type"] = "text/csv"
     return output
 
+def _date_arg(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        abort(400, f'Invalid {name} date, expected YYYY-MM-DD')
+
 @main.route("/reports/download/expenses")
 @login_required
 def download_expenses():
-    """Download all expenses as CSV"""
-    # Get all expenses for current user
-    expenses = Expense.query.filter_by(user_id=current_user.id).order_by(Expense.date.desc()).all()
-    
-    # Create CSV in memory
-    si = StringIO()
-    writer = csv.writer(si)
+    """Download expenses as CSV, optionally filtered by date range and category"""
+    start = _date_arg('start')
+    end = _date_arg('end')
+    category_id = request.args.get('category', type=int)
     
-    # Write headers
-    writer.writerow(['Date', 'Category', 'Description', 'Amount'])
+    # Rows are streamed from the database as the response is sent
+    chunks = exports.csv_chunks(exports.expense_rows(current_user.id, start, end, category_id))
     
-    # Write data
-    for expense in expenses:
-        writer.writerow([
-            expense.date.strftime('%Y-%m-%d'),
-            expense.category.name,
-            expense.description or '',
-            f'{expense.amount:.2f}'
-        ])
+    if start or end or category_id:
+        filename = f"expenses_{start or 'start'}_{end or 'end'}.csv"
+    else:
+        filename = "expenses_all.csv"
     
-    # Create response
-    output = make_response(si.getvalue())
-    output.headers["Content-Disposition"] = "attachment; filename=expenses_all.csv"
-    output.headers["Content-type"] = "text/csv"
-    return output
+    headers = {"Content-Disposition": f"attachment; filename={filename}"}
+    if request.accept_encodings['gzip']:
+        chunks = exports.gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+        headers["Vary"] = "Accept-Encoding"
+    return Response(stream_with_context(chunks), mimetype="text/csv", headers=headers)
+
+@main.route("/reports/jobs", methods=['POST'])
+@login_required
+def create_report_job():
+    """Queue a report to be generated in the background; identical requests share a job"""
+    form = ReportJobForm()
+    if not form.validate_on_submit():
+        return jsonify({'errors': form.errors}), 400
+    if form.kind.data == 'expenses':
+        params = {
+            'start': form.start.data.isoformat() if form.start.data else None,
+            'end': form.end.data.isoformat() if form.end.data else None,
+            'category': form.category.data
+        }
+    else:
+        now = datetime.now()
+        params = {'year': form.year.data or now.year, 'month': form.month.data or now.month}
+    job = jobs.submit(current_user.id, form.kind.data, form.format.data, params)
+    status_url = url_for('main.report_job', job_id=job.id)
+    return jsonify(_job_status(job)), 202, {'Location': status_url}
+
+def _user_job(job_id):
+    job = db.session.get(ReportJob, job_id)
+    if job is None or job.user_id != current_user.id:
+        abort(404)
+    return job
+
+def _job_status(job):
+    status = jobs.describe(job)
+    status['status_url'] = url_for('main.report_job', job_id=job.id)
+    if job.status == 'done':
+        status['download_url'] = url_for('main.download_report_job', job_id=job.id)
+    return status
+
+@main.route("/reports/jobs/<int:job_id>")
+@login_required
+def report_job(job_id):
+    """Status of a background report"""
+    return jsonify(_job_status(_user_job(job_id)))
+
+@main.route("/reports/jobs/<int:job_id>/download")
+@login_required
+def download_report_job(job_id):
+    """The finished file of a background report"""
+    job = _user_job(job_id)
+    if job.status == 'expired' or (job.status == 'done' and job.expires_at < datetime.utcnow()):
+        abort(410, 'This report has expired; request it again')
+    if job.status != 'done':
+        return jsonify(_job_status(job)), 409
+    return send_file(job.path, mimetype=jobs.MIMETYPES[job.format], as_attachment=True,
+                     download_name=f'{job.kind}_{job.id}.{job.format}')
+
+def _analytics_range():
+    """start and end query arguments; by default the twelve months up to today"""
+    end = _date_arg('end') or datetime.now().date()
+    start = _date_arg('start') or analytics.period_start('month', analytics.period_key('month', end) - 11)
+    if start > end:
+        abort(400, 'start must not be after end')
+    return start, end
+
+def _conditional_json(compute):
+    """JSON response with an ETag built from the user's data version, so an
+    unchanged result is answered with 304 before anything is queried"""
+    # The date matters as ranges default to ending today
+    validator = f'{data_version(current_user.id)}:{refdata.category_version(current_user.id)}:{datetime.now().date()}:{request.full_path}'
+    etag = hashlib.sha1(validator.encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(compute())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response
+
+@main.route("/api/analytics/spending")
+@login_required
+def analytics_spending():
+    """Spending per day, week or month with rolling averages and period-over-period changes"""
+    start, end = _analytics_range()
+    granularity = request.args.get('granularity', 'month')
+    if granularity not in analytics.GRANULARITIES:
+        abort(400, f"granularity must be one of: {', '.join(analytics.GRANULARITIES)}")
+    if analytics.period_count(granularity, start, end) > MAX_ANALYTICS_PERIODS:
+        abort(400, f'Range spans more than {MAX_ANALYTICS_PERIODS} periods; use a coarser granularity')
+    window = request.args.get('window', analytics.DEFAULT_WINDOW, type=int)
+    if window < 1:
+        abort(400, 'window must be at least 1')
+    category_id = request.args.get('category', type=int)
+    return _conditional_json(lambda: analytics.spending_series(
+        current_user.id, start, end, granularity, category_id, window))
+
+@main.route("/api/analytics/categories")
+@login_required
+def analytics_categories():
+    """Spending per category over a date range"""
+    start, end = _analytics_range()
+    return _conditional_json(lambda: analytics.category_breakdown(current_user.id, start, end))
+
+@main.route("/api/analytics/budgets")
+@login_required
+def analytics_budgets():
+    """Budget against spending for each month of a date range"""
+    start, end = _analytics_range()
+    if analytics.period_count('month', start, end) > MAX_ANALYTICS_PERIODS:
+        abort(400, f'Range spans more than {MAX_ANALYTICS_PERIODS} months')
+    return _conditional_json(lambda: analytics.budget_adherence(current_user.id, start, end))
 
 @main.route("/init_db")
 def init_db():
@@ -0,0 +1,202 @@
+"""Full-text search over expense descriptions.
+
+On SQLite, descriptions are indexed in expense_fts, a contentless FTS5 table.
+Triggers on the expense table keep it in sync with inserts, updates and
+deletes. Bulk inserts (app.bulk) drop the insert trigger for the length of
+their transaction and index a whole batch with one INSERT ... SELECT
+instead. Each row also
+indexes an owner token ('u<user_id>'), so the full-text match is already
+narrowed to one user's expenses before anything is ranked. Other databases
+fall back to a LIKE scan.
+"""
+import base64
+import json
+import re
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import event, func, literal, literal_column, select, text, and_, or_
+from app import db, refdata
+from app.models import Expense
+
+FTS_TABLE = 'expense_fts'
+# Most words a query is split into
+MAX_TERMS = 10
+
+_INSERT_TRIGGER = f"""CREATE TRIGGER IF NOT EXISTS expense_fts_insert AFTER INSERT ON expense BEGIN
+    INSERT INTO {FTS_TABLE} (rowid, description, owner)
+    VALUES (new.id, coalesce(new.description, ''), 'u' || new.user_id);
+END"""
+
+_DDL = [
+    # prefix='2 3' keeps indexes of 2 and 3 character prefixes, so short
+    # prefix queries don't scan every matching term
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        description, owner, content='', tokenize='unicode61 remove_diacritics 2', prefix='2 3')""",
+    _INSERT_TRIGGER,
+    # A contentless table can only forget a row given the values it indexed
+    f"""CREATE TRIGGER IF NOT EXISTS expense_fts_delete AFTER DELETE ON expense BEGIN
+        INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, description, owner)
+        VALUES ('delete', old.id, coalesce(old.description, ''), 'u' || old.user_id);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS expense_fts_update AFTER UPDATE OF description, user_id ON expense BEGIN
+        INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, description, owner)
+        VALUES ('delete', old.id, coalesce(old.description, ''), 'u' || old.user_id);
+        INSERT INTO {FTS_TABLE} (rowid, description, owner)
+        VALUES (new.id, coalesce(new.description, ''), 'u' || new.user_id);
+    END"""
+]
+
+
+def is_supported(connection):
+    return connection.dialect.name == 'sqlite'
+
+
+def install(connection):
+    """Create the FTS table and its triggers (idempotent)"""
+    if is_supported(connection):
+        for statement in _DDL:
+            connection.execute(text(statement))
+
+
+def rebuild(connection):
+    """Re-index every expense from scratch"""
+    if not is_supported(connection):
+        return
+    connection.execute(text(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('delete-all')"))
+    connection.execute(text(
+        f"INSERT INTO {FTS_TABLE} (rowid, description, owner) "
+        f"SELECT id, coalesce(description, ''), 'u' || user_id FROM expense"
+    ))
+    optimize(connection)
+
+
+def drop_insert_trigger(connection):
+    """Stop indexing inserts until create_insert_trigger(). Only within a
+    transaction that holds the write lock, so no other writer can slip an
+    expense past the index and a rollback brings the trigger back."""
+    if is_supported(connection):
+        connection.execute(text('DROP TRIGGER IF EXISTS expense_fts_insert'))
+
+
+def create_insert_trigger(connection):
+    if is_supported(connection):
+        connection.execute(text(_INSERT_TRIGGER))
+
+
+def index_after(connection, after):
+    """Index the expenses with ids above `after`, inserted while the insert
+    trigger was dropped"""
+    if is_supported(connection):
+        connection.execute(text(
+            f"INSERT INTO {FTS_TABLE} (rowid, description, owner) "
+            f"SELECT id, coalesce(description, ''), 'u' || user_id FROM expense WHERE id > :after"
+        ), {'after': after})
+
+
+def optimize(connection):
+    """Merge the index's segments into one"""
+    if is_supported(connection):
+        connection.execute(text(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')"))
+
+
+@event.listens_for(Expense.__table__, 'after_create')
+def _create_index(target, connection, **kw):
+    install(connection)
+
+
+@event.listens_for(Expense.__table__, 'before_drop')
+def _drop_index(target, connection, **kw):
+    if is_supported(connection):
+        connection.execute(text(f'DROP TABLE IF EXISTS {FTS_TABLE}'))
+
+
+def terms(query):
+    """Words of a search string, lowercased; punctuation and FTS operators are dropped"""
+    return re.findall(r'\w+', query.lower())[:MAX_TERMS]
+
+
+def match_expression(user_id, words):
+    """FTS5 query matching every word as a prefix, within one user's expenses"""
+    return ' AND '.join([f'owner:"u{user_id}"'] + [f'description:"{word}"*' for word in words])
+
+
+def encode_cursor(score, id):
+    payload = json.dumps([score, id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """Inverse of encode_cursor; raises ValueError for a malformed token"""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        score, id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return float(score), int(id)
+    except (TypeError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f'Invalid cursor: {token}') from e
+
+
+class SearchPage:
+    def __init__(self, items, next_cursor):
+        self.items = items # (expense, score) pairs, best match first
+        self.next_cursor = next_cursor
+
+
+def search(user_id, query='', start=None, end=None, category_id=None, min_cents=None, max_cents=None,
+           cursor=None, per_page=20):
+    """Rank a user's expenses against query, combined with optional filters.
+
+    Results are ordered by BM25 relevance (best first, then newest id) and
+    paged with a (score, id) cursor. Without query words every filtered
+    expense matches with the same score, so the newest come first.
+    """
+    words = terms(query or '')
+    connection = db.session.connection()
+    if words and is_supported(connection):
+        fts = literal_column(FTS_TABLE)
+        # Weights per column: only description matches count towards the rank
+        score = func.bm25(fts, 1.0, 0.0)
+        ranked = select(literal_column('rowid').label('id'), score.label('score')).select_from(
+            text(FTS_TABLE)
+        ).where(fts.op('MATCH')(match_expression(user_id, words))).subquery()
+        q = db.session.query(Expense, ranked.c.score).join(ranked, Expense.id == ranked.c.id)
+        score = ranked.c.score
+    else:
+        score = literal(0.0)
+        q = db.session.query(Expense, score.label('score'))
+        for word in words:
+            q = q.filter(or_(Expense.description.ilike(f'{word}%'), Expense.description.ilike(f'% {word}%')))
+
+    q = q.filter(Expense.user_id == user_id)
+    if start:
+        q = q.filter(Expense.date >= start)
+    if end:
+        q = q.filter(Expense.date < end)
+    if category_id:
+        q = q.filter(Expense.category_id.in_(refdata.subtree_ids(user_id, category_id)))
+    if min_cents is not None:
+        q = q.filter(Expense.amount_cents >= min_cents)
+    if max_cents is not None:
+        q = q.filter(Expense.amount_cents <= max_cents)
+    if cursor:
+        after_score, after_id = decode_cursor(cursor)
+        q = q.filter(or_(score > after_score, and_(score == after_score, Expense.id < after_id)))
+
+    rows = q.order_by(score, Expense.id.desc()).limit(per_page + 1).all()
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(rows[-1][1], rows[-1][0].id)
+    return SearchPage(rows, next_cursor)
+
+
+@click.command('search-rebuild')
+@with_appcontext
+def rebuild_command():
+    """Rebuild the expense full-text search index."""
+    with db.engine.begin() as connection:
+        if not is_supported(connection):
+            click.echo('Full-text search needs SQLite; other databases are searched without an index.')
+            return
+        install(connection)
+        rebuild(connection)
+    click.echo('Search index rebuilt.')
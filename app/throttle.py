@@ -0,0 +1,34 @@
+import time
+from flask import current_app
+from app.cache import cache
+
+# Attempts are counted in fixed windows in the cache backend, so the limits
+# are shared by every worker that shares the backend. The read-increment-write
+# is not atomic; under contention a few extra attempts may slip through.
+
+
+def hit(key, limit, window):
+    """Count an attempt against key; returns the seconds to wait if over limit, else 0"""
+    if not limit:
+        return 0
+    now = time.time()
+    cache_key = f'throttle:{key}:{int(now // window)}'
+    entry = cache.backend.get(cache_key)
+    attempts = (entry[1] if entry is not None else 0) + 1
+    cache.backend.set(cache_key, attempts, window)
+    if attempts > limit:
+        return int(window - now % window) + 1
+    return 0
+
+
+def login_attempt(ip, email):
+    """Throttle a login by client address and by account, before any hashing"""
+    config = current_app.config
+    window = config['LOGIN_ATTEMPT_WINDOW']
+    return max(hit(f'login:ip:{ip}', config['LOGIN_ATTEMPTS_PER_IP'], window),
+               hit(f'login:email:{email.lower()}', config['LOGIN_ATTEMPTS_PER_EMAIL'], window))
+
+
+def registration_attempt(ip):
+    config = current_app.config
+    return hit(f'register:ip:{ip}', config['REGISTRATIONS_PER_IP'], config['LOGIN_ATTEMPT_WINDOW'])
@@ -0,0 +1,189 @@
+"""Concurrent load test against the production server.
+
+Seeds a file database, then for each worker count starts gunicorn with the
+production config and runs reader threads (dashboard, expense list, reports)
+alongside one writer thread adding expenses, reporting reads/s, writes/s and
+read p95. Read throughput should grow with workers while writes continue.
+With --logins, that many clients also log in back to back; as password
+hashing runs off the request threads, read latency should stay flat.
+
+    python -m benchmarks.load_test --workers 1 2 4 --readers 16 --duration 20
+    python -m benchmarks.load_test --workers 2 --readers 8 --logins 0 8
+"""
+import argparse
+import http.cookiejar
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from datetime import date
+from app import create_app
+from app.models import Category
+from benchmarks.seed import seed, user_email, PASSWORD
+from benchmarks.run import _percentile
+
+READ_PATHS = ['/dashboard', '/expenses?per_page=20', '/reports']
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _opener(base, user=0):
+    """A urllib opener with its own cookie jar, logged in as a seeded user"""
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    data = urllib.parse.urlencode({'email': user_email(user), 'password': PASSWORD}).encode()
+    opener.open(base + '/login', data).read()
+    return opener
+
+
+def _wait_for(base, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(base + '/login').read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'Server at {base} did not start')
+
+
+def _load(base, users, readers, duration, category_id, logins=0):
+    stop = threading.Event()
+    latencies, writes, logged_in, errors = [], [0], [0], [0]
+    lock = threading.Lock()
+
+    # Readers and the writer log in before any load starts
+    openers = [_opener(base, n % users) for n in range(readers + 1)]
+
+    def read(n):
+        opener = openers[n]
+        i = n
+        while not stop.is_set():
+            started = time.perf_counter()
+            try:
+                opener.open(base + READ_PATHS[i % len(READ_PATHS)]).read()
+            except OSError:
+                with lock:
+                    errors[0] += 1
+                continue
+            with lock:
+                latencies.append((time.perf_counter() - started) * 1000)
+            i += 1
+
+    def write():
+        opener = openers[-1]
+        data = urllib.parse.urlencode({'amount': 9.99, 'category': category_id, 'description': 'Load test',
+                                       'date': date.today().isoformat()}).encode()
+        while not stop.is_set():
+            try:
+                opener.open(base + '/expenses', data).read()
+                writes[0] += 1
+            except OSError:
+                with lock:
+                    errors[0] += 1
+
+    def login(n):
+        while not stop.is_set():
+            try:
+                _opener(base, n % users)
+                with lock:
+                    logged_in[0] += 1
+            except OSError:
+                with lock:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=read, args=(n,)) for n in range(readers)]
+    threads.append(threading.Thread(target=write))
+    threads += [threading.Thread(target=login, args=(n,)) for n in range(logins)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    return {
+        'reads_per_s': round(len(latencies) / duration, 1),
+        'writes_per_s': round(writes[0] / duration, 1),
+        'logins_per_s': round(logged_in[0] / duration, 1),
+        'read_p50_ms': round(statistics.median(latencies), 1) if latencies else None,
+        'read_p95_ms': round(_percentile(latencies, 0.95), 1) if latencies else None,
+        'errors': errors[0]
+    }
+
+
+def run(workers=(1, 2, 4), threads=4, readers=16, duration=20, users=4, expenses=5000, years=1, logins=(0,)):
+    directory = tempfile.mkdtemp(prefix='expense-load-')
+    database = f'sqlite:///{os.path.join(directory, "load.db")}'
+    env = dict(os.environ, APP_ENV='production', SECRET_KEY='load-test', DATABASE_URL=database,
+               FLASK_WTF_CSRF_ENABLED='false', FLASK_CACHE_DIR=os.path.join(directory, 'cache'),
+               FLASK_LOGIN_ATTEMPTS_PER_IP='0', FLASK_LOGIN_ATTEMPTS_PER_EMAIL='0')
+    try:
+        app = create_app({'SQLALCHEMY_DATABASE_URI': database})
+        with app.app_context():
+            seed(users, expenses, years)
+            category_id = Category.query.order_by(Category.id).first().id
+
+        results = {}
+        for count in workers:
+            port = _free_port()
+            base = f'http://127.0.0.1:{port}'
+            server = subprocess.Popen(
+                [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{port}',
+                 '--workers', str(count), '--threads', str(threads), '--access-logfile', '/dev/null',
+                 'wsgi:app'],
+                env=env)
+            try:
+                _wait_for(base)
+                for login_clients in logins:
+                    results[(count, login_clients)] = _load(base, users, readers, duration, category_id,
+                                                            login_clients)
+            finally:
+                server.terminate()
+                server.wait()
+        return results
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def format_table(results):
+    lines = [f"{'workers':>8}{'logins':>8}{'reads/s':>10}{'writes/s':>10}{'logins/s':>10}"
+             f"{'p50 ms':>9}{'p95 ms':>9}{'errors':>8}"]
+    for (count, login_clients), r in results.items():
+        lines.append(f"{count:>8}{login_clients:>8}{r['reads_per_s']:>10.1f}{r['writes_per_s']:>10.1f}"
+                     f"{r['logins_per_s']:>10.1f}"
+                     f"{r['read_p50_ms'] or 0:>9.1f}{r['read_p95_ms'] or 0:>9.1f}{r['errors']:>8}")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the production server with concurrent reads and writes.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='Worker counts to compare.')
+    parser.add_argument('--threads', type=int, default=4, help='Threads per worker.')
+    parser.add_argument('--readers', type=int, default=16, help='Concurrent reading clients.')
+    parser.add_argument('--duration', type=float, default=20, help='Seconds per worker count.')
+    parser.add_argument('--users', type=int, default=4)
+    parser.add_argument('--expenses', type=int, default=5000, help='Expenses per user.')
+    parser.add_argument('--years', type=int, default=1)
+    parser.add_argument('--logins', type=int, nargs='+', default=[0],
+                        help='Clients logging in continuously; each count is a separate run.')
+    args = parser.parse_args(argv)
+
+    results = run(args.workers, args.threads, args.readers, args.duration, args.users, args.expenses, args.years,
+                  args.logins)
+    print(format_table(results))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,194 @@
+"""Route benchmarks.
+
+Seeds a database with synthetic data, drives every route through the Flask
+test client and reports p50/p95 latency, SQL statements per request and
+peak Python memory per route. Results can be saved as a JSON baseline and
+later runs compared against it; a regression exits with status 1.
+
+    python -m benchmarks.run --users 3 --expenses 20000 --years 3 --save baseline.json
+    python -m benchmarks.run --users 3 --expenses 20000 --years 3 --compare baseline.json
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+import tracemalloc
+from sqlalchemy import event
+from app import create_app, db
+from app.models import Category
+from benchmarks.seed import seed, user_email, PASSWORD
+
+# A route regresses if its p95 grows by more than this fraction (plus a
+# small absolute allowance for timer noise) or it issues more statements
+DEFAULT_TOLERANCE = 0.25
+NOISE_MS = 2.0
+
+
+class StatementCounter:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'after_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _consume(response):
+    """Read a response body chunk by chunk without keeping it, like a real client"""
+    for _ in response.iter_encoded():
+        pass
+    response.close()
+    return response.status_code
+
+
+def _routes(app, client, pages, first_category):
+    """(name, callable) pairs; each callable performs one request and reads the whole body"""
+
+    def get(url):
+        return lambda: _consume(client.get(url))
+
+    def expenses_pages():
+        # Walks `pages` pages deep through the keyset cursors
+        url = '/expenses?per_page=20'
+        for _ in range(pages):
+            response = client.get(url)
+            cursor = response.data.split(b'cursor=', 1)
+            if len(cursor) < 2:
+                break
+            url = '/expenses?cursor=' + cursor[1].split(b'&', 1)[0].split(b'"', 1)[0].decode()
+        return response.status_code
+
+    def login():
+        # A fresh client each time, so the request is an actual login
+        return _consume(app.test_client().post('/login', data={'email': user_email(0), 'password': PASSWORD}))
+
+    return [
+        ('dashboard', get('/dashboard')),
+        ('expenses', get('/expenses?per_page=20')),
+        ('expenses_deep_pages', expenses_pages),
+        ('reports', get('/reports')),
+        ('download_budget_spending', get('/reports/download/budget-spending')),
+        ('download_expenses', get('/reports/download/expenses')),
+        ('download_expenses_filtered', get(f'/reports/download/expenses?category={first_category}')),
+        ('login', login),
+    ]
+
+
+def run(users=1, expenses=1000, years=1, iterations=20, pages=10, database='sqlite:///:memory:', config=None):
+    """Seed a database, benchmark every route and return the results as a dict"""
+    app = create_app({
+        'TESTING': True,
+        'WTF_CSRF_ENABLED': False,
+        'SQLALCHEMY_DATABASE_URI': database,
+        # The login route is timed repeatedly from one address
+        'LOGIN_ATTEMPTS_PER_IP': 0,
+        'LOGIN_ATTEMPTS_PER_EMAIL': 0,
+        **(config or {})
+    })
+    results = {'scale': {'users': users, 'expenses': expenses, 'years': years, 'iterations': iterations},
+               'routes': {}}
+
+    with app.app_context():
+        started = time.perf_counter()
+        seed(users, expenses, years)
+        results['scale']['seed_seconds'] = round(time.perf_counter() - started, 3)
+        first_category = Category.query.order_by(Category.id).first().id
+        counter = StatementCounter(db.engine)
+
+    # Requests run outside the seeding app context so each one gets its own,
+    # as in production (otherwise g, and the loaded user, would be shared)
+    client = app.test_client()
+    client.post('/login', data={'email': user_email(0), 'password': PASSWORD})
+    for name, request in _routes(app, client, pages, first_category):
+        # Warm up once, then time without tracing
+        status = request()
+        assert status in (200, 302), f'{name} returned {status}'
+        latencies, statements = [], []
+        for _ in range(iterations):
+            before = counter.count
+            started = time.perf_counter()
+            request()
+            latencies.append((time.perf_counter() - started) * 1000)
+            statements.append(counter.count - before)
+
+        # A separate traced pass for peak memory, as tracing skews timings
+        tracemalloc.start()
+        request()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        results['routes'][name] = {
+            'p50_ms': round(statistics.median(latencies), 3),
+            'p95_ms': round(_percentile(latencies, 0.95), 3),
+            'statements': max(statements),
+            'peak_kib': round(peak / 1024, 1)
+        }
+
+    with app.app_context():
+        db.engine.dispose()
+    return results
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Regressions of results against a baseline, as human readable strings"""
+    regressions = []
+    for name, base in baseline['routes'].items():
+        current = results['routes'].get(name)
+        if current is None:
+            continue
+        limit = base['p95_ms'] * (1 + tolerance) + NOISE_MS
+        if current['p95_ms'] > limit:
+            regressions.append(f"{name}: p95 {current['p95_ms']:.1f} ms > {limit:.1f} ms "
+                               f"(baseline {base['p95_ms']:.1f} ms)")
+        if current['statements'] > base['statements']:
+            regressions.append(f"{name}: {current['statements']} statements > baseline {base['statements']}")
+    return regressions
+
+
+def format_table(results):
+    lines = [f"{'route':<28}{'p50 ms':>10}{'p95 ms':>10}{'queries':>9}{'peak KiB':>11}"]
+    for name, r in results['routes'].items():
+        lines.append(f"{name:<28}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['statements']:>9}{r['peak_kib']:>11.1f}")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the expense tracker routes.')
+    parser.add_argument('--users', type=int, default=1)
+    parser.add_argument('--expenses', type=int, default=1000, help='Expenses per user.')
+    parser.add_argument('--years', type=int, default=1, help='Years of history the expenses span.')
+    parser.add_argument('--iterations', type=int, default=20, help='Timed requests per route.')
+    parser.add_argument('--pages', type=int, default=10, help='Pages walked by expenses_deep_pages.')
+    parser.add_argument('--database', default='sqlite:///:memory:',
+                        help='SQLAlchemy URI; use a file (sqlite:////tmp/bench.db) to include disk I/O.')
+    parser.add_argument('--no-cache', action='store_true', help='Disable the dashboard result cache.')
+    parser.add_argument('--save', metavar='PATH', help='Write the results as a JSON baseline.')
+    parser.add_argument('--compare', metavar='PATH', help='Fail if results regress against this baseline.')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    config = {'CACHE_TYPE': 'null'} if args.no_cache else {}
+    results = run(args.users, args.expenses, args.years, args.iterations, args.pages, args.database, config)
+    print(format_table(results))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,68 @@
+"""Synthetic data generator for benchmarks.
+
+Seeds N users with M expenses each, spread evenly over the last Y years,
+plus a budget for every category in every month of that range.
+"""
+import random
+from datetime import datetime, timedelta
+from app import db, bcrypt, rollup
+from app.models import User, Expense, Category, Budget
+
+PASSWORD = 'benchmark'
+BATCH_SIZE = 10000
+
+DESCRIPTIONS = ['Groceries', 'Bus fare', 'Cinema', 'Electricity', 'Rent', 'Coffee', 'Taxi', 'Internet']
+
+
+def user_email(n):
+    return f'bench{n}@example.com'
+
+
+def _months(start, end):
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        yield year, month
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def seed(users=1, expenses=1000, years=1, seed_value=0):
+    """Populate the current app's database; returns the ids of the created users"""
+    rng = random.Random(seed_value)
+    password = bcrypt.generate_password_hash(PASSWORD).decode('utf-8')
+    category_ids = [c.id for c in Category.query.all()]
+    end = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    start = end - timedelta(days=365 * years)
+    span = (end - start).total_seconds()
+
+    user_ids = []
+    for n in range(users):
+        user = User(username=f'bench{n}', email=user_email(n), password=password)
+        db.session.add(user)
+        db.session.flush()
+        user_ids.append(user.id)
+
+        connection = db.session.connection()
+        batch = []
+        for i in range(expenses):
+            batch.append({
+                'amount_cents': rng.randint(100, 20000),
+                'date': start + timedelta(seconds=span * i / max(expenses, 1)),
+                'description': rng.choice(DESCRIPTIONS),
+                'user_id': user.id,
+                'category_id': rng.choice(category_ids)
+            })
+            if len(batch) == BATCH_SIZE:
+                connection.execute(Expense.__table__.insert(), batch)
+                batch = []
+        if batch:
+            connection.execute(Expense.__table__.insert(), batch)
+
+        connection.execute(Budget.__table__.insert(), [
+            {'amount_cents': rng.choice([200, 500, 1000, 2000]) * 100, 'year': year, 'month': month,
+             'user_id': user.id, 'category_id': category_id}
+            for year, month in _months(start, end) for category_id in category_ids
+        ])
+        db.session.commit()
+
+    rollup.rebuild()
+    return user_ids
@@ -0,0 +1,23 @@
+"""Gunicorn settings for production; each can be overridden from the environment"""
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+# Processes scale CPU-bound work (templates, hashing) past the GIL; threads
+# within each keep serving while a request waits on the database
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 4))
+timeout = int(os.environ.get('WEB_TIMEOUT', 30))
+# Load the app once in the master so migrations run once, not per worker
+preload_app = True
+accesslog = '-'
+
+
+def post_fork(server, worker):
+    # Connections opened by the master during startup must not be shared
+    # with the forked workers; each worker opens its own pool
+    from app import db
+    from wsgi import app
+    with app.app_context():
+        db.engine.dispose(close=False)
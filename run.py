@@ -3,4 +3,5 @@ from app import create_app
 app = create_app()
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0')
+    # Development server only; production runs wsgi:app under gunicorn
+    app.run(debug=app.config['APP_ENV'] == 'development', host='0.0.0.0')
@@ -0,0 +1,36 @@
+import pytest
+from app import create_app, db
+from app.models import Category
+
+@pytest.fixture
+def client():
+    app = create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
+        'WTF_CSRF_ENABLED': False # Disable CSRF for testing
+    })
+
+    with app.test_client() as client:
+        with app.app_context():
+            db.create_all()
+            # Create default categories
+            c1 = Category(name='Food')
+            db.session.add(c1)
+            db.session.commit()
+            yield client
+
+
+@pytest.fixture
+def auth_client(client):
+    """Client logged in as a freshly registered user"""
+    client.post('/register', data=dict(
+        username='testuser',
+        email='test@example.com',
+        password='password',
+        confirm_password='password'
+    ), follow_redirects=True)
+    client.post('/login', data=dict(
+        email='test@example.com',
+        password='password'
+    ), follow_redirects=True)
+    return client
@@ -0,0 +1,84 @@
+from datetime import datetime
+from decimal import Decimal
+from app import db
+from app.aggregates import budget_vs_spending, budget_vs_spending_tables, table_totals, monthly_spending
+from app.models import User, Expense, Category, Budget
+
+
+def _user(username):
+    user = User(username=username, email=f'{username}@example.com', password='x')
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def test_budget_vs_spending(client):
+    """Test spending and budget are combined per category"""
+    user = _user('alice')
+    food = Category.query.filter_by(name='Food').first()
+    db.session.add_all([
+        Expense(amount=60, date=datetime(2024, 3, 2), user_id=user.id, category_id=food.id),
+        Expense(amount=35, date=datetime(2024, 3, 30), user_id=user.id, category_id=food.id),
+        Expense(amount=500, date=datetime(2024, 4, 1), user_id=user.id, category_id=food.id),
+        Budget(amount=100, month=3, year=2024, user_id=user.id, category_id=food.id)
+    ])
+    db.session.commit()
+
+    rows = budget_vs_spending(user.id, 2024, 3)
+    assert len(rows) == Category.query.count()
+    food_row = next(r for r in rows if r['category'] == 'Food' and r['budget'])
+    assert food_row['spending'] == 95
+    assert food_row['remaining'] == 5
+    assert food_row['warning'] and not food_row['alert']
+    assert food_row['status'] == 'Warning (90%+)'
+    assert table_totals(rows) == (95, 100)
+
+
+def test_budget_vs_spending_tables_batch(client):
+    """Test several users and months are computed in one call"""
+    alice, bob = _user('alice'), _user('bob')
+    food = Category.query.filter_by(name='Food').first()
+    db.session.add_all([
+        Expense(amount=10, date=datetime(2024, 1, 5), user_id=alice.id, category_id=food.id),
+        Expense(amount=20, date=datetime(2024, 2, 5), user_id=bob.id, category_id=food.id)
+    ])
+    db.session.commit()
+
+    tables = budget_vs_spending_tables([alice.id, bob.id], [(2024, 1), (2024, 2)])
+    assert len(tables) == 4
+    assert table_totals(tables[(alice.id, 2024, 1)]) == (10, 0)
+    assert table_totals(tables[(alice.id, 2024, 2)]) == (0, 0)
+    assert table_totals(tables[(bob.id, 2024, 2)]) == (20, 0)
+
+
+def test_budget_spending_download(auth_client):
+    """Test the budget report CSV is built from the aggregated table"""
+    user = User.query.filter_by(email='test@example.com').first()
+    now = datetime.now()
+    db.session.add_all([
+        Expense(amount=120, date=now, user_id=user.id, category_id=1),
+        Budget(amount=100, month=now.month, year=now.year, user_id=user.id, category_id=1)
+    ])
+    db.session.commit()
+
+    response = auth_client.get('/reports/download/budget-spending')
+    assert response.status_code == 200
+    assert b'Food,100.00,120.00,-20.00,120.0%,Over Budget' in response.data
+
+    response = auth_client.get('/dashboard')
+    assert b'Over Budget!' in response.data
+
+
+def test_amounts_are_exact_decimals(client):
+    """Test amounts round trip through integer cents and sum exactly"""
+    user = _user('cents')
+    # 0.1 + 0.2 style amounts would drift as floats
+    db.session.add_all([
+        Expense(amount='0.10', date=datetime(2024, 1, 31, 23, 59), user_id=user.id, category_id=1),
+        Expense(amount='0.20', date=datetime(2024, 1, 31, 8, 0), user_id=user.id, category_id=1),
+        Expense(amount=0.29, date=datetime(2024, 2, 1), user_id=user.id, category_id=1)
+    ])
+    db.session.commit()
+    expense = Expense.query.filter_by(amount_cents=29).one()
+    assert expense.amount == Decimal('0.29')
+    assert monthly_spending(user.id, 2024, 1) == Decimal('0.30')
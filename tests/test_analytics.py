@@ -0,0 +1,88 @@
+from datetime import datetime
+from sqlalchemy import event
+from app import db
+from app.models import User, Expense, Budget
+
+
+def _seed():
+    user = User.query.filter_by(email='test@example.com').one()
+    db.session.add_all([
+        Expense(amount='10.00', date=datetime(2024, 1, 1), user_id=user.id, category_id=1),   # Monday
+        Expense(amount='5.50', date=datetime(2024, 1, 7, 22), user_id=user.id, category_id=2), # Sunday
+        Expense(amount='30.00', date=datetime(2024, 3, 15), user_id=user.id, category_id=1),
+        Budget(amount=20, year=2024, month=1, user_id=user.id, category_id=1),
+        Budget(amount=20, year=2024, month=3, user_id=user.id, category_id=1)
+    ])
+    db.session.commit()
+
+
+def test_monthly_series(auth_client):
+    """Test a monthly series is dense with rolling averages and changes"""
+    _seed()
+    data = auth_client.get('/api/analytics/spending?start=2024-01-01&end=2024-03-31&window=2').get_json()
+    series = data['series']
+    assert [p['period'] for p in series] == ['2024-01-01', '2024-02-01', '2024-03-01']
+    assert [p['total'] for p in series] == ['15.50', '0.00', '30.00']
+    assert series[0]['by_category'] == {'1': '10.00', '2': '5.50'}
+    assert [p['rolling_average'] for p in series] == ['15.50', '7.75', '15.00']
+    assert [p['change'] for p in series] == [None, '-15.50', '30.00']
+    assert [p['change_percent'] for p in series] == [None, -100.0, None]
+
+
+def test_weekly_and_daily_series_use_one_query(auth_client):
+    """Test day and week buckets are computed by a single grouped query"""
+    _seed()
+    statements = []
+    engine = db.engine
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(engine, 'after_cursor_execute', record)
+    try:
+        weekly = auth_client.get('/api/analytics/spending?start=2024-01-01&end=2024-01-14&granularity=week')
+    finally:
+        event.remove(engine, 'after_cursor_execute', record)
+    assert [(p['period'], p['total']) for p in weekly.get_json()['series']] == [
+        ('2024-01-01', '15.50'), ('2024-01-08', '0.00')]
+    assert len([s for s in statements if 'FROM expense' in s]) == 1
+
+    daily = auth_client.get('/api/analytics/spending?start=2024-01-06&end=2024-01-07&granularity=day&category=2')
+    assert [(p['period'], p['total']) for p in daily.get_json()['series']] == [
+        ('2024-01-06', '0.00'), ('2024-01-07', '5.50')]
+
+
+def test_breakdown_and_budget_adherence(auth_client):
+    """Test category shares and monthly budget adherence"""
+    _seed()
+    breakdown = auth_client.get('/api/analytics/categories?start=2024-01-01&end=2024-03-31').get_json()
+    assert breakdown['total'] == '45.50'
+    assert [(c['id'], c['total'], c['count'], c['share_percent']) for c in breakdown['categories']] == [
+        (1, '40.00', 2, 87.9), (2, '5.50', 1, 12.1)]
+
+    budgets = auth_client.get('/api/analytics/budgets?start=2024-01-01&end=2024-03-31').get_json()
+    assert (budgets['months_budgeted'], budgets['months_within_budget']) == (2, 1)
+    january, february, march = budgets['months']
+    assert (january['within_budget'], january['percent_used']) == (True, 77.5)
+    assert february['within_budget'] is None
+    assert (march['within_budget'], march['categories_over_budget']) == (False, 1)
+
+
+def test_etag_revalidation(auth_client):
+    """Test unchanged results are answered with 304 until the user's data changes"""
+    _seed()
+    url = '/api/analytics/spending?start=2024-01-01&end=2024-03-31'
+    first = auth_client.get(url)
+    etag = first.headers['ETag']
+    assert auth_client.get(url, headers={'If-None-Match': etag}).status_code == 304
+
+    auth_client.post('/expenses', data=dict(amount=1, category=1, date='2024-02-02'))
+    second = auth_client.get(url, headers={'If-None-Match': etag})
+    assert second.status_code == 200 and second.headers['ETag'] != etag
+    assert second.get_json()['series'][1]['total'] == '1.00'
+
+
+def test_invalid_arguments(auth_client):
+    """Test bad ranges and granularities are rejected"""
+    assert auth_client.get('/api/analytics/spending?granularity=year').status_code == 400
+    assert auth_client.get('/api/analytics/spending?start=2024-02-01&end=2024-01-01').status_code == 400
+    assert auth_client.get('/api/analytics/spending?start=2000-01-01&granularity=day').status_code == 400
@@ -0,0 +1,151 @@
+import gzip
+import json
+from app import db, importer
+from app.models import User, Expense, Budget, ChangeLog
+
+
+def _token(client, email='test@example.com', password='password'):
+    response = client.post('/api/v1/tokens', json={'email': email, 'password': password, 'name': 'phone'})
+    assert response.status_code == 201
+    return {'Authorization': f"Bearer {response.get_json()['token']}"}
+
+
+def _create(client, headers, *expenses):
+    return client.post('/api/v1/expenses', headers=headers, json={'expenses': [
+        {'amount': amount, 'date': date, 'description': description, 'category_id': 1}
+        for amount, date, description in expenses
+    ]})
+
+
+def test_token_required(auth_client):
+    """Test the API takes bearer tokens only, not the browser session, and tokens can be revoked"""
+    assert auth_client.get('/api/v1/expenses').status_code == 401
+    assert auth_client.post('/api/v1/tokens', json={'email': 'test@example.com', 'password': 'wrong'}).status_code == 401
+    headers = _token(auth_client)
+    assert auth_client.get('/api/v1/expenses', headers=headers).status_code == 200
+    assert auth_client.delete('/api/v1/tokens/current', headers=headers).status_code == 204
+    response = auth_client.get('/api/v1/expenses', headers=headers)
+    assert response.status_code == 401
+    assert response.headers['WWW-Authenticate'] == 'Bearer'
+
+
+def test_batch_create_and_delete(auth_client):
+    """Test a batch is created in one go, rejected whole if any item is invalid, and deleted by id"""
+    headers = _token(auth_client)
+    response = _create(auth_client, headers, ('12.50', '2024-03-01', 'Lunch'), ('oops', '2024-03-02', 'Bus'))
+    assert response.status_code == 422
+    assert response.get_json()['errors'] == [{'index': 1, 'field': 'amount', 'message': 'Must be a decimal number'}]
+    assert Expense.query.count() == 0
+
+    response = _create(auth_client, headers, ('12.50', '2024-03-01', 'Lunch'), ('2.75', '2024-03-02', 'Bus'))
+    assert response.status_code == 201
+    created = response.get_json()['expenses']
+    assert [(e['amount'], e['description']) for e in created] == [('12.50', 'Lunch'), ('2.75', 'Bus')]
+
+    other = User(username='other', email='other@example.com', password='x')
+    db.session.add(other)
+    db.session.commit()
+    db.session.add(Expense(amount='9.00', user_id=other.id, category_id=1))
+    db.session.commit()
+    ids = [e['id'] for e in created] + [Expense.query.filter_by(user_id=other.id).one().id]
+    response = auth_client.delete('/api/v1/expenses', headers=headers, json={'ids': ids})
+    assert response.get_json()['deleted'] == ids[:2]
+    assert Expense.query.count() == 1
+
+    response = auth_client.put('/api/v1/budgets', headers=headers, json={'budgets': [
+        {'category_id': 1, 'year': 2024, 'month': 3, 'amount': '100'},
+        {'category_id': 1, 'year': 2024, 'month': 3, 'amount': '120'}
+    ]})
+    assert [b['amount'] for b in response.get_json()['budgets']] == ['120.00']
+    assert Budget.query.one().amount_cents == 12000
+
+
+def test_category_ids_must_be_integers(auth_client):
+    """Test category ids of the wrong JSON type are reported per item rather than failing the request"""
+    headers = _token(auth_client)
+    response = auth_client.post('/api/v1/expenses', headers=headers, json={'expenses': [
+        {'amount': '1.00', 'date': '2024-03-01', 'category_id': category_id} for category_id in ([1], {'id': 1}, True)
+    ]})
+    assert response.status_code == 422
+    assert response.get_json()['errors'] == [
+        {'index': index, 'field': 'category_id', 'message': 'Must be an integer'} for index in range(3)]
+    response = auth_client.put('/api/v1/budgets', headers=headers, json={'budgets': [
+        {'category_id': [1], 'year': 2024, 'month': 3, 'amount': '100'}]})
+    assert response.status_code == 422
+    assert Expense.query.count() == 0 and Budget.query.count() == 0
+
+
+def test_sparse_fields_and_gzip(auth_client):
+    """Test fields limits what is returned, large responses are gzipped both ways and bodies are capped"""
+    headers = _token(auth_client)
+    body = json.dumps({'expenses': [{'amount': '1.00', 'date': '2024-03-01', 'description': f'Item {i}',
+                                     'category_id': 1} for i in range(60)]}).encode()
+    response = auth_client.post('/api/v1/expenses', data=gzip.compress(body), content_type='application/json',
+                                headers={**headers, 'Content-Encoding': 'gzip'})
+    assert response.status_code == 201
+
+    response = auth_client.get('/api/v1/expenses?fields=id,amount&per_page=50',
+                               headers={**headers, 'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    page = json.loads(gzip.decompress(response.data))
+    assert len(page['expenses']) == 50
+    assert set(page['expenses'][0]) == {'id', 'amount'}
+    assert page['next_cursor']
+    assert auth_client.get('/api/v1/expenses?fields=id,secret', headers=headers).status_code == 400
+
+    # Uncompressed bodies are limited too
+    response = auth_client.post('/api/v1/expenses', data=b' ' * (5 * 1024 * 1024 + 1),
+                                content_type='application/json', headers=headers)
+    assert response.status_code == 413
+
+
+def test_conditional_get(auth_client):
+    """Test unchanged collections are answered with 304 until any write, even one the rollup ignores"""
+    headers = _token(auth_client)
+    _create(auth_client, headers, ('5.00', '2024-03-01', 'Coffee'))
+    response = auth_client.get('/api/v1/expenses', headers=headers)
+    etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+    assert etag.startswith('W/')
+    assert auth_client.get('/api/v1/expenses', headers={**headers, 'If-None-Match': etag}).status_code == 304
+    assert auth_client.get('/api/v1/expenses',
+                           headers={**headers, 'If-Modified-Since': last_modified}).status_code == 304
+
+    expense = Expense.query.one()
+    expense.description = 'Flat white'
+    db.session.commit()
+    response = auth_client.get('/api/v1/expenses', headers={**headers, 'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.get_json()['expenses'][0]['description'] == 'Flat white'
+
+
+def test_delta_sync(auth_client):
+    """Test changes after a cursor cover every write path, each row once in its latest state"""
+    headers = _token(auth_client)
+    cursor = auth_client.get('/api/v1/changes', headers=headers).get_json()['cursor']
+
+    first, second = [e['id'] for e in _create(
+        auth_client, headers, ('1.00', '2024-03-01', 'Tea'), ('2.00', '2024-03-02', 'Cake')).get_json()['expenses']]
+    Expense.query.filter_by(id=second).one().description = 'Carrot cake'
+    db.session.commit()
+    auth_client.delete('/api/v1/expenses', headers=headers, json={'ids': [first]})
+    # The importer's Core inserts are logged too
+    user_id = User.query.filter_by(email='test@example.com').one().id
+    importer.import_expenses(user_id, ['Date,Category,Description,Amount', '2024-03-05,Food,Imported,3.00'])
+
+    response = auth_client.get(f'/api/v1/changes?cursor={cursor}', headers=headers).get_json()
+    changes = {(c['type'], c['id']): c for c in response['changes']}
+    assert changes[('expense', first)]['deleted']
+    assert changes[('expense', second)]['data']['description'] == 'Carrot cake'
+    assert [c['data']['description'] for c in response['changes'] if c['type'] == 'expense' and c['id'] > second] == ['Imported']
+    assert len(response['changes']) == 3
+    assert not response['has_more']
+    # Logged once per batch, not by the per-row trigger as well
+    imported = Expense.query.filter_by(description='Imported').one().id
+    assert ChangeLog.query.filter_by(entity='expense', entity_id=imported).count() == 1
+
+    # Nothing new after the returned cursor, and another user's writes stay invisible
+    db.session.add(User(username='other', email='other@example.com', password='x'))
+    db.session.commit()
+    db.session.add(Expense(amount='9.00', user_id=User.query.filter_by(username='other').one().id, category_id=1))
+    db.session.commit()
+    assert auth_client.get(f"/api/v1/changes?cursor={response['cursor']}", headers=headers).get_json()['changes'] == []
@@ -1,23 +1,3 @@
-import pytest
-from app import create_app, db, bcrypt
-from app.models import User, Category
-
-@pytest.fixture
-def client():
-    app = create_app()
-    app.config['TESTING'] = True
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
-    app.config['WTF_CSRF_ENABLED'] = False # Disable CSRF for testing
-
-    with app.test_client() as client:
-        with app.app_context():
-            db.create_all()
-            # Create default categories
-            c1 = Category(name='Food')
-            db.session.add(c1)
-            db.session.commit()
-            yield client
-
 def test_home_page(client):
     """Test that home page redirects to login if not authenticated"""
     response = client.get('/')
@@ -0,0 +1,20 @@
+from benchmarks.run import run, compare
+
+
+def test_benchmark_harness_smoke():
+    """Test the benchmark harness seeds data and measures every route"""
+    results = run(users=2, expenses=50, years=1, iterations=2, pages=2, config={'BCRYPT_LOG_ROUNDS': 4})
+    assert set(results['routes']) == {
+        'dashboard', 'expenses', 'expenses_deep_pages', 'reports', 'download_budget_spending',
+        'download_expenses', 'download_expenses_filtered', 'login'
+    }
+    assert all(r['p95_ms'] > 0 for r in results['routes'].values())
+    assert results['routes']['download_expenses']['statements'] >= 1
+    assert compare(results, results) == []
+
+
+def test_benchmark_compare_flags_regressions():
+    """Test slower routes and extra statements are reported"""
+    baseline = {'routes': {'dashboard': {'p50_ms': 5, 'p95_ms': 10, 'statements': 3, 'peak_kib': 1}}}
+    results = {'routes': {'dashboard': {'p50_ms': 50, 'p95_ms': 100, 'statements': 9, 'peak_kib': 1}}}
+    assert len(compare(results, baseline)) == 2
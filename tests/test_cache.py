@@ -0,0 +1,50 @@
+import time
+from datetime import datetime
+from app.cache import cache, LRUBackend, FileSystemBackend
+
+
+def test_lru_backend_evicts_and_expires():
+    """Test least recently used and expired entries are evicted"""
+    backend = LRUBackend(max_entries=2)
+    backend.set('a', 1, 60)
+    backend.set('b', 2, 60)
+    backend.get('a')
+    backend.set('c', 3, 60)
+    assert backend.get('b') is None
+    assert backend.get('a')[1] == 1
+    backend.set('d', 4, -1)
+    assert backend.get('d') is None
+    assert backend.evictions == 3
+
+
+def test_filesystem_backend(tmp_path):
+    """Test the filesystem backend round-trips and prunes entries"""
+    backend = FileSystemBackend(str(tmp_path), max_entries=2)
+    for i, key in enumerate('abc'):
+        backend.set(key, {'n': i}, 60)
+        time.sleep(0.01)
+    assert len(backend) == 2
+    assert backend.get('c')[1] == {'n': 2}
+    backend.delete('c')
+    assert backend.get('c') is None
+
+
+def test_dashboard_cache_invalidated_by_writes(auth_client):
+    """Test the dashboard is served from cache until an expense or budget changes"""
+    now = datetime.now()
+    auth_client.get('/dashboard') # Logging in already rendered it once
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    auth_client.post('/expenses', data=dict(amount=40, category=1, date=now.strftime('%Y-%m-%d')))
+    assert b'$40.00' in auth_client.get('/dashboard').data
+    assert cache.misses == 2
+
+    auth_client.post('/budgets', data=dict(amount=50, category=1, month=now.month, year=now.year))
+    response = auth_client.get('/dashboard')
+    assert b'$50.00' in response.data and b'90% Used' not in response.data
+    assert cache.misses == 3
+
+    stats = cache.stats()
+    assert stats['backend'] == 'LRUBackend' and stats['misses'] == 3
+    # Exported with /metrics only, not to every logged-in user
+    assert auth_client.get('/cache/stats').status_code == 404
@@ -0,0 +1,85 @@
+from datetime import datetime
+from app import db, refdata
+from app.aggregates import budget_vs_spending, table_totals
+from app.models import User, Category, Expense, Budget
+
+
+def _users():
+    alice = User(username='alice', email='alice@example.com', password='x')
+    bob = User(username='bob', email='bob@example.com', password='x')
+    db.session.add_all([alice, bob])
+    db.session.commit()
+    return alice.id, bob.id
+
+
+def _add(name, user_id, parent_id=None):
+    category = Category(name=name, user_id=user_id, parent_id=parent_id)
+    db.session.add(category)
+    db.session.commit()
+    return category
+
+
+def test_per_user_tree(client):
+    """Test users see the default categories plus their own, nested by path"""
+    alice, bob = _users()
+    food = db.session.get(Category, 1) # Food
+    groceries = _add('Groceries', alice, food.id)
+    organic = _add('Organic', alice, groceries.id)
+    assert organic.path == f'/{food.id}/{groceries.id}/{organic.id}/' and organic.depth == 2
+
+    bob_version = refdata.category_version(bob)
+    tree = refdata.category_tree(alice)
+    assert [(node.label, node.depth) for node in tree][:3] == [
+        ('Food', 0), ('Food / Groceries', 1), ('Food / Groceries / Organic', 2)]
+    assert refdata.category_choices(alice)[2] == (organic.id, '— — Organic')
+    assert refdata.subtree_ids(alice, food.id) == [food.id, groceries.id, organic.id]
+    # Other users neither see nor have to reload alice's categories
+    assert 'Groceries' not in [node.name for node in refdata.category_tree(bob)]
+    assert refdata.category_version(bob) == bob_version
+
+
+def test_subtree_rollup(client):
+    """Test a category's spending includes its subcategories, counted once in the totals"""
+    alice, bob = _users()
+    food = db.session.get(Category, 1) # Food
+    groceries = _add('Groceries', alice, food.id)
+    db.session.add_all([
+        Expense(amount='20.00', date=datetime(2024, 3, 2), user_id=alice, category_id=food.id),
+        Expense(amount='30.00', date=datetime(2024, 3, 3), user_id=alice, category_id=groceries.id),
+        Expense(amount='99.00', date=datetime(2024, 3, 3), user_id=bob, category_id=food.id),
+        Budget(amount='100.00', year=2024, month=3, user_id=alice, category_id=food.id)
+    ])
+    db.session.commit()
+
+    rows = {row['category_id']: row for row in budget_vs_spending(alice, 2024, 3)}
+    assert rows[food.id]['spending'] == 50 and rows[food.id]['remaining'] == 50
+    assert rows[groceries.id]['category'] == 'Food / Groceries' and rows[groceries.id]['spending'] == 30
+    assert table_totals(budget_vs_spending(alice, 2024, 3)) == (50, 100)
+
+    # A subcategory's budget is a share of its parent's, not on top of it;
+    # one whose parent has no budget counts on its own
+    transport = db.session.get(Category, 2)
+    taxis = _add('Taxis', alice, transport.id)
+    db.session.add_all([
+        Budget(amount='40.00', year=2024, month=3, user_id=alice, category_id=groceries.id),
+        Budget(amount='25.00', year=2024, month=3, user_id=alice, category_id=taxis.id)
+    ])
+    db.session.commit()
+    assert table_totals(budget_vs_spending(alice, 2024, 3)) == (50, 125)
+
+
+def test_category_routes(auth_client):
+    """Test adding a subcategory makes it selectable, and used categories are kept"""
+    food = db.session.get(Category, 1) # Food
+    response = auth_client.post('/categories', data=dict(name='Coffee', parent=food.id), follow_redirects=True)
+    assert b'Category added!' in response.data
+    duplicate = auth_client.post('/categories', data=dict(name='coffee', parent=food.id))
+    assert b'already a category with that name' in duplicate.data
+
+    coffee = Category.query.filter_by(name='Coffee').one()
+    assert b'\xe2\x80\x94 Coffee' in auth_client.get('/expenses').data
+    auth_client.post('/expenses', data=dict(amount=3, category=coffee.id, description='Flat white', date='2024-01-01'))
+    response = auth_client.get(f'/category/delete/{coffee.id}', follow_redirects=True)
+    assert b'Only categories without' in response.data
+    response = auth_client.get(f'/category/delete/{food.id}', follow_redirects=True)
+    assert b'only delete your own' in response.data
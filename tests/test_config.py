@@ -0,0 +1,38 @@
+import pytest
+from sqlalchemy import text
+from app import create_app, db
+from app.config import config_for, _database_url
+
+
+def test_production_sqlite_pragmas(tmp_path, monkeypatch):
+    monkeypatch.setenv('APP_ENV', 'production')
+    app = create_app({
+        'SECRET_KEY': 'test',
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / "prod.db"}',
+        'CACHE_DIR': str(tmp_path / 'cache')
+    })
+    assert app.config['APP_ENV'] == 'production'
+    assert app.config['CACHE_TYPE'] == 'filesystem'
+    with app.app_context():
+        assert db.engine.pool.size() == app.config['SQLALCHEMY_ENGINE_OPTIONS']['pool_size']
+        with db.engine.connect() as conn:
+            assert conn.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+            assert conn.execute(text('PRAGMA synchronous')).scalar() == 1 # NORMAL
+            assert conn.execute(text('PRAGMA busy_timeout')).scalar() == 5000
+            assert conn.execute(text('PRAGMA mmap_size')).scalar() == 256 * 1024 * 1024
+        db.engine.dispose()
+
+
+def test_production_requires_secret_key(monkeypatch):
+    monkeypatch.setenv('APP_ENV', 'production')
+    with pytest.raises(RuntimeError):
+        create_app({'SECRET_KEY': None, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:'})
+
+
+def test_database_url(monkeypatch):
+    monkeypatch.setenv('DATABASE_URL', 'postgres://user:pw@db/expenses')
+    assert _database_url() == 'postgresql://user:pw@db/expenses'
+    monkeypatch.delenv('DATABASE_URL')
+    assert _database_url() is None
+    with pytest.raises(ValueError):
+        config_for('staging')
@@ -0,0 +1,51 @@
+import gzip
+from datetime import datetime
+from app import db
+from app.exports import csv_chunks
+from app.models import User, Expense
+
+
+def _add_expenses(user_id):
+    db.session.add_all([
+        Expense(amount=10, date=datetime(2024, 1, 15), description='Groceries', user_id=user_id, category_id=1),
+        Expense(amount=20, date=datetime(2024, 2, 10), description='Bus pass', user_id=user_id, category_id=2),
+        Expense(amount=30, date=datetime(2024, 3, 5), user_id=user_id, category_id=1)
+    ])
+    db.session.commit()
+
+
+def test_download_expenses_streams_filtered_csv(auth_client):
+    """Test the export honours date and category filters"""
+    user = User.query.filter_by(email='test@example.com').first()
+    _add_expenses(user.id)
+
+    response = auth_client.get('/reports/download/expenses')
+    assert response.is_streamed
+    assert response.data.decode().splitlines() == [
+        'Date,Category,Description,Amount',
+        '2024-03-05,Food,,30.00',
+        '2024-02-10,Transport,Bus pass,20.00',
+        '2024-01-15,Food,Groceries,10.00'
+    ]
+
+    response = auth_client.get('/reports/download/expenses?start=2024-01-01&end=2024-02-29&category=1')
+    assert response.data.decode().splitlines()[1:] == ['2024-01-15,Food,Groceries,10.00']
+    assert 'expenses_2024-01-01_2024-02-29.csv' in response.headers['Content-Disposition']
+
+    assert auth_client.get('/reports/download/expenses?start=yesterday').status_code == 400
+
+
+def test_download_expenses_gzip(auth_client):
+    """Test the export is gzip-encoded when the client accepts it"""
+    user = User.query.filter_by(email='test@example.com').first()
+    _add_expenses(user.id)
+
+    response = auth_client.get('/reports/download/expenses', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.data).decode().count('\n') == 4
+
+
+def test_csv_chunks():
+    """Test rows are emitted in fixed-size chunks"""
+    chunks = list(csv_chunks(([i] for i in range(5)), headers=['n'], chunk_rows=2))
+    assert chunks == ['n\r\n0\r\n1\r\n', '2\r\n3\r\n', '4\r\n']
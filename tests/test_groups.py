@@ -0,0 +1,120 @@
+from datetime import datetime
+import pytest
+from sqlalchemy import event
+from app import db, groups
+from app.models import User, GroupMember, GroupBudget, Budget
+
+
+def _users(*names):
+    users = [User(username=name, email=f'{name}@example.com', password='x') for name in names]
+    db.session.add_all(users)
+    db.session.commit()
+    return [user.id for user in users]
+
+
+def test_split_cents():
+    """Test splits always add up to the amount exactly"""
+    assert groups.split_cents(1000, {1: 1, 2: 1, 3: 1}) == {1: 334, 2: 333, 3: 333}
+    assert groups.split_cents(101, {1: 2, 2: 1}) == {1: 67, 2: 34}
+    for total in range(0, 200, 7):
+        assert sum(groups.split_cents(total, {1: 3, 2: 5, 3: 1, 4: 1}).values()) == total
+
+
+def test_dashboard_in_one_query(client):
+    """Test budget vs spending and balances come from a single cached query"""
+    alice, bob, carol = _users('alice', 'bob', 'carol')
+    group_id = groups.create(alice, 'Flat').id
+    groups.set_member(group_id, bob, 'member')
+    groups.set_member(group_id, carol, 'viewer')
+    now = datetime.now()
+    groups.add_expense(group_id, alice, '90.00', 'Groceries', date=now, category_id=1)
+    groups.add_expense(group_id, bob, '30.00', 'Milk', date=now, category_id=1, weights={alice: 1, bob: 1})
+    groups.set_budget(group_id, 1, now.year, now.month, '100.00')
+
+    statements = []
+    listener = lambda *args: statements.append(args[2])
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    try:
+        summary = groups.dashboard(group_id, now.year, now.month)
+        groups.dashboard(group_id, now.year, now.month)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', listener)
+    # The union, the member list for the balances, and the default categories
+    assert len([s for s in statements if 'UNION ALL' in s]) == 1
+    assert len(statements) <= 3
+
+    food = summary['budget_vs_spending'][0]
+    assert (food['spending'], food['budget']) == (120, 100)
+    assert food['alert']
+    balances = {b.username: b.balance for b in summary['balances']}
+    assert balances == {'alice': 45, 'bob': -15, 'carol': -30}
+    assert sum(balances.values()) == 0
+
+    # Any write to the group gives the next request fresh numbers
+    groups.add_expense(group_id, carol, '30.00', 'Bread', date=now, category_id=1)
+    assert groups.dashboard(group_id, now.year, now.month)['total_spending'] == 150
+
+
+def test_roles_enforced(auth_client):
+    """Test non-members cannot see a group and viewers cannot write to it"""
+    me = User.query.filter_by(email='test@example.com').one().id
+    owner, = _users('owner')
+    group = groups.create(owner, 'Not mine')
+    assert auth_client.get(f'/groups/{group.id}').status_code == 404
+
+    groups.set_member(group.id, me, 'viewer')
+    assert auth_client.get(f'/groups/{group.id}').status_code == 200
+    response = auth_client.post(f'/groups/{group.id}', data={
+        'budget-amount': '50.00', 'budget-category': 1, 'budget-month': 1, 'budget-year': 2024,
+        'budget-submit': 'Set Budget'
+    })
+    assert response.status_code == 403
+    assert GroupBudget.query.count() == 0
+
+    groups.set_member(group.id, me, 'member')
+    assert GroupMember.query.filter_by(group_id=group.id).count() == 2
+    response = auth_client.post(f'/groups/{group.id}', data={
+        'member-email': 'test@example.com', 'member-role': 'owner', 'member-submit': 'Add Member'
+    })
+    assert response.status_code == 403
+
+
+def test_group_keeps_an_owner(auth_client):
+    """Test the last owner can be neither demoted nor demote themselves, while one of two can"""
+    me = User.query.filter_by(email='test@example.com').one().id
+    other, = _users('other')
+    group = groups.create(me, 'Flat')
+    response = auth_client.post(f'/groups/{group.id}', data={
+        'member-email': 'test@example.com', 'member-role': 'member', 'member-submit': 'Add Member'
+    })
+    assert response.status_code == 200 and b'A group must keep at least one owner' in response.data
+    assert groups.membership(group.id, me).role == 'owner'
+
+    groups.set_member(group.id, other, 'owner')
+    groups.set_member(group.id, me, 'viewer')
+    with pytest.raises(ValueError):
+        groups.set_member(group.id, other, 'member')
+    assert [role for _, _, role in groups.members(group.id)] == ['owner', 'viewer']
+
+
+def test_budget_upserts(auth_client):
+    """Test saving a budget twice updates one row in place"""
+    now = datetime.now()
+    for amount in ('100.00', '250.00'):
+        auth_client.post('/budgets', data={
+            'amount': amount, 'category': 1, 'month': now.month, 'year': now.year
+        }, follow_redirects=True)
+    budgets = Budget.query.all()
+    assert len(budgets) == 1
+    assert budgets[0].amount == 250
+
+    owner = User.query.filter_by(email='test@example.com').one().id
+    group = groups.create(owner, 'Home')
+    for amount in ('10.00', '20.00'):
+        response = auth_client.post(f'/groups/{group.id}', data={
+            'budget-amount': amount, 'budget-category': 1, 'budget-month': now.month, 'budget-year': now.year,
+            'budget-submit': 'Set Budget'
+        }, follow_redirects=True)
+        assert b'Group budget saved!' in response.data
+    assert [b.amount for b in GroupBudget.query.all()] == [20]
+    assert groups.dashboard(group.id, now.year, now.month)['total_budget'] == 20
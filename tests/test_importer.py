@@ -0,0 +1,56 @@
+import io
+from decimal import Decimal
+from app import db, rollup, search
+from app.models import User, Expense, ChangeLog
+
+CSV_DATA = b"""Date,Category,Description,Amount
+2024-01-15,Food,Groceries,10.50
+2024-01-16,transport,Bus,2.75
+2024-01-17,Hobbies,Paint,5.00
+not-a-date,Food,Oops,1.00
+2024-01-18,Food,Refund,-3.00
+"""
+
+OFX_DATA = b"""OFXHEADER:100
+<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS><BANKTRANLIST>
+<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20240203120000<TRNAMT>-42.10<NAME>Power Co</STMTTRN>
+<STMTTRN><TRNTYPE>CREDIT<DTPOSTED>20240204<TRNAMT>1000.00<NAME>Salary</STMTTRN>
+</BANKTRANLIST></STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>
+"""
+
+
+def test_import_csv_upload(auth_client):
+    """Test a CSV upload imports valid rows and reports the rest"""
+    response = auth_client.post('/expenses/import', data={
+        'file': (io.BytesIO(CSV_DATA), 'history.csv')
+    }, content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert b'Imported 2 expenses.' in response.data
+    assert b"Unknown category &#39;Hobbies&#39;" in response.data
+    assert b"Invalid date &#39;not-a-date&#39;" in response.data
+    assert b'Amount must be positive' in response.data
+
+    user = User.query.filter_by(email='test@example.com').first()
+    assert sorted(e.amount for e in Expense.query.filter_by(user_id=user.id)) == [2.75, 10.5]
+    assert rollup.verify() == []
+    # Indexed for search once per batch, not by the per-row trigger as well
+    assert [e.description for e, score in search.search(user.id, 'groc').items] == ['Groceries']
+    # The insert triggers are back for everything else
+    expense = Expense(amount='4.00', description='Greengrocer', user_id=user.id, category_id=1)
+    db.session.add(expense)
+    db.session.commit()
+    assert len(search.search(user.id, 'gr').items) == 2
+    assert ChangeLog.query.filter_by(entity='expense', entity_id=expense.id).count() == 1
+
+
+def test_import_ofx_cli(auth_client, tmp_path):
+    """Test the CLI imports OFX debits in batches and skips deposits"""
+    path = tmp_path / 'statement.ofx'
+    path.write_bytes(OFX_DATA)
+    runner = auth_client.application.test_cli_runner()
+    result = runner.invoke(args=['import-expenses', str(path), '--user', 'test@example.com', '--batch-size', '1'])
+    assert 'Imported 1 expenses, skipped 1, 0 errors.' in result.output
+
+    expense = Expense.query.one()
+    assert (expense.amount, expense.description, expense.category.name) == (Decimal('42.10'), 'Power Co', 'Other')
+    assert expense.date.strftime('%Y-%m-%d') == '2024-02-03'
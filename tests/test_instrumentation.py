@@ -0,0 +1,69 @@
+import logging
+import time
+from flask import g
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from app import create_app, db
+from app.models import Category
+
+
+def test_metrics_endpoint(auth_client):
+    """Test latency, statement counts and cache stats are exported"""
+    auth_client.get('/dashboard')
+    body = auth_client.get('/metrics').data.decode()
+    assert '# TYPE http_request_duration_seconds histogram' in body
+    assert 'http_request_duration_seconds_count{endpoint="main.dashboard"} 2' in body
+    assert 'http_requests_total{endpoint="main.login",status="302"} 1' in body
+    assert 'db_statements_total{endpoint="main.register"}' in body
+    assert 'cache_hits_total 1' in body
+
+
+def test_n_plus_one_and_slow_requests_logged(caplog):
+    """Test repeated statements and slow requests are flagged"""
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:', 'SLOW_REQUEST_MS': 0})
+
+    @app.route('/n-plus-one')
+    def n_plus_one():
+        for category in Category.query.all():
+            Category.query.filter_by(id=category.id).first()
+        return 'ok'
+
+    client = app.test_client()
+    with caplog.at_level(logging.WARNING):
+        client.get('/n-plus-one')
+    assert 'Possible N+1 query in n_plus_one: statement ran 6 times' in caplog.text
+    assert 'Slow request GET /n-plus-one' in caplog.text
+    assert 'db_n_plus_one_requests_total{endpoint="n_plus_one"} 1' in client.get('/metrics').data.decode()
+
+
+def test_failed_statements_do_not_skew_timings():
+    """Test a statement that raises leaves no start time behind for the next one to pick up"""
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:'})
+
+    @app.route('/failing')
+    def failing():
+        for _ in range(3):
+            try:
+                db.session.execute(text('SELECT * FROM no_such_table'))
+            except OperationalError:
+                db.session.rollback()
+        time.sleep(0.2)
+        db.session.execute(text('SELECT 1'))
+        timings = [elapsed for elapsed, statement in g._request_stats.timings]
+        return {'timings': timings, 'info': sorted(db.session.connection().info)}
+
+    data = app.test_client().get('/failing').get_json()
+    assert '_query_start' not in data['info']
+    # Timed from its own start, not from a failed statement's 0.2 s earlier
+    assert data['timings'][-1] < 0.1
+
+
+def test_metrics_access():
+    """Test /metrics is limited to the allowed addresses, or callers with the token"""
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:', 'METRICS_TOKEN': 's3cret'})
+    client = app.test_client()
+    remote = {'REMOTE_ADDR': '203.0.113.7'}
+    assert client.get('/metrics').status_code == 200
+    assert client.get('/metrics', environ_base=remote).status_code == 403
+    assert client.get('/metrics', environ_base=remote, headers={'Authorization': 'Bearer wrong'}).status_code == 403
+    assert client.get('/metrics', environ_base=remote, headers={'Authorization': 'Bearer s3cret'}).status_code == 200
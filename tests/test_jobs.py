@@ -0,0 +1,146 @@
+import re
+import time
+from datetime import datetime, timedelta
+import pytest
+from app import create_app, db
+from app.models import User, Expense, ReportJob
+
+
+@pytest.fixture
+def inline_jobs(auth_client, tmp_path):
+    """Jobs run synchronously on submit, with results under tmp_path"""
+    runner = auth_client.application.extensions['jobs']
+    runner.workers = 0
+    runner.directory = str(tmp_path)
+    user = User.query.filter_by(email='test@example.com').one()
+    db.session.add(Expense(amount='12.50', date=datetime(2024, 3, 2), description='Lunch', user_id=user.id,
+                           category_id=1))
+    db.session.commit()
+    return auth_client
+
+
+def test_csv_job_is_generated_and_shared(inline_jobs):
+    """Test a job produces the CSV and identical requests share it"""
+    response = inline_jobs.post('/reports/jobs', data=dict(kind='expenses', format='csv', start='2024-03-01'))
+    assert response.status_code == 202
+    job = response.get_json()
+    assert job['status'] == 'done' and response.headers['Location'] == job['status_url']
+
+    download = inline_jobs.get(job['download_url'])
+    assert download.status_code == 200
+    assert download.data.decode().splitlines() == ['Date,Category,Description,Amount', '2024-03-02,Food,Lunch,12.50']
+
+    again = inline_jobs.post('/reports/jobs', data=dict(kind='expenses', format='csv', start='2024-03-01'))
+    assert again.get_json()['id'] == job['id']
+    other = inline_jobs.post('/reports/jobs', data=dict(kind='expenses', format='csv', start='2024-03-02'))
+    assert other.get_json()['id'] != job['id']
+
+
+def test_jobs_are_not_shared_after_a_write(inline_jobs):
+    """Test a request made after the user adds an expense gets a fresh report"""
+    job = inline_jobs.post('/reports/jobs', data=dict(kind='expenses', format='csv')).get_json()
+    user = User.query.filter_by(email='test@example.com').one()
+    db.session.add(Expense(amount='3.00', date=datetime(2024, 3, 3), description='Coffee', user_id=user.id,
+                           category_id=1))
+    db.session.commit()
+
+    again = inline_jobs.post('/reports/jobs', data=dict(kind='expenses', format='csv')).get_json()
+    assert again['id'] != job['id']
+    assert '2024-03-03,Food,Coffee,3.00' in inline_jobs.get(again['download_url']).data.decode()
+
+
+def test_xlsx_and_pdf_jobs(inline_jobs):
+    """Test the spreadsheet and PDF summary formats"""
+    pytest.importorskip('openpyxl')
+    pytest.importorskip('reportlab')
+    xlsx = inline_jobs.post('/reports/jobs', data=dict(kind='budget_spending', format='xlsx', year=2024, month=3))
+    assert inline_jobs.get(xlsx.get_json()['download_url']).data[:2] == b'PK'
+    pdf = inline_jobs.post('/reports/jobs', data=dict(kind='budget_spending', format='pdf', year=2024, month=3))
+    assert inline_jobs.get(pdf.get_json()['download_url']).data[:4] == b'%PDF'
+
+    assert inline_jobs.post('/reports/jobs', data=dict(kind='expenses', format='pdf')).status_code == 400
+
+
+def test_expired_results(inline_jobs):
+    """Test an expired result is gone and a new request makes a new job"""
+    job = inline_jobs.post('/reports/jobs', data=dict(kind='expenses', format='csv')).get_json()
+    db.session.get(ReportJob, job['id']).expires_at = datetime.utcnow() - timedelta(seconds=1)
+    db.session.commit()
+    assert inline_jobs.get(job['download_url']).status_code == 410
+
+    again = inline_jobs.post('/reports/jobs', data=dict(kind='expenses', format='csv')).get_json()
+    assert again['id'] != job['id'] and again['status'] == 'done'
+    assert inline_jobs.get(job['status_url']).get_json()['status'] == 'expired'
+
+
+def test_reports_page_submits_jobs_with_csrf(tmp_path):
+    """Test the reports page renders the job form, and its token is accepted with CSRF protection on"""
+    app = create_app({'TESTING': True, 'BCRYPT_LOG_ROUNDS': 4, 'JOB_WORKERS': 0,
+                      'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / "jobs.db"}',
+                      'JOB_RESULTS_DIR': str(tmp_path / 'reports')})
+    client = app.test_client()
+    with app.app_context():
+        db.session.add(User(username='csrf', email='csrf@example.com', password='x'))
+        db.session.commit()
+    with client.session_transaction() as session:
+        session['_user_id'] = '1'
+
+    assert client.post('/reports/jobs', data=dict(kind='expenses', format='csv')).status_code == 400
+    page = client.get('/reports').data.decode()
+    assert 'id="report-job-form"' in page
+    token = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', page).group(1)
+    response = client.post('/reports/jobs', data=dict(csrf_token=token, kind='expenses', format='csv'))
+    assert response.status_code == 202 and response.get_json()['status'] == 'done'
+
+
+def _orphan(app, **kwargs):
+    """A job left over from a previous process"""
+    with app.app_context():
+        job = ReportJob(user_id=1, kind='budget_spending', format='csv', params='{"month": 1, "year": 2024}',
+                        **kwargs)
+        db.session.add(job)
+        db.session.commit()
+        return job.id
+
+
+def test_jobs_run_in_background(tmp_path):
+    """Test the thread pool picks up jobs, including ones queued before it started"""
+    app = create_app({'TESTING': True, 'WTF_CSRF_ENABLED': False, 'BCRYPT_LOG_ROUNDS': 4,
+                      'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / "jobs.db"}',
+                      'JOB_RESULTS_DIR': str(tmp_path / 'reports')})
+    orphan_id = _orphan(app)
+    client = app.test_client()
+    client.post('/register', data=dict(username='bg', email='bg@example.com', password='password',
+                                       confirm_password='password'))
+    client.post('/login', data=dict(email='bg@example.com', password='password'))
+
+    job = client.post('/reports/jobs', data=dict(kind='expenses', format='csv')).get_json()
+    deadline = time.monotonic() + 10
+    statuses = {}
+    while time.monotonic() < deadline:
+        statuses = {i: client.get(f'/reports/jobs/{i}').get_json()['status'] for i in (job['id'], orphan_id)}
+        if set(statuses.values()) == {'done'}:
+            break
+        time.sleep(0.05)
+    assert set(statuses.values()) == {'done'}
+    app.extensions['jobs'].shutdown()
+    with app.app_context():
+        db.engine.dispose()
+
+
+def test_restart_recovers_jobs_without_a_submission(tmp_path):
+    """Test jobs queued or stuck running when a process died are run on the next process's first request"""
+    config = {'TESTING': True, 'BCRYPT_LOG_ROUNDS': 4, 'JOB_WORKERS': 0,
+              'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / "jobs.db"}',
+              'JOB_RESULTS_DIR': str(tmp_path / 'reports')}
+    app = create_app(config)
+    queued = _orphan(app)
+    stuck = _orphan(app, status='running', started_at=datetime.utcnow() - timedelta(hours=1))
+    with app.app_context():
+        db.engine.dispose()
+
+    restarted = create_app(config)
+    restarted.test_client().get('/login')
+    with restarted.app_context():
+        assert [db.session.get(ReportJob, i).status for i in (queued, stuck)] == ['done', 'done']
+        db.engine.dispose()
@@ -0,0 +1,99 @@
+import sqlite3
+from sqlalchemy import inspect, text
+from app import create_app, db
+from app.aggregates import in_month
+from app.models import Expense
+from app.migrations import head
+
+LEGACY_SCHEMA = """
+CREATE TABLE user (id INTEGER NOT NULL, username VARCHAR(20) NOT NULL, email VARCHAR(120) NOT NULL,
+    password VARCHAR(60) NOT NULL, PRIMARY KEY (id), UNIQUE (username), UNIQUE (email));
+CREATE TABLE category (id INTEGER NOT NULL, name VARCHAR(100) NOT NULL, PRIMARY KEY (id));
+CREATE TABLE budget (id INTEGER NOT NULL, amount FLOAT NOT NULL, month INTEGER NOT NULL, year INTEGER NOT NULL,
+    user_id INTEGER NOT NULL, category_id INTEGER NOT NULL, PRIMARY KEY (id));
+CREATE TABLE expense (id INTEGER NOT NULL, amount FLOAT NOT NULL, date DATETIME NOT NULL, description VARCHAR(200),
+    user_id INTEGER NOT NULL, category_id INTEGER NOT NULL, PRIMARY KEY (id));
+INSERT INTO user VALUES (1, 'old', 'old@example.com', 'x');
+INSERT INTO category VALUES (1, 'Food');
+INSERT INTO budget VALUES (1, 100.0, 3, 2024, 1, 1);
+INSERT INTO budget VALUES (2, 150.0, 3, 2024, 1, 1);
+INSERT INTO expense VALUES (1, 12.5, '2024-03-02 00:00:00.000000', NULL, 1, 1);
+CREATE TABLE "group" (id INTEGER NOT NULL, name VARCHAR(100) NOT NULL, created_by INTEGER NOT NULL,
+    created_at DATETIME, PRIMARY KEY (id));
+CREATE TABLE group_member (id INTEGER NOT NULL, group_id INTEGER NOT NULL, user_id INTEGER NOT NULL,
+    joined_at DATETIME, PRIMARY KEY (id));
+CREATE TABLE shared_expense (id INTEGER NOT NULL, group_id INTEGER NOT NULL, paid_by INTEGER NOT NULL,
+    amount FLOAT NOT NULL, description VARCHAR(200) NOT NULL, date DATETIME, category_id INTEGER, PRIMARY KEY (id));
+CREATE TABLE expense_split (id INTEGER NOT NULL, shared_expense_id INTEGER NOT NULL, user_id INTEGER NOT NULL,
+    amount_owed FLOAT NOT NULL, PRIMARY KEY (id));
+INSERT INTO "group" VALUES (1, 'Flat', 1, NULL);
+INSERT INTO group_member VALUES (1, 1, 1, NULL);
+INSERT INTO group_member VALUES (2, 1, 1, NULL);
+INSERT INTO shared_expense VALUES (1, 1, 1, 9.99, 'Pizza', '2024-03-02 00:00:00.000000', 1);
+INSERT INTO expense_split VALUES (1, 1, 1, 9.99);
+"""
+
+
+def test_upgrade_legacy_database(tmp_path):
+    """Test an existing site.db is upgraded in place"""
+    path = tmp_path / 'site.db'
+    conn = sqlite3.connect(path)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.close()
+
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': f'sqlite:///{path}'})
+    with app.app_context():
+        inspector = inspect(db.engine)
+        assert {'ix_expense_user_date', 'ix_expense_user_category_date'} <= {
+            i['name'] for i in inspector.get_indexes('expense')}
+        assert 'ux_budget_user_period_category' in {i['name'] for i in inspector.get_indexes('budget')}
+        # The duplicate budget was collapsed onto the newest row
+        assert db.session.execute(text('SELECT id, amount_cents, currency FROM budget')).all() == [(2, 15000, 'USD')]
+        assert db.session.execute(text('SELECT version FROM schema_version')).scalar() == head()
+        # Float amounts were converted to integer cents and the old column dropped
+        assert db.session.execute(text('SELECT amount_cents FROM expense')).all() == [(1250,)]
+        assert 'amount' not in {c['name'] for c in inspector.get_columns('expense')}
+        # The rollup was built from the existing expenses
+        assert db.session.execute(text('SELECT total_cents, count FROM monthly_spend')).all() == [(1250, 1)]
+        # Existing categories became shared top-level ones
+        assert db.session.execute(text('SELECT user_id, parent_id, path FROM category')).all() == [(None, None, '/1/')]
+        # Group creators became owners, once, and shared amounts moved to cents
+        assert db.session.execute(text('SELECT user_id, role FROM group_member')).all() == [(1, 'owner')]
+        assert db.session.execute(text('SELECT amount_cents FROM shared_expense')).all() == [(999,)]
+        assert db.session.execute(text('SELECT owed_cents FROM expense_split')).all() == [(999,)]
+        # Writes from now on are logged for delta sync, but the upgrade itself was not
+        assert db.session.execute(text('SELECT COUNT(*) FROM change_log')).scalar() == 0
+        db.session.execute(text("UPDATE expense SET description = 'Lunch'"))
+        assert db.session.execute(text('SELECT entity, entity_id FROM change_log')).all() == [('expense', 1)]
+        # The insert triggers no longer look for bulk inserts on every row
+        sql = dict(db.session.execute(text('SELECT name, sql FROM sqlite_master WHERE sql IS NOT NULL')).all())
+        assert 'WHEN' not in sql['change_log_expense_insert'] and 'WHEN' not in sql['expense_fts_insert']
+        assert 'bulk_write' not in sql
+        # Only occurrences of recurring rules are in their unique index
+        assert 'WHERE recurring_id IS NOT NULL' in sql['ux_expense_recurring_date']
+        db.engine.dispose()
+
+
+def test_month_filter_uses_index(client):
+    """Test monthly totals are answered from the (user_id, date) index"""
+    query = db.session.query(Expense.amount_cents).filter(Expense.user_id == 1, in_month(Expense.date, 2024, 3))
+    sql = str(query.statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+    plan = ' '.join(row[-1] for row in db.session.execute(text('EXPLAIN QUERY PLAN ' + sql)))
+    assert 'USING INDEX ix_expense_user' in plan
+
+
+def test_upgrade_drops_emptied_rollup_months(tmp_path):
+    """Test migration 13 rebuilds the rollup without zero rows"""
+    uri = f'sqlite:///{tmp_path / "site.db"}'
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': uri})
+    with app.app_context():
+        db.session.execute(text('INSERT INTO monthly_spend VALUES (1, 1, 2024, 3, 0, 0)'))
+        db.session.execute(text('UPDATE schema_version SET version = 12'))
+        db.session.commit()
+        db.engine.dispose()
+
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': uri})
+    with app.app_context():
+        assert db.session.execute(text('SELECT COUNT(*) FROM monthly_spend')).scalar() == 0
+        assert db.session.execute(text('SELECT version FROM schema_version')).scalar() == head()
+        db.engine.dispose()
@@ -0,0 +1,63 @@
+import re
+from datetime import datetime
+import pytest
+from app import db
+from app.models import User, Expense
+from app.pagination import encode_cursor, decode_cursor, keyset_paginate, AFTER
+
+
+def _seed(user_id, n):
+    # Pairs of expenses share a date so the id tie-breaker matters
+    db.session.add_all([
+        Expense(amount=i, date=datetime(2024, 1, 1 + i // 2), description=f'e{i}', user_id=user_id, category_id=1)
+        for i in range(n)
+    ])
+    db.session.commit()
+
+
+def test_cursor_round_trip():
+    """Test cursors decode to what was encoded and reject garbage"""
+    token = encode_cursor(datetime(2024, 5, 6, 7, 8), 42, AFTER)
+    assert decode_cursor(token) == (datetime(2024, 5, 6, 7, 8), 42, AFTER)
+    with pytest.raises(ValueError):
+        decode_cursor('not-a-cursor')
+
+
+def test_keyset_paginate_forward_and_back(client):
+    """Test walking all pages forwards then backwards visits every row once"""
+    user = User(username='pager', email='pager@example.com', password='x')
+    db.session.add(user)
+    db.session.commit()
+    _seed(user.id, 11)
+    query = Expense.query.filter_by(user_id=user.id)
+
+    pages, cursor = [], None
+    while True:
+        page = keyset_paginate(query, Expense, cursor=cursor, per_page=4)
+        pages.append([e.description for e in page.items])
+        if not page.has_next:
+            break
+        cursor = page.next_cursor
+    assert pages == [['e10', 'e9', 'e8', 'e7'], ['e6', 'e5', 'e4', 'e3'], ['e2', 'e1', 'e0']]
+
+    page = keyset_paginate(query, Expense, cursor=page.prev_cursor, per_page=4)
+    assert [e.description for e in page.items] == ['e6', 'e5', 'e4', 'e3']
+    page = keyset_paginate(query, Expense, cursor=page.prev_cursor, per_page=4)
+    assert [e.description for e in page.items] == ['e10', 'e9', 'e8', 'e7']
+    assert not page.has_prev and page.has_next
+
+
+def test_expenses_view_links(auth_client):
+    """Test the expenses page renders cursor links and the cached total"""
+    user = User.query.filter_by(email='test@example.com').first()
+    _seed(user.id, 7)
+
+    response = auth_client.get('/expenses')
+    assert b'7 expenses in total' in response.data
+    assert b'Newer' not in response.data
+    next_url = re.search(rb'href="(/expenses\?cursor=[^"]+)"', response.data).group(1).decode()
+
+    response = auth_client.get(next_url.replace('&amp;', '&'))
+    assert b'e1' in response.data and b'e6' not in response.data
+    assert b'Newer' in response.data
+    assert auth_client.get('/expenses?cursor=bogus').status_code == 400
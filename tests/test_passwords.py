@@ -0,0 +1,58 @@
+import threading
+from app import bcrypt, db
+from app.models import User
+from app.passwords import hasher
+
+
+def _login(client, email='test@example.com', password='password'):
+    return client.post('/login', data=dict(email=email, password=password))
+
+
+def test_hashes_on_process_pool(client):
+    """Test hashes made on the pool verify with Flask-Bcrypt and vice versa"""
+    assert hasher.workers > 0
+    pw_hash = hasher.hash('secret')
+    assert bcrypt.check_password_hash(pw_hash, 'secret')
+    assert hasher.check(pw_hash, 'secret')
+    assert not hasher.check(pw_hash, 'wrong')
+
+
+def test_rehash_on_login_when_cost_changes(client):
+    """Test a hash made with an old cost factor is replaced on login"""
+    old_hash = bcrypt.generate_password_hash('password', 4).decode('utf-8')
+    db.session.add(User(username='old', email='old@example.com', password=old_hash))
+    db.session.commit()
+    assert hasher.needs_rehash(old_hash)
+
+    response = _login(client, 'old@example.com')
+    assert response.status_code == 302
+    user = db.session.execute(db.select(User).filter_by(email='old@example.com')).scalar_one()
+    assert user.password.startswith('$2b$12$')
+    assert not hasher.needs_rehash(user.password)
+
+
+def test_login_throttled_before_hashing(client, monkeypatch):
+    """Test attempts beyond the per-email limit are refused without a hash check"""
+    limit = client.application.config['LOGIN_ATTEMPTS_PER_EMAIL']
+    # A long window, so the attempts don't straddle a window boundary
+    client.application.config['LOGIN_ATTEMPT_WINDOW'] = 3600
+    for _ in range(limit):
+        assert _login(client, password='wrong').status_code == 200
+
+    def fail(*args):
+        raise AssertionError('hashed a throttled login')
+    monkeypatch.setattr(hasher, 'check', fail)
+    response = _login(client, password='wrong')
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) > 0
+    assert b'Too many attempts' in response.data
+
+
+def test_full_hash_queue_refuses_login(auth_client, monkeypatch):
+    """Test a login is refused with 503 rather than queued when every slot is taken"""
+    auth_client.get('/logout')
+    monkeypatch.setattr(hasher, '_slots', threading.BoundedSemaphore(1))
+    hasher._slots.acquire()
+    response = _login(auth_client)
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
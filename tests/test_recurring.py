@@ -0,0 +1,87 @@
+from datetime import date
+from app import db, recurring, rollup
+from app.aggregates import dashboard_summary
+from app.models import User, Expense, RecurringExpense
+
+
+def _rule(user_id, **kw):
+    rule = RecurringExpense(amount=kw.pop('amount', '1000.00'), user_id=user_id, category_id=1,
+                            description=kw.pop('description', 'Rent'), **kw)
+    recurring.reset(rule)
+    db.session.add(rule)
+    db.session.commit()
+    return rule
+
+
+def _user():
+    user = User(username='renter', email='renter@example.com', password='x')
+    db.session.add(user)
+    db.session.commit()
+    return user.id
+
+
+def _dates(rule_id):
+    return [e.date.date() for e in Expense.query.filter_by(recurring_id=rule_id).order_by(Expense.date)]
+
+
+def test_occurrences():
+    """Test monthly rules keep their day of month and interval rules step evenly"""
+    monthly = RecurringExpense(frequency='monthly', interval=1, start_date=date(2024, 1, 31))
+    assert [recurring.occurrence(monthly, n) for n in range(4)] == [
+        date(2024, 1, 31), date(2024, 2, 29), date(2024, 3, 31), date(2024, 4, 30)]
+    every_ten_days = RecurringExpense(frequency='daily', interval=10, start_date=date(2024, 1, 1))
+    assert recurring.occurrence(every_ten_days, 3) == date(2024, 1, 31)
+    fortnightly = RecurringExpense(frequency='weekly', interval=2, start_date=date(2024, 1, 1))
+    assert recurring.occurrence(fortnightly, 2) == date(2024, 1, 29)
+
+
+def test_materialize_is_idempotent(client):
+    """Test due occurrences are written once, honour the end date and feed the rollup"""
+    user_id = _user()
+    rent = _rule(user_id, frequency='monthly', interval=1, start_date=date(2024, 1, 1), end_date=date(2024, 4, 15))
+    gym = _rule(user_id, amount='10.00', description='Gym', frequency='weekly', interval=1,
+                start_date=date(2024, 3, 1))
+
+    assert recurring.materialize_due(date(2024, 3, 10), rules_per_batch=1) == 3 + 2
+    assert recurring.materialize_due(date(2024, 3, 10)) == 0
+    assert _dates(rent.id) == [date(2024, 1, 1), date(2024, 2, 1), date(2024, 3, 1)]
+
+    # A deleted occurrence is not brought back
+    db.session.delete(Expense.query.filter_by(recurring_id=gym.id).first())
+    db.session.commit()
+    assert recurring.materialize_due(date(2024, 6, 1)) == 1 + 12
+    assert _dates(rent.id)[-1] == date(2024, 4, 1)
+    assert db.session.get(RecurringExpense, rent.id).next_due is None
+    assert rollup.verify() == []
+
+
+def test_stale_claim_writes_nothing(client):
+    """Test a run holding an outdated high-water mark cannot write occurrences again"""
+    user_id = _user()
+    rule = _rule(user_id, frequency='daily', interval=1, start_date=date(2024, 1, 1))
+    stale = RecurringExpense(id=rule.id, user_id=user_id, category_id=1, amount_cents=rule.amount_cents,
+                             frequency='daily', interval=1, start_date=date(2024, 1, 1), materialized=0,
+                             next_due=date(2024, 1, 1))
+    assert recurring.materialize([rule], date(2024, 1, 3)) == 3
+    assert recurring.materialize([stale], date(2024, 1, 3)) == 0
+    assert Expense.query.count() == 3
+
+
+def test_dashboard_projection(auth_client):
+    """Test committed spending shows on the dashboard without creating expenses"""
+    user = User.query.filter_by(email='test@example.com').one()
+    today = date.today()
+    # Due every month on the 28th, starting next month: nothing is spent yet
+    start = date(today.year + 1, 1, 28) if today.month == 12 else date(today.year, today.month + 1, 28)
+    _rule(user.id, amount='750.00', frequency='monthly', interval=1, start_date=start)
+    next_month = dashboard_summary(user.id, start.year, start.month)
+    assert next_month['total_committed'] == 750
+    assert next_month['budget_vs_spending'][0]['projected'] == 750
+    assert Expense.query.count() == 0
+
+    response = auth_client.post('/recurring', data=dict(amount='40', category=1, description='Phone',
+                                                        frequency='monthly', interval=1,
+                                                        start_date=today.isoformat()),
+                                follow_redirects=True)
+    assert b'1 expenses recorded so far' in response.data
+    assert Expense.query.filter_by(description='Phone').count() == 1
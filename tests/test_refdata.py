@@ -0,0 +1,73 @@
+import pytest
+from sqlalchemy import event
+from app import create_app, db, refdata
+from app.models import Category
+
+
+@pytest.fixture
+def isolated_client():
+    """Logged in client whose requests each get their own app context (and g),
+    as in production, so the user loader runs on every request"""
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
+                      'WTF_CSRF_ENABLED': False, 'BCRYPT_LOG_ROUNDS': 4})
+    client = app.test_client()
+    client.post('/register', data=dict(username='snap', email='snap@example.com',
+                                       password='password', confirm_password='password'))
+    client.post('/login', data=dict(email='snap@example.com', password='password'))
+    return client
+
+
+class _Statements:
+    def __init__(self, app):
+        self.app = app
+        self.sql = []
+        with app.app_context():
+            event.listen(db.engine, 'after_cursor_execute', self._record)
+
+    def _record(self, conn, cursor, statement, *args):
+        self.sql.append(statement)
+
+    def close(self):
+        with self.app.app_context():
+            event.remove(db.engine, 'after_cursor_execute', self._record)
+
+
+def test_cached_page_view_issues_no_reference_queries(isolated_client):
+    """Test a repeat dashboard view loads neither the user nor the categories"""
+    isolated_client.get('/dashboard')
+    statements = _Statements(isolated_client.application)
+    isolated_client.get('/dashboard')
+    isolated_client.get('/budgets')
+    statements.close()
+    assert statements.sql
+    assert not any('FROM user' in sql or 'FROM category' in sql for sql in statements.sql)
+
+
+def test_category_writes_bump_version(client):
+    """Test adding a category is picked up on the next lookup"""
+    names = [c.name for c in refdata.categories()]
+    db.session.add(Category(name='Travel'))
+    db.session.commit()
+    assert [c.name for c in refdata.categories()] == names + ['Travel']
+
+
+def test_user_snapshot_expires_and_logout_clears_it(isolated_client):
+    """Test the snapshot is refreshed after its TTL and dropped on logout"""
+    client = isolated_client
+    client.get('/dashboard')
+    with client.session_transaction() as session:
+        snapshot = session[refdata.SNAPSHOT_KEY]
+        assert snapshot['email'] == 'snap@example.com'
+        stale = snapshot['at'] - 3600
+        session[refdata.SNAPSHOT_KEY] = dict(snapshot, at=stale)
+
+    statements = _Statements(client.application)
+    assert client.get('/dashboard').status_code == 200
+    statements.close()
+    assert any('FROM user' in sql for sql in statements.sql)
+    with client.session_transaction() as session:
+        assert session[refdata.SNAPSHOT_KEY]['at'] > stale
+
+    client.get('/logout')
+    with client.session_transaction() as session:
+        assert refdata.SNAPSHOT_KEY not in session
@@ -0,0 +1,110 @@
+from datetime import datetime
+import pytest
+from sqlalchemy import insert, update
+from app import db, rollup
+from app.models import User, Expense, MonthlySpend
+
+
+def _rollup(user_id):
+    return {(r.category_id, r.year, r.month): (r.total, r.count)
+            for r in MonthlySpend.query.filter_by(user_id=user_id) if r.count}
+
+
+def test_rollup_follows_expense_routes(auth_client):
+    """Test adding and deleting expenses through the views keeps the rollup in step"""
+    auth_client.post('/expenses', data=dict(amount=12.5, category=1, description='Lunch', date='2024-03-02'))
+    auth_client.post('/expenses', data=dict(amount=7.5, category=1, description='Coffee', date='2024-03-20'))
+    user = User.query.filter_by(email='test@example.com').first()
+    assert _rollup(user.id) == {(1, 2024, 3): (20.0, 2)}
+
+    expense = Expense.query.filter_by(description='Lunch').first()
+    auth_client.get(f'/expense/delete/{expense.id}')
+    assert _rollup(user.id) == {(1, 2024, 3): (7.5, 1)}
+    assert rollup.verify() == []
+
+
+def test_rollup_updates_and_bulk_statements(client):
+    """Test edits, bulk inserts and bulk deletes are all reflected"""
+    user = User(username='bulk', email='bulk@example.com', password='x')
+    db.session.add(user)
+    db.session.commit()
+
+    expense = Expense(amount=10, date=datetime(2024, 1, 31), user_id=user.id, category_id=1)
+    db.session.add(expense)
+    db.session.commit()
+    expense.date = datetime(2024, 2, 1)
+    expense.amount = 15
+    db.session.commit()
+    assert _rollup(user.id) == {(1, 2024, 2): (15.0, 1)}
+
+    db.session.execute(insert(Expense), [
+        {'amount_cents': 500, 'date': datetime(2024, 2, d), 'user_id': user.id, 'category_id': 2} for d in range(1, 5)
+    ])
+    db.session.commit()
+    assert _rollup(user.id) == {(1, 2024, 2): (15.0, 1), (2, 2024, 2): (20.0, 4)}
+
+    Expense.query.filter_by(user_id=user.id, category_id=2).delete()
+    db.session.commit()
+    assert _rollup(user.id) == {(1, 2024, 2): (15.0, 1)}
+    assert rollup.verify() == []
+
+
+def test_rollup_legacy_bulk_methods(client):
+    """Test bulk_insert_mappings and bulk_update_mappings reach the rollup, and bulk_save_objects is refused"""
+    user = User(username='legacy', email='legacy@example.com', password='x')
+    db.session.add(user)
+    db.session.commit()
+    db.session.bulk_insert_mappings(Expense, [
+        {'amount_cents': 500, 'date': datetime(2024, 5, d), 'user_id': user.id, 'category_id': 1} for d in (1, 2)
+    ])
+    db.session.commit()
+    assert _rollup(user.id) == {(1, 2024, 5): (10.0, 2)}
+
+    first = Expense.query.filter_by(user_id=user.id).order_by(Expense.id).first()
+    db.session.bulk_update_mappings(Expense, [{'id': first.id, 'amount_cents': 100, 'date': datetime(2024, 6, 1)}])
+    db.session.commit()
+    assert _rollup(user.id) == {(1, 2024, 5): (5.0, 1), (1, 2024, 6): (1.0, 1)}
+    assert rollup.verify() == []
+
+    with pytest.raises(TypeError):
+        db.session.bulk_save_objects([Expense(amount=1, user_id=user.id, category_id=1)])
+
+
+def test_rollup_bulk_update_statements(client):
+    """Test ORM UPDATE statements move totals between months and categories"""
+    user = User(username='mover', email='mover@example.com', password='x')
+    db.session.add(user)
+    db.session.commit()
+    db.session.execute(insert(Expense), [
+        {'amount_cents': 500, 'date': datetime(2024, 2, d), 'user_id': user.id, 'category_id': 1} for d in (1, 2, 3)
+    ])
+    db.session.commit()
+
+    # The WHERE clause no longer matches the rows once they are updated
+    db.session.execute(update(Expense).where(Expense.user_id == user.id, Expense.category_id == 1)
+                       .values(category_id=2, amount_cents=Expense.amount_cents * 2))
+    db.session.commit()
+    assert _rollup(user.id) == {(2, 2024, 2): (30.0, 3)}
+
+    Expense.query.filter_by(user_id=user.id).update({'date': datetime(2024, 3, 1)})
+    db.session.commit()
+    assert _rollup(user.id) == {(2, 2024, 3): (30.0, 3)}
+    # Untracked columns leave the rollup alone
+    Expense.query.filter_by(user_id=user.id).update({'description': 'Moved'})
+    db.session.commit()
+    assert rollup.verify() == []
+
+
+def test_rollup_command_repairs_drift(client):
+    """Test the rollup command reports drift and rebuilds"""
+    user = User(username='drift', email='drift@example.com', password='x')
+    db.session.add(user)
+    db.session.commit()
+    db.session.add(Expense(amount=10, date=datetime(2024, 1, 5), user_id=user.id, category_id=1))
+    db.session.commit()
+    MonthlySpend.query.filter_by(user_id=user.id).update({'total_cents': 9900})
+    db.session.commit()
+
+    result = client.application.test_cli_runner().invoke(args=['rollup'])
+    assert '1 rollup rows drifted.' in result.output
+    assert rollup.verify() == []
@@ -0,0 +1,88 @@
+from datetime import datetime
+from sqlalchemy import text
+from app import db, search
+from app.models import User, Expense
+
+
+def _add_expenses():
+    user = User(username='finder', email='finder@example.com', password='x')
+    other = User(username='other', email='other@example.com', password='x')
+    db.session.add_all([user, other])
+    db.session.commit()
+    db.session.add_all([
+        Expense(amount='4.50', description='Groceries at the corner shop', date=datetime(2024, 1, 5),
+                user_id=user.id, category_id=1),
+        Expense(amount='80.00', description='Weekly groceries', date=datetime(2024, 2, 10),
+                user_id=user.id, category_id=1),
+        Expense(amount='2.40', description='Bus fare', date=datetime(2024, 2, 11),
+                user_id=user.id, category_id=2),
+        Expense(amount='12.00', description='Café crème et croissant', date=datetime(2024, 3, 1),
+                user_id=user.id, category_id=1),
+        Expense(amount='9.00', description='Groceries', date=datetime(2024, 3, 2),
+                user_id=other.id, category_id=1)
+    ])
+    db.session.commit()
+    return user.id
+
+
+def _descriptions(page):
+    return [expense.description for expense, score in page.items]
+
+
+def test_search_prefix_and_filters(client):
+    """Test prefix matching within one user's expenses, combined with filters"""
+    user_id = _add_expenses()
+    assert sorted(_descriptions(search.search(user_id, 'groc'))) == [
+        'Groceries at the corner shop', 'Weekly groceries']
+    assert _descriptions(search.search(user_id, 'cafe cre')) == ['Café crème et croissant']
+    assert _descriptions(search.search(user_id, 'groc', min_cents=1000)) == ['Weekly groceries']
+    assert _descriptions(search.search(user_id, 'groc', end=datetime(2024, 2, 1))) == [
+        'Groceries at the corner shop']
+    assert _descriptions(search.search(user_id, 'fare', category_id=1)) == []
+    # FTS syntax in the query is treated as plain words
+    assert _descriptions(search.search(user_id, '"fare" *(:^')) == ['Bus fare']
+
+
+def test_search_ranks_and_pages(client):
+    """Test results are ranked and keyset paging visits each match once"""
+    user_id = _add_expenses()
+    # The shorter description is the closer match
+    assert _descriptions(search.search(user_id, 'groceries'))[0] == 'Weekly groceries'
+
+    seen, cursor = [], None
+    while True:
+        page = search.search(user_id, '', cursor=cursor, per_page=1)
+        seen += _descriptions(page)
+        cursor = page.next_cursor
+        if cursor is None:
+            break
+    assert len(seen) == len(set(seen)) == 4
+
+
+def test_index_follows_writes_and_rebuild(client):
+    """Test triggers keep the index in sync and a rebuild restores it"""
+    user_id = _add_expenses()
+    expense = Expense.query.filter_by(description='Bus fare').one()
+    expense.description = 'Train ticket'
+    db.session.commit()
+    assert _descriptions(search.search(user_id, 'bus')) == []
+    assert _descriptions(search.search(user_id, 'train')) == ['Train ticket']
+
+    db.session.delete(expense)
+    db.session.commit()
+    assert _descriptions(search.search(user_id, 'train')) == []
+
+    db.session.execute(text(f"INSERT INTO {search.FTS_TABLE} ({search.FTS_TABLE}) VALUES ('delete-all')"))
+    assert _descriptions(search.search(user_id, 'groc')) == []
+    search.rebuild(db.session.connection())
+    assert len(_descriptions(search.search(user_id, 'groc'))) == 2
+
+
+def test_search_route(auth_client):
+    """Test the search page and its cursor validation"""
+    auth_client.post('/expenses', data=dict(amount=12.5, category=1, description='Pizza night', date='2024-01-01'))
+    response = auth_client.get('/expenses/search?q=piz&min_amount=10')
+    assert response.status_code == 200
+    assert b'Pizza night' in response.data
+    assert b'Pizza night' not in auth_client.get('/expenses/search?q=piz&max_amount=10').data
+    assert auth_client.get('/expenses/search?q=piz&cursor=bogus').status_code == 400
@@ -0,0 +1,7 @@
+"""WSGI entry point for production servers, e.g.
+
+    APP_ENV=production SECRET_KEY=... gunicorn -c gunicorn.conf.py wsgi:app
+"""
+from app import create_app
+
+app = create_app()